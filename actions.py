@@ -0,0 +1,311 @@
+"""ゲームへの操作。Webの各エンドポイントとシミュレーションの両方から使う。
+
+各操作は成功すると {'message': ..., (追加の項目)} を返し、
+受け付けられない操作には ActionError を投げる。
+
+Webからの操作はplayを通す。playは操作ごとの乱数をゲームのシードと版から作り、
+行った操作をgame.historyに残すので、シードと履歴からゲームを最初から再現できる。
+履歴は手元のGameにだけあり、スナップショットには入らない(戻したゲームの履歴はNone)。
+"""
+import copy
+
+from game_logic import (
+    DICE_CATALOGUE,
+    Dice,
+    MontyHallEvent,
+    SLOT_OPTIONS,
+    spin_slot as spin_slot_result,
+)
+
+
+class ActionError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def roll_dice(game):
+    return {'message': game.next_turn()}
+
+
+def select_dice(game, dice_index):
+    player = game.players[game.current_player_index]
+
+    if not player.needs_dice_selection:
+        raise ActionError('サイコロの選択は必要ありません。')
+
+    # 選択されたインデックスがPREDEFINEDとMYSTERYの合計の範囲内か確認
+    if dice_index < 0 or dice_index >= len(DICE_CATALOGUE):
+        raise ActionError('無効なサイコロの選択です。')
+
+    selected_dice = DICE_CATALOGUE[dice_index]
+    player.dice = Dice(selected_dice['probabilities'])
+    player.needs_dice_selection = False
+    return {'message': f"{player.name}は「{selected_dice['name']}」を選択しました。"}
+
+
+def monty_hall_choice(game, choice=0, change='いいえ'):
+    player = game.players[game.current_player_index]
+
+    if not player.is_in_monty_hall:
+        raise ActionError('モンティ・ホールイベント中ではありません。')
+
+    state = player.monty_hall_state
+    if state.player_choice is None:
+        # プレイヤーの最初の選択
+        choice = int(choice)
+        if choice not in [1, 2, 3]:
+            raise ActionError('1から3の数字を選んでください。')
+        state.player_choice = choice
+
+        # 開ける扉を決定
+        doors = [1, 2, 3]
+        doors.remove(state.prize_door)
+        if state.player_choice != state.prize_door:
+            doors.remove(state.player_choice)
+        opened_door = game.rng.choice(doors)
+        state.opened_door = opened_door
+
+        message = f"扉{opened_door}はハズレでした。選択を変更しますか？（はい/いいえ）"
+        return {'message': message, 'opened_door': opened_door}
+
+    # プレイヤーの選択変更
+    if change.lower() == 'はい':
+        state.player_choice = 6 - state.player_choice - state.opened_door
+
+    # 結果判定
+    monty_event = game.board.event_at(player.position)
+    if not isinstance(monty_event, MontyHallEvent):
+        monty_event = MontyHallEvent()  # デフォルト値を設定
+
+    if state.player_choice == state.prize_door:
+        message = f"おめでとうございます！賞品を獲得しました。{monty_event.reward_steps}マス進みます。"
+        player.position += monty_event.reward_steps
+    else:
+        message = f"残念！ハズレでした。{monty_event.penalty_steps}マス戻ります。"
+        player.position -= monty_event.penalty_steps
+        if player.position < 0:
+            player.position = 0
+    player.is_in_monty_hall = False
+    player.monty_hall_state = None
+    return {'message': message}
+
+
+def spin_slot(game, slot_index):
+    if not game.is_slot_event_active:
+        raise ActionError('現在スロットイベント中ではありません。')
+
+    # スロットイベントではslot_orderの先頭が次に回すべきプレイヤー
+    if len(game.slot_order) == 0:
+        raise ActionError('全員スロットを回し終えました。')
+
+    next_player_idx = game.slot_order[0]
+    if next_player_idx < 0 or next_player_idx >= len(game.players):
+        raise ActionError('無効なプレイヤーインデックス。')
+
+    if slot_index < 0 or slot_index >= len(SLOT_OPTIONS):
+        raise ActionError('無効なスロット選択です。')
+
+    player = game.players[next_player_idx]
+
+    # スロット結果を取得して前進/後退
+    res = spin_slot_result(slot_index, game.rng)
+    steps = res['steps']
+    player.total_distance += steps
+    player.position += steps
+    player.position = player.position % game.board.size
+
+    result_msg = f"{player.name}は{SLOT_OPTIONS[slot_index]['name']}を回した！結果：{res['name']}（{steps}マス）"
+
+    # このプレイヤーは実行終了
+    game.slot_results[player.name] = result_msg
+    game.slot_order.pop(0)
+
+    # 全員終了したらイベント終了
+    if len(game.slot_order) == 0:
+        game.is_slot_event_active = False
+        all_res = "\n".join(game.slot_results.values())
+        result_msg += f"\n全員スロット終了！結果まとめ：\n{all_res}"
+
+    return {'message': result_msg}
+
+
+def _maze_player(game):
+    player = game.players[game.current_player_index]
+    if not player.is_in_maze or not player.maze:
+        raise ActionError('迷路イベント中ではありません。')
+    return player
+
+
+def maze_choices(game):
+    player = _maze_player(game)
+    choices_info = []
+    for idx, choice in enumerate(player.maze.get_current_choices()):
+        choices_info.append({
+            'index': idx,
+            'description': choice.description,
+            'probability': choice.probability
+        })
+    message = f"{player.name}は現在「{player.maze.current_node}」にいます。次に進む道を選んでください。"
+    return {'message': message, 'choices': choices_info}
+
+
+def maze_choice(game, choice_index):
+    player = _maze_player(game)
+    result_message = player.maze.make_choice(choice_index)
+
+    # 迷路が終了したか確認
+    if player.maze.is_finished:
+        player.is_in_maze = False
+        if player.maze.is_success:
+            player.position += player.maze.reward_steps
+            result_message += f"\n{player.name}は迷路を突破し、{player.maze.reward_steps}マス進みました！"
+        else:
+            player.position -= player.maze.penalty_steps
+            if player.position < 0:
+                player.position = 0
+            result_message += f"\n{player.name}は迷路で迷い、{player.maze.penalty_steps}マス戻りました。"
+        player.maze = None
+
+    return {'message': result_message}
+
+
+def pending_decision(game):
+    """次に必要な操作の種類と、それを行うプレイヤーの番号を返す。
+
+    画面と同じ優先度(モンティ・ホール > 迷路 > サイコロ選択 > スロット)で調べ、
+    どれも無ければサイコロを振る。終了していれば (None, None)。
+    """
+    if game.is_over:
+        return None, None
+    index = game.current_player_index
+    player = game.players[index]
+    if player.is_in_monty_hall:
+        if player.monty_hall_state.player_choice is None:
+            return 'monty_hall_choice', index
+        return 'monty_hall_change', index
+    if player.is_in_maze and player.maze:
+        return 'maze_choice', index
+    if player.needs_dice_selection:
+        return 'select_dice', index
+    if game.is_slot_event_active and game.slot_order:
+        return 'spin_slot', game.slot_order[0]
+    return 'roll_dice', index
+
+
+def _int_argument(action, key):
+    try:
+        return int(action.get(key, -1))
+    except (TypeError, ValueError):
+        raise ActionError(f"{key}には数値を指定してください。") from None
+
+
+def apply_action(game, action):
+    # {'type': 操作名, ...引数} の形の操作を実行する
+    kind = action.get('type')
+    if kind == 'roll_dice':
+        return roll_dice(game)
+    if kind == 'select_dice':
+        return select_dice(game, _int_argument(action, 'dice_index'))
+    if kind == 'monty_hall_choice':
+        return monty_hall_choice(game, action.get('choice', 0), action.get('change', 'いいえ'))
+    if kind == 'spin_slot':
+        return spin_slot(game, _int_argument(action, 'slot_index'))
+    if kind == 'maze_choice':
+        return maze_choice(game, _int_argument(action, 'choice_index'))
+    raise ActionError(f"不明な操作です: {kind}")
+
+
+# 引数を1つ取る操作と、その引数の名前
+_ARGUMENTS = {'select_dice': 'dice_index', 'spin_slot': 'slot_index', 'maze_choice': 'choice_index'}
+
+
+def canonical_action(game, action):
+    """履歴に残す形の操作を返す。今の状態で使われる引数だけを、決まった型にする。"""
+    kind = action.get('type')
+    if kind == 'roll_dice':
+        return {'type': kind}
+    if kind in _ARGUMENTS:
+        key = _ARGUMENTS[kind]
+        return {'type': kind, key: _int_argument(action, key)}
+    if kind == 'monty_hall_choice':
+        # 扉が開く前はchoice、開いた後はchangeだけが使われる
+        if pending_decision(game)[0] == 'monty_hall_change':
+            change = action.get('change', 'いいえ')
+            return {'type': kind, 'change': 'はい' if isinstance(change, str) and change.lower() == 'はい' else 'いいえ'}
+        try:
+            return {'type': kind, 'choice': int(action.get('choice', 0))}
+        except (TypeError, ValueError):
+            raise ActionError('1から3の数字を選んでください。') from None
+    raise ActionError(f"不明な操作です: {kind}")
+
+
+def play(game, action, rng=None):
+    """操作を1つ行い、履歴に残して版を進める。
+
+    乱数は省略すると (ゲームのシード, 操作前の版) から作る。計測のために包んだものを渡してもよいが、
+    引く値は同じものにすること。受け付けられない操作はActionErrorで、履歴も版も変わらない。
+    """
+    entry = canonical_action(game, action)
+    game.rng = rng if rng is not None else game.action_rng()
+    result = apply_action(game, entry)
+    if game.history is not None:
+        game.history.append(entry)
+    game.commit_changes()
+    return result
+
+
+def replay(game, history):
+    """始めたばかりのgameに操作の一覧を順に行い、各操作の結果の一覧を返す。"""
+    results = []
+    for action in history:
+        results.append(play(game, action))
+    return results
+
+
+def policy_action(policy, game, decision, player_index, rng=None):
+    """pending_decisionの結果に対して、方針が選ぶ操作を返す。
+
+    rngを省略するとgame.rngから選ぶ。
+    """
+    rng = rng if rng is not None else game.rng
+    player = game.players[player_index]
+    if decision == 'roll_dice':
+        return {'type': 'roll_dice'}
+    if decision == 'select_dice':
+        return {'type': 'select_dice', 'dice_index': policy.choose_dice(rng, player.position)}
+    if decision == 'monty_hall_choice':
+        # 最初に選ぶ扉で当たる確率は変わらない
+        return {'type': 'monty_hall_choice', 'choice': rng.randint(1, 3)}
+    if decision == 'monty_hall_change':
+        change = 'はい' if policy.switch_door(rng, player.position) else 'いいえ'
+        return {'type': 'monty_hall_choice', 'change': change}
+    if decision == 'maze_choice':
+        maze = player.maze
+        index = policy.choose_maze_branch(maze.current_node, maze.get_current_choices(), rng, maze.graph)
+        return {'type': 'maze_choice', 'choice_index': index}
+    if decision == 'spin_slot':
+        return {'type': 'spin_slot', 'slot_index': policy.choose_slot(rng, player.position)}
+    raise ValueError(f"不明な操作です: {decision}")
+
+
+def checkpoint(game):
+    """restoreで戻すためのゲームの複製を作る。
+
+    盤面・乱数・共通のサイコロは操作で変わらないので複製せずに共有する。
+    """
+    memo = {id(game.board): game.board, id(game.rng): game.rng, id(game.dice): game.dice,
+            id(game.history): game.history}
+    saved = copy.deepcopy(game, memo)
+    # 履歴は追記するだけなので複製せず、長さを覚えておいて戻すときに切り詰める
+    saved._history_length = None if game.history is None else len(game.history)
+    return saved
+
+
+def restore(game, saved):
+    # checkpointの時点に戻す。savedはそのまま取り込むので使い回さない
+    length = saved.__dict__.pop('_history_length')
+    game.__dict__.update(saved.__dict__)
+    if length is not None:
+        del game.history[length:]
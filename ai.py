@@ -0,0 +1,310 @@
+"""サーバー側で操作するコンピューターのプレイヤー。
+
+判断には期待値の表だけを使う。表の値 V[t][d][c] は、自分の手番の始め(サイコロを振る前)に
+サイコロd・マスcにいて、あと t 回振れるときの、これから増える累計移動距離の期待値。
+t の小さい方から順に1回ずつ後ろ向きに計算し、止まったマスのイベントでは各選択肢の
+うち期待値の最も高いものを選んだとして値を決める。
+
+表は (盤面, ゲーム共通のサイコロ) ごとに1つ作ってキャッシュする。盤面の雛形の表は起動時に
+prepareで作っておくので、手番ごとの判断は表を数回引くだけで終わる。雛形に無い盤面
+(保存データから戻したものなど)の表は裏のスレッドで作り、できるまではその場の期待値で選ぶ
+GreedyPolicyで判断する。リクエストを処理するスレッドで表を計算することはない。
+
+残り回数は盤面の大きさに応じてtable_rollsで打ち切り、それより先は表の最後の値で判断する
+(残り回数が多いと1回あたりの値の増え方はほぼ一定になり、選択肢の順位は変わらない)。
+
+他の人が起こすスロットイベントは自分の手番と関係なく起こるので、表の計算では無視する。
+回すときの判断には同じ表を使う。
+"""
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from actions import policy_action
+from game_logic import DICE_CATALOGUE, SLOT_OPTIONS, MontyHallEvent
+from markov import LRUCache, board_key, dice_key
+from maze import FAIL, GOAL
+from policies import GreedyPolicy
+
+# 盤面とサイコロの組み合わせごとの表
+_tables = LRUCache(maxsize=32)
+# 表を計算しておく残り回数の上限
+MAX_ROLLS = 256
+# 表の大きさ(残り回数 × マス数)の上限。1回分を継ぎ足すのに、40マスで約0.4ミリ秒、
+# 1万マスで約100ミリ秒かかる。1000マスまでの盤面はMAX_ROLLS回分を作り、それより大きい盤面は減らす
+MAX_TABLE_CELLS = MAX_ROLLS * 1000
+# 雛形に無い盤面の表を作るスレッド
+_builder = ThreadPoolExecutor(1, thread_name_prefix='sugoroku-tables')
+_building = set()
+_building_lock = threading.Lock()
+# 表ができるまでの判断に使う方針。選択肢の重みは1つだけが1なので、乱数で結果は変わらない
+_FALLBACK = GreedyPolicy()
+_FALLBACK_RNG = random.Random(0)
+# 迷路ごとに、各ノードからたどり着ける終点
+_maze_outcomes = {}
+_maze_lock = threading.Lock()
+
+
+def _probability_table(probabilities):
+    total = sum(probabilities.values())
+    return [(face, prob / total) for face, prob in probabilities.items() if prob > 0]
+
+
+def maze_outcomes(graph):
+    """迷路の各ノードから、選び方しだいでたどり着ける終点の集合を返す。"""
+    outcomes = _maze_outcomes.get(graph)
+    if outcomes is not None:
+        return outcomes
+    outcomes = {GOAL: frozenset([GOAL]), FAIL: frozenset([FAIL])}
+
+    def visit(node, seen):
+        if node in outcomes:
+            return outcomes[node]
+        if node in seen:
+            return frozenset()
+        reached = frozenset().union(*(visit(choice.to, seen | {node}) for choice in graph.choices(node)))
+        outcomes[node] = reached
+        return reached
+
+    for node in graph.edges:
+        visit(node, frozenset())
+    with _maze_lock:
+        _maze_outcomes[graph] = outcomes
+    return outcomes
+
+
+class ValueTable:
+    """盤面1つとゲーム共通のサイコロ1つに対する期待値の表。
+
+    サイコロの番号0はゲーム共通のサイコロ、1以降はDICE_CATALOGUEの順。
+    """
+
+    def __init__(self, board, dice):
+        self.size = board.size
+        self.max_rolls = table_rolls(board.size)
+        self.faces = [_probability_table(dice.probabilities)]
+        self.faces += [_probability_table(option['probabilities']) for option in DICE_CATALOGUE]
+        # 同じ確率のサイコロは小さい番号にまとめる
+        self._dice_ids = {}
+        for index, probabilities in enumerate([dice.probabilities] +
+                                              [option['probabilities'] for option in DICE_CATALOGUE]):
+            self._dice_ids.setdefault(tuple(sorted(probabilities.items())), index)
+
+        size = self.size
+        # マスごとに、止まったときの処理。イベントの無いマスはNone
+        self.landing = [None] * size
+        for position in board.index.positions:
+            event = board.events[position]
+            kind = event.kind
+            if kind == 'forward':
+                self.landing[position] = ('move', (position + event.steps) % size, 0)
+            elif kind == 'backward':
+                self.landing[position] = ('move', (position - event.steps) % size, -event.steps)
+            elif kind in ('monty_hall', 'maze'):
+                win = (position + event.reward_steps) % size
+                lose = max(position - event.penalty_steps, 0)
+                if kind == 'maze':
+                    reachable = maze_outcomes(event.graph)[event.graph.start]
+                    self.landing[position] = ('maze', win, lose, GOAL in reachable, FAIL in reachable)
+                else:
+                    self.landing[position] = ('monty_hall', win, lose)
+            elif kind in ('dice_selection', 'slot_machine'):
+                self.landing[position] = (kind,)
+            else:
+                raise ValueError(f"期待値の表で扱えないイベントです: {event.name}")
+
+        self.slots = [[(res['steps'], res['prob']) for res in option['results'] if res['prob'] > 0]
+                      for option in SLOT_OPTIONS]
+        self.values = [[[0.0] * size for _ in self.faces]]
+        self._lock = threading.Lock()
+
+    @property
+    def horizon(self):
+        return len(self.values) - 1
+
+    def ensure(self, rolls):
+        """残りrolls回(max_rollsまで)の値を計算しておく。"""
+        rolls = min(rolls, self.max_rolls)
+        if rolls <= self.horizon:
+            return
+        with self._lock:
+            while self.horizon < rolls:
+                self.values.append(self._next(self.values[-1]))
+
+    def _next(self, previous):
+        size = self.size
+        landed = [[self._landed(previous, d, cell) for cell in range(size)] for d in range(len(self.faces))]
+        values = []
+        for d, faces in enumerate(self.faces):
+            after = landed[d]
+            values.append([sum(prob * (face + after[(cell + face) % size]) for face, prob in faces)
+                           for cell in range(size)])
+        return values
+
+    def _landed(self, previous, d, cell):
+        # cellに止まった直後の期待値。イベントの選択はすべて最善を選ぶ
+        landing = self.landing[cell]
+        row = previous[d]
+        if landing is None:
+            return row[cell]
+        kind = landing[0]
+        if kind == 'move':
+            return landing[2] + row[landing[1]]
+        if kind == 'dice_selection':
+            return max(previous[i][cell] for i in range(1, len(self.faces)))
+        if kind == 'monty_hall':
+            win, lose = row[landing[1]], row[landing[2]]
+            # 扉を変えれば2/3、変えなければ1/3で当たる
+            return max(win, lose) * 2 / 3 + min(win, lose) / 3
+        if kind == 'maze':
+            _, win, lose, can_win, can_lose = landing
+            outcomes = [row[win]] * can_win + [row[lose]] * can_lose
+            return max(outcomes) if outcomes else row[cell]
+        return self._best_spin(row, cell)[1]
+
+    def _best_spin(self, row, cell):
+        size = self.size
+        best = None
+        for index, results in enumerate(self.slots):
+            value = sum(prob * (steps + row[(cell + steps) % size]) for steps, prob in results)
+            if best is None or value > best[1]:
+                best = (index, value)
+        return best
+
+    def row(self, rolls, d):
+        rolls = min(rolls, self.max_rolls)
+        self.ensure(rolls)
+        return self.values[rolls][d]
+
+    def dice_index(self, dice):
+        if dice is None:
+            return 0
+        return self._dice_ids.get(tuple(sorted(dice.probabilities.items())), 0)
+
+    def best_dice(self, rolls, cell):
+        # 選んだサイコロは以後ずっと使うので、次に振る前の値で比べる
+        rolls = min(rolls, self.max_rolls)
+        self.ensure(rolls)
+        values = self.values[rolls]
+        return max(range(len(DICE_CATALOGUE)), key=lambda i: values[i + 1][cell])
+
+    def best_slot(self, rolls, d, cell):
+        return self._best_spin(self.row(rolls, d), cell)[0]
+
+    def prefers(self, rolls, d, cell, other):
+        # cellにいる方がotherにいるより期待値が高い(同じなら高いとみなす)
+        row = self.row(rolls, d)
+        return row[cell % self.size] >= row[other % self.size]
+
+
+def table_rolls(size):
+    # size マスの盤面の表を何回分まで作るか。外挿に使うので2回分は必ず作る
+    return max(2, min(MAX_ROLLS, MAX_TABLE_CELLS // size))
+
+
+def _full_table(board, dice):
+    table = ValueTable(board, dice)
+    table.ensure(table.max_rolls)
+    return table
+
+
+def prepare(board, dice):
+    """起動時に盤面の雛形ごとに呼び、表を最後まで作って捨てない表として置く。"""
+    return _tables.pin((board_key(board), dice_key(dice)), _full_table(board, dice))
+
+
+def ready_table(board, dice):
+    """できている表を返す。無ければ裏のスレッドで作り始めてNoneを返す。"""
+    key = (board_key(board), dice_key(dice))
+    table = _tables.get(key)
+    if table is None:
+        build_later(_tables, key, lambda: _full_table(board, dice))
+    return table
+
+
+def build_later(cache, key, build):
+    """build()の結果を裏のスレッドでcacheに置く。同じkeyを作っている途中なら何もしない。"""
+    with _building_lock:
+        if (id(cache), key) in _building:
+            return
+        _building.add((id(cache), key))
+    _builder.submit(_build, cache, key, build)
+
+
+def _build(cache, key, build):
+    try:
+        cache.put(key, build())
+    finally:
+        with _building_lock:
+            _building.discard((id(cache), key))
+
+
+def table_for(board, dice, rolls=0):
+    """盤面とサイコロに対する表を返す。残りrolls回までの値はこの場で計算する。
+
+    リクエストの処理では使わない(シミュレーターやトーナメントの自動の対戦など向け)。
+    """
+    key = (board_key(board), dice_key(dice))
+    table = _tables.get(key)
+    if table is None:
+        table = _tables.put(key, ValueTable(board, dice))
+    table.ensure(rolls)
+    return table
+
+
+def rolls_left(game, seat):
+    """seatの人がこの先サイコロを振れる回数。今のターンでまだ振っていなければ今回も数える。"""
+    if game.is_over:
+        return 0
+    left = game.max_turns - game.current_turn + 1
+    if seat < game.current_player_index:
+        left -= 1
+    return max(left, 0)
+
+
+def decide(game, decision, seat):
+    """pending_decisionの結果に対して、期待値の表から選んだ操作を返す。"""
+    if decision == 'roll_dice':
+        return {'type': 'roll_dice'}
+    if decision == 'monty_hall_choice':
+        # 最初に選ぶ扉で当たる確率は変わらない
+        return {'type': 'monty_hall_choice', 'choice': 1}
+
+    table = ready_table(game.board, game.dice)
+    if table is None:
+        # 表ができるまでは、その場の期待値で選ぶ
+        return policy_action(_FALLBACK, game, decision, seat, _FALLBACK_RNG)
+    player = game.players[seat]
+    # 表はできている分だけを引く。足りない分をここで計算しない
+    rolls = min(rolls_left(game, seat), table.horizon)
+    d = table.dice_index(player.dice)
+    position = player.position
+    cell = position % table.size
+
+    if decision == 'select_dice':
+        return {'type': 'select_dice', 'dice_index': table.best_dice(rolls, cell)}
+    if decision == 'spin_slot':
+        return {'type': 'spin_slot', 'slot_index': table.best_slot(rolls, d, cell)}
+    if decision == 'monty_hall_change':
+        event = game.board.event_at(position)
+        if not isinstance(event, MontyHallEvent):
+            event = MontyHallEvent()
+        win = position + event.reward_steps
+        lose = max(position - event.penalty_steps, 0)
+        return {'type': 'monty_hall_choice', 'change': 'はい' if table.prefers(rolls, d, win, lose) else 'いいえ'}
+    if decision == 'maze_choice':
+        maze = player.maze
+        win = position + maze.reward_steps
+        lose = max(position - maze.penalty_steps, 0)
+        target = GOAL if table.prefers(rolls, d, win, lose) else FAIL
+        outcomes = maze_outcomes(maze.graph)
+        choices = maze.get_current_choices()
+        for index, choice in enumerate(choices):
+            if target in outcomes.get(choice.to, ()):
+                return {'type': 'maze_choice', 'choice_index': index}
+        return {'type': 'maze_choice', 'choice_index': 0}
+    raise ValueError(f"不明な操作です: {decision}")
+
+
+def cache_info():
+    return {'tables': _tables.info()}
@@ -0,0 +1,120 @@
+"""/analysisで返す確率と期待値。
+
+表は (盤面, ゲーム共通のサイコロ) ごとに1つ作る。表には、サイコロ(共通のサイコロと
+DICE_CATALOGUEの各サイコロ)ごと・マスごとに、次に振ったときに止まるマスの確率を作り置きする。
+先の手番まで含めた期待値はai.pyの期待値の表を引く。
+
+盤面の雛形の表は、どちらも起動時にprepareで作っておく。雛形に無い盤面の表は裏のスレッドで作り、
+できるまでanalyze_playerはNoneを返す。リクエストの処理の中では表を計算せず、引くだけで答える。
+"""
+import ai
+from ai import rolls_left
+from game_logic import DICE_CATALOGUE, MYSTERY_DICE_OPTIONS, SLOT_OPTIONS
+from markov import LRUCache, board_key, dice_key
+from policies import slot_expectation
+
+# 盤面とサイコロの組み合わせごとの表。雛形の表は捨てない
+_tables = LRUCache(maxsize=64)
+# 確率を伏せるサイコロ。使っている間は行き先の確率や先の期待値を返さない
+_MYSTERY_KEYS = frozenset(tuple(sorted(option['probabilities'].items())) for option in MYSTERY_DICE_OPTIONS)
+
+
+class AnalysisTable:
+    """盤面1つとゲーム共通のサイコロ1つに対する、止まるマスの確率の表。
+
+    サイコロの番号はai.ValueTableと同じく、0がゲーム共通のサイコロ、1以降がDICE_CATALOGUEの順。
+    """
+
+    def __init__(self, board, dice):
+        self.size = board.size
+        self.events = {position: board.events[position].kind for position in board.index.positions}
+        tables = [dice.probabilities] + [option['probabilities'] for option in DICE_CATALOGUE]
+        self.reach = [self._reach(probabilities) for probabilities in tables]
+        self.slot_steps = [slot_expectation(option) for option in SLOT_OPTIONS]
+
+    def _reach(self, probabilities):
+        # マスごとに、次に振って止まるマスと確率の一覧。盤面より大きい目は同じマスにまとめる
+        total = sum(probabilities.values())
+        rows = []
+        for cell in range(self.size):
+            row = {}
+            for face, prob in probabilities.items():
+                if prob > 0:
+                    target = (cell + face) % self.size
+                    row[target] = row.get(target, 0.0) + prob / total
+            rows.append(sorted(row.items()))
+        return rows
+
+
+def prepare(board, dice):
+    """起動時に盤面の雛形ごとに呼ぶ。確率の表と期待値の表(ai.prepare)を作っておく。"""
+    ai.prepare(board, dice)
+    return _tables.pin((board_key(board), dice_key(dice)), AnalysisTable(board, dice))
+
+
+def table_for_game(game):
+    # できている表を返す。無ければ裏のスレッドで作り始めてNoneを返す
+    key = (board_key(game.board), dice_key(game.dice))
+    table = _tables.get(key)
+    if table is None:
+        board, dice = game.board, game.dice
+        ai.build_later(_tables, key, lambda: AnalysisTable(board, dice))
+    return table
+
+
+def analyze_player(game, seat, target=None):
+    """seatの人について、次に止まるマスの確率と、スロットごとの期待値を返す。
+
+    確率を伏せたサイコロを使っている人には、スロットの目の期待値(expected_steps)だけを返す。
+    expected_distanceは、今からゲームの終わりまでに増える累計移動距離の期待値
+    (以後のイベントではコンピューターのプレイヤーと同じく期待値の最も高い選択をするとしたもの)。
+    表がまだできていなければNoneを返す。
+    """
+    table = table_for_game(game)
+    values = ai.ready_table(game.board, game.dice)
+    if table is None or values is None or values.horizon < 1:
+        return None
+    player = game.players[seat]
+    rolls = rolls_left(game, seat)
+    d = values.dice_index(player.dice)
+    cell = player.position % table.size
+    row = _value_row(values, rolls, d)
+
+    result = {'player': seat, 'position': player.position, 'rolls_left': rolls}
+    if player.dice is not None and dice_key(player.dice) in _MYSTERY_KEYS:
+        # 確率を伏せたサイコロの期待値や行き先は、そのサイコロの確率を明かしてしまう
+        result['dice_hidden'] = True
+        result['slots'] = [{'index': index, 'name': option['name'], 'expected_steps': table.slot_steps[index]}
+                           for index, option in enumerate(SLOT_OPTIONS)]
+        return result
+
+    reach = table.reach[d][cell]
+    result.update(
+        dice_hidden=False,
+        expected_distance=row[cell],
+        slots=[{'index': index, 'name': option['name'], 'expected_steps': table.slot_steps[index],
+                'expected_distance': sum(prob * (steps + row[(cell + steps) % table.size])
+                                         for steps, prob in values.slots[index])}
+               for index, option in enumerate(SLOT_OPTIONS)],
+        reach=[{'cell': position, 'probability': prob, 'event': table.events.get(position)}
+               for position, prob in reach],
+    )
+    if target is not None:
+        result['target'] = target
+        result['reach_probability'] = dict(reach).get(target % table.size, 0.0)
+    return result
+
+
+def _value_row(values, rolls, d):
+    # 表はhorizon回までなので、それより先は1回あたりの増え方が変わらないとみなして延ばす
+    horizon = values.horizon
+    if rolls <= horizon:
+        return values.values[rolls][d]
+    last = values.values[horizon][d]
+    previous = values.values[horizon - 1][d]
+    extra = rolls - horizon
+    return [value + extra * (value - before) for value, before in zip(last, previous)]
+
+
+def cache_info():
+    return {'tables': _tables.info()}
@@ -1,28 +1,257 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template
 from game_logic import (
-    Cell,
-    Event,
     Player,
     Dice,
-    Board,
     Game,
-    forward_event_factory,
-    backward_event_factory,
-    ProbabilityMazeEvent,
-    DiceSelectionEvent,
-    MontyHallEvent,
     PREDEFINED_DICE_OPTIONS,
     MYSTERY_DICE_OPTIONS,
     SLOT_OPTIONS, 
-    spin_slot,
-    SlotMachineEvent
+    MAX_SEED_LENGTH,
+    MAX_TURNS,
 )
+import actions
+import ai
+import analysis
+from actions import ActionError
+from boards import DEFAULT_BOARD_NAME, TEMPLATES, board_catalogue, board_layout, board_template, render_layout
+from journal import open_journal
+import metrics
+from policies import POLICIES
+from pubsub import Broadcaster, FanOut, stream
+from responses import FastJSONProvider, StaticPayload, get_encoder
+from rooms import GameRegistry
+from store import VersionConflict, open_store
+from tournament import Entrant, Tournament, TournamentRunner
+import os
 import random
+import time
 
 app = Flask(__name__)
 
-# ゲームのインスタンスを保持する変数
-game = None
+# 応答のJSON化に使うエンコーダー。SUGOROKU_JSONで選べ、省略時はorjsonがあればorjson
+json_encoder = get_encoder(os.environ.get('SUGOROKU_JSON'))
+app.json = FastJSONProvider(app, json_encoder)
+
+ROOM_TTL = float(os.environ.get('SUGOROKU_ROOM_TTL', 3600))
+
+# SUGOROKU_STOREを指定すると、ゲーム状態を共有ストアに置き複数ワーカーで動かせる
+# 例: sqlite:///games.db, redis://localhost:6379/0
+store_url = os.environ.get('SUGOROKU_STORE')
+
+# ゲームの更新を購読中のクライアントへ配信する
+broadcaster = Broadcaster(dumps=json_encoder)
+
+# SUGOROKU_JOURNALを指定すると、共有ストアを使わない場合でも操作をディレクトリに記録し、
+# ワーカーの再起動時に進行中のゲームを復元する
+journal_dir = os.environ.get('SUGOROKU_JOURNAL')
+journal = None
+
+
+def _room_closed(game_id):
+    broadcaster.close(game_id)
+    spectators.close(game_id)
+    tournaments.close_game(game_id)
+    if journal is not None:
+        journal.end(game_id)
+
+
+# ゲームIDごとにゲームのインスタンスを保持するレジストリ
+registry = GameRegistry(
+    max_rooms=int(os.environ.get('SUGOROKU_MAX_ROOMS', 10000)),
+    ttl=ROOM_TTL,
+    store=open_store(store_url, ttl=ROOM_TTL) if store_url else None,
+    on_close=_room_closed,
+)
+
+if journal_dir and not store_url:
+    journal, recovered = open_journal(
+        journal_dir,
+        fsync_interval=float(os.environ.get('SUGOROKU_JOURNAL_FSYNC_MS', 50)) / 1000,
+        snapshot_every=int(os.environ.get('SUGOROKU_JOURNAL_SNAPSHOT_EVERY', 64)),
+    )
+    for recovered_id, recovered_game in recovered:
+        registry.create(recovered_game, recovered_id)
+
+# /metricsで返す計測値
+metrics_registry = metrics.MetricsRegistry()
+REQUEST_LATENCY = metrics_registry.register(metrics.Histogram(
+    'sugoroku_http_request_duration_seconds', 'エンドポイントごとの応答時間(秒)', ('route', 'method')))
+REQUESTS = metrics_registry.register(metrics.Counter(
+    'sugoroku_http_requests_total', 'エンドポイントと応答コードごとのリクエスト数', ('route', 'method', 'status')))
+EVENTS = metrics_registry.register(metrics.Counter(
+    'sugoroku_game_events_total', '種類ごとの発生したイベントの数', ('kind',)))
+EVENT_LATENCY = metrics_registry.register(metrics.Histogram(
+    'sugoroku_game_event_duration_seconds', 'イベントの効果の処理にかかった時間(秒)', ('kind',),
+    metrics.EVENT_BUCKETS))
+RNG_DRAWS = metrics_registry.register(metrics.Counter(
+    'sugoroku_rng_draws_total', '操作の中で乱数を引いた回数', ('method',)))
+CPU_ACTIONS = metrics_registry.register(metrics.Counter(
+    'sugoroku_cpu_actions_total', 'コンピューターのプレイヤーが行った操作の数', ('decision',)))
+SPECTATOR_RESYNCS = metrics_registry.register(metrics.Counter(
+    'sugoroku_spectator_resyncs_total', '追いつけない観戦者に状態全体を送り直した回数'))
+metrics_registry.register(metrics.CallbackCounter(
+    'sugoroku_analysis_cache_lookups_total', '確率・期待値の表のキャッシュのヒット・ミスの数(valuesはコンピューターの判断と共有)', ('cache', 'result'),
+    lambda: {(name, result): info[result]
+             for name, info in (('reach', analysis.cache_info()['tables']), ('values', ai.cache_info()['tables']))
+             for result in ('hits', 'misses')}))
+metrics_registry.register(metrics.Gauge(
+    'sugoroku_rooms_active', 'このワーカーが保持している部屋の数', lambda: len(registry)))
+metrics_registry.register(metrics.Gauge(
+    'sugoroku_spectators', '接続中の観戦者の数', lambda: spectators.total_subscribers()))
+
+# SUGOROKU_PROFILERを指定したときだけ、/metrics/profileからプロファイラーを動かせる
+profiler = metrics.SamplingProfiler()
+profiler_allowed = bool(os.environ.get('SUGOROKU_PROFILER'))
+metrics_registry.register(metrics.Gauge(
+    'sugoroku_profiler_samples', 'プロファイラーが取ったサンプルの数', lambda: profiler.samples))
+
+
+def _observe_event(event, seconds):
+    EVENTS.inc(event.kind)
+    EVENT_LATENCY.observe(seconds, event.kind)
+
+
+Game.event_observer = _observe_event
+
+NOT_STARTED_MESSAGE = 'ゲームが開始されていません。'
+
+# /batchで1回のリクエストに実行する操作の上限
+BATCH_MAX_ACTIONS = 1000
+batch_policies = {}
+
+
+def _request_game_id():
+    # GETはクエリ文字列、POSTはJSONボディからゲームIDを受け取る
+    game_id = request.args.get('game_id')
+    if game_id:
+        return game_id
+    data = request.get_json(silent=True) or {}
+    return data.get('game_id')
+
+def _request_since():
+    # 手元にある状態の版。指定されれば、それ以降に変わった項目だけを返す
+    since = request.args.get('since')
+    if since is None:
+        data = request.get_json(silent=True) or {}
+        since = data.get('since')
+    try:
+        return int(since) if since is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _game_state(game, since=None):
+    game_fields, players_state = game.changes_since(since)
+    state = {'version': game.version}
+    if since is not None:
+        state['since'] = since
+    state['players'] = players_state
+    state.update(game_fields)
+    return state
+
+
+def _spectator_state(game_id):
+    # 観戦者に最初と、追いつけなくなったときに送る状態全体
+    with registry.session(game_id) as game:
+        if game is None:
+            return None
+        return _game_state(game)
+
+
+# 観戦者への配信。更新は専用のスレッドで配るので、観戦者が多くても操作の応答は遅くならない
+spectators = FanOut(
+    _spectator_state,
+    max_bytes=int(os.environ.get('SUGOROKU_SPECTATOR_BUFFER_KB', 256)) * 1024,
+    dumps=json_encoder,
+    on_resync=SPECTATOR_RESYNCS.inc,
+)
+
+
+def _publish(game_id, game, since, message, **extra):
+    update = _game_state(game, since)
+    update['message'] = message
+    update.update(extra)
+    # 書き込みが競合して失敗した更新は配信しないよう、応答が確定してから送る
+    g.setdefault('pending_events', []).append((game_id, update))
+    if game.is_over and tournaments.is_live(game_id):
+        g.setdefault('finished_matches', []).append((game_id, [player.total_distance for player in game.players]))
+
+    # 操作したクライアントには、送られてきた版からの差分(無ければ全体)を返す
+    payload = _game_state(game, _request_since())
+    payload['message'] = message
+    payload.update(extra)
+    return payload
+
+
+def _apply(game_id, game, action):
+    # 乱数は (シード, 版) から作ったものを、引いた回数を数えるために包んで渡す
+    rng = metrics.CountingRandom(game.action_rng())
+    try:
+        return actions.play(game, action, rng)
+    finally:
+        game.rng = rng.rng
+        rng.record(RNG_DRAWS)
+
+
+def _perform(game_id, action):
+    # 操作を実行して配信する。受け付けられない操作はエラーメッセージを返す
+    with registry.session(game_id, write=True) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        start_version = game.version
+        steps = []
+        entries = []
+        try:
+            result = _batch_step(game_id, game, action, steps, entries)
+        except ActionError as error:
+            return jsonify({'message': error.message}), error.status
+        # 続くコンピューターの番は同じリクエストの中で進め、まとめて配信する
+        _auto_play(game_id, game, steps, entries)
+        extra = {key: value for key, value in result.items() if key != 'message'}
+        if len(steps) > 1:
+            extra['cpu_steps'] = steps[1:]
+        payload = _publish(game_id, game, start_version,
+                           '\n'.join(step['message'] for step in steps), **extra)
+        if journal is not None:
+            journal.record_entries(game_id, game, entries)
+        return jsonify(payload)
+
+
+def _conditional(payload, etag):
+    # ETagが一致すれば本文を省いて304を返す
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # URLそのものではなくルートの形で分け、存在しないURLはまとめる
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(response.status_code))
+    return response
+
+
+@app.after_request
+def _flush_events(response):
+    pending = g.pop('pending_events', ())
+    if response.status_code < 400:
+        for game_id, update in pending:
+            broadcaster.publish(game_id, 'update', update, update['version'])
+            spectators.publish(game_id, 'update', update, update['version'])
+        for game_id, distances in g.pop('finished_matches', ()):
+            tournaments.report_game(game_id, distances)
+    return response
+
 
 @app.route('/')
 def index():
@@ -31,361 +260,557 @@ def index():
 
 @app.route('/start_game', methods=['POST'])
 def start_game():
-    global game
     data = request.get_json()
+    try:
+        players, board, max_turns, seed = _game_settings(data)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+
+    game_id, message, seed = _create_game(players, board, max_turns, seed)
+    return jsonify({'message': message, 'num_players': len(players), 'game_id': game_id, 'seed': seed})
+
+
+def _game_settings(data):
+    # /start_gameと/replayの本文から (プレイヤー, 盤面, ターン数, シード) を作る。不正な値はValueError
     num_players = data.get('num_players', 2)
     characters = data.get('characters', [])
     max_turns = data.get('max_turns', 20)  # ユーザーからターン数を指定できるようにする
+    # ターン数はコンピューターの判断に使う表の大きさにもなるので上限を設ける
+    if not isinstance(max_turns, int) or isinstance(max_turns, bool) or not 1 <= max_turns <= MAX_TURNS:
+        raise ValueError(f"max_turnsには1以上{MAX_TURNS}以下の整数を指定してください。")
+    # コンピューターが操作する席の番号
+    try:
+        cpu_players = {int(seat) for seat in data.get('cpu_players', [])}
+    except (TypeError, ValueError):
+        raise ValueError('cpu_playersには席の番号を指定してください。') from None
 
     players = []
     for i in range(num_players):
         name = f"プレイヤー{i+1}"
         character = characters[i] if i < len(characters) else 'default.png'
-        players.append(Player(name, character))
+        players.append(Player(name, character, is_cpu=i in cpu_players))
+
+    # 盤面は起動時に読み込んだ雛形をそのまま使う
+    board = board_template(data.get('board', DEFAULT_BOARD_NAME))
+    return players, board, max_turns, _seed_argument(data.get('seed'))
+
+
+def _seed_argument(seed):
+    # 指定されたシードは文字列にそろえる。省略時はNone(ゲームを作るときに決める)
+    if seed is None:
+        return None
+    if isinstance(seed, bool) or not isinstance(seed, (str, int)):
+        raise ValueError('seedには文字列か整数を指定してください。')
+    seed = str(seed)
+    if not 0 < len(seed) <= MAX_SEED_LENGTH:
+        raise ValueError(f"seedは1文字以上{MAX_SEED_LENGTH}文字以下にしてください。")
+    return seed
 
+
+def _create_game(players, board, max_turns, seed=None):
+    # ゲームを作って部屋に置き、(ゲームID, 開始のメッセージ, シード) を返す
     default_dice = PREDEFINED_DICE_OPTIONS[0]
     dice = Dice(default_dice['probabilities'].copy())
+    # コンピューターの判断に使う表は、雛形ごとに起動時に作ってある(ai.prepare)
+    has_cpu = any(player.is_cpu for player in players)
 
-    board_size = 40
-    board = Board(board_size)
-
-    # イベントの追加
-    board.add_event(3, SlotMachineEvent())
-    board.add_event(7, MontyHallEvent())
-    board.add_event(4, MontyHallEvent())
-    board.add_event(5, forward_event_factory(2))
-    board.add_event(10, backward_event_factory(3))
-    board.add_event(15, DiceSelectionEvent())  # サイコロ選択イベント
-    board.add_event(20, forward_event_factory(5))
-    board.add_event(25, backward_event_factory(4))
-    board.add_event(30, DiceSelectionEvent())  # サイコロ選択イベント
-    board.add_event(12, ProbabilityMazeEvent())
-    board.add_event(22, MontyHallEvent())
-    board.add_event(35, SlotMachineEvent())
-
-    # ゲームの作成
-    game = Game(players, board, dice, max_turns=max_turns)
+    game = Game(players, board, dice, max_turns=max_turns, seed=seed)
     game.start()
+    seed = game.seed
+    game_id = registry.create(game)
+    if journal is not None:
+        journal.start(game_id, game)
+
+    message = 'ゲームを開始しました。'
+    if has_cpu:
+        # 最初の番がコンピューターなら、人の番になるまで進めておく
+        with registry.session(game_id, write=True) as game:
+            steps = []
+            entries = []
+            _auto_play(game_id, game, steps, entries)
+            if journal is not None:
+                journal.record_entries(game_id, game, entries)
+        message = '\n'.join([message] + [step['message'] for step in steps])
+    return game_id, message, seed
+
+
+def _open_tournament_match(tournament, match):
+    # 人のいる対戦は通常のゲームとして部屋を作る。人以外の席はコンピューターが操作する
+    players = []
+    for name in match.seats:
+        entrant = tournament.entrants[name]
+        players.append(Player(name, entrant.character, is_cpu=not entrant.is_human))
+    game_id, _, _ = _create_game(players, board_template(tournament.board), tournament.max_turns)
+    return game_id
 
-    return jsonify({'message': 'ゲームを開始しました。', 'num_players': num_players})
+
+# トーナメントの自動の対戦を実行するワーカーの数。省略時はCPUの数
+tournaments = TournamentRunner(
+    workers=int(os.environ.get('SUGOROKU_TOURNAMENT_WORKERS', 0)) or None,
+    open_live=_open_tournament_match,
+)
 
 @app.route('/get_game_state', methods=['GET'])
 def get_game_state():
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
-    players_state = []
-    for player in game.players:
-        players_state.append({
-            'name': player.name,
-            'position': player.position,
-            'character': player.character,
-            'is_in_monty_hall': player.is_in_monty_hall,
-            'is_in_maze': player.is_in_maze,
-            'needs_dice_selection': player.needs_dice_selection  # 更新
-        })
-
-    return jsonify({
-        'players': players_state,
-        'current_player_index': game.current_player_index,
-        'is_over': game.is_over,
-        'is_slot_event_active': game.is_slot_event_active
-    })
+    game_id = _request_game_id()
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+
+        since = _request_since()
+        return _conditional(_game_state(game, since), f"{game_id}.{game.version}.{since}")
 
 @app.route('/roll_dice', methods=['POST'])
 def roll_dice():
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
-    message = game.next_turn()
-
-
-    # ゲーム状態を返す
-    players_state = []
-    for player in game.players:
-        players_state.append({
-            'name': player.name,
-            'position': player.position,
-            'character': player.character,
-            'is_in_monty_hall': player.is_in_monty_hall,
-            'is_in_maze': player.is_in_maze,
-            'needs_dice_selection': player.needs_dice_selection  # 更新
-        })
-
-    response = {
-        'message': message,
-        'players': players_state,
-        'current_player_index': game.current_player_index,
-        'is_over': game.is_over
-    }
-
-    return jsonify(response)
+    return _perform(_request_game_id(), {'type': 'roll_dice'})
 
 @app.route('/get_dice_probabilities', methods=['GET'])
 def get_dice_probabilities():
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-    return jsonify({'probabilities': game.dice.probabilities})
+    game_id = _request_game_id()
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        return _conditional({'probabilities': game.dice.probabilities}, f"{game_id}.dice")
 
 @app.route('/get_event_positions', methods=['GET'])
 def get_event_positions():
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-    event_positions = []
-    for cell in game.board.cells:
-        if cell.event:
-            event_positions.append({'position': cell.position, 'event_name': cell.event.name})
-    return jsonify({'event_positions': event_positions})
+    game_id = _request_game_id()
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        # ボードの索引に作り置きした一覧と、画面に並べるための大きさを返す
+        payload = dict(board_layout(game.board), event_positions=game.board.index.event_positions)
+        return _conditional(payload, f"{game_id}.positions")
+
+@app.route('/get_board_layout', methods=['GET'])
+def get_board_layout():
+    # 盤面を描くためのマスの配置とイベントの記号。ゲーム中は変わらない
+    game_id = _request_game_id()
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        board = game.board
+    payload = BOARD_LAYOUT_PAYLOADS.get(getattr(board, 'name', None))
+    if payload is not None and TEMPLATES[board.name] is board:
+        return payload.response(request, app.response_class)
+    # 今の設定に無い盤面(保存データから戻したもの)はその場で作る
+    return _conditional(render_layout(board), f"{game_id}.layout")
 
 @app.route('/get_event_descriptions', methods=['GET'])
 def get_event_descriptions():
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-    event_set = {}
-    for cell in game.board.cells:
-        if cell.event and cell.event.name not in event_set:
-            event_set[cell.event.name] = cell.event.description
-    events = []
-    for name, description in event_set.items():
-        events.append({'name': name, 'description': description})
-    return jsonify({'events': events})
-
+    game_id = _request_game_id()
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        events = game.board.index.event_descriptions
+        return _conditional({'events': events}, f"{game_id}.descriptions")
+
+
+@app.route('/analysis', methods=['GET'])
+def analysis_endpoint():
+    """プレイヤーについての確率と期待値。
+
+    player: 席の番号(省略時は次に操作する人)。target: 次に止まる確率を知りたいマス
+    """
+    game_id = _request_game_id()
+    try:
+        seat, target = (None if request.args.get(key) is None else int(request.args[key])
+                        for key in ('player', 'target'))
+    except ValueError:
+        return jsonify({'message': 'playerとtargetには数値を指定してください。'}), 400
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        if seat is None:
+            seat = actions.pending_decision(game)[1]
+            if seat is None:
+                seat = game.current_player_index
+        if not 0 <= seat < len(game.players):
+            return jsonify({'message': '無効なプレイヤーインデックス。'}), 400
+        payload = analysis.analyze_player(game, seat, target)
+        if payload is None:
+            return jsonify({'message': 'この盤面の分析の表を準備しています。しばらくしてからもう一度お試しください。'}), 503
+        return _conditional(payload, f"{game_id}.{game.version}.analysis.{seat}.{target}")
 
 @app.route('/select_dice', methods=['POST'])
 def select_dice():
-    global game
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
     data = request.get_json()
-    selected_dice_index = int(data.get('dice_index', -1))
+    action = {'type': 'select_dice', 'dice_index': data.get('dice_index', -1)}
+    return _perform(_request_game_id(), action)
 
-    player = game.players[game.current_player_index]
 
-    if not player.needs_dice_selection:
-        return jsonify({'message': 'サイコロの選択は必要ありません。'}), 400
+def _dice_options_payload():
+    # 通常のサイコロは確率を公開し、謎サイコロは確率を返さない。
+    # クライアントは確率の無いものを確率不明なサイコロとして扱う
+    dice_options = [{'name': option['name'], 'description': option['description'],
+                     'probabilities': option['probabilities']} for option in PREDEFINED_DICE_OPTIONS]
+    dice_options += [{'name': option['name'], 'description': option['description']}
+                     for option in MYSTERY_DICE_OPTIONS]
+    return {'dice_options': dice_options}
 
-    # 選択されたインデックスがPREDEFINEDとMYSTERYの合計の範囲内か確認
-    total_options = len(PREDEFINED_DICE_OPTIONS) + len(MYSTERY_DICE_OPTIONS)
-    if selected_dice_index < 0 or selected_dice_index >= total_options:
-        return jsonify({'message': '無効なサイコロの選択です。'}), 400
 
-    if selected_dice_index < len(PREDEFINED_DICE_OPTIONS):
-        # 通常サイコロ選択
-        selected_dice = PREDEFINED_DICE_OPTIONS[selected_dice_index]
-        player.dice = Dice(selected_dice['probabilities'])
-        dice_name = selected_dice['name']
-    else:
-        # 謎サイコロ選択
-        mystery_index = selected_dice_index - len(PREDEFINED_DICE_OPTIONS)
-        selected_dice = MYSTERY_DICE_OPTIONS[mystery_index]
-        player.dice = Dice(selected_dice['probabilities'])
-        dice_name = selected_dice['name']
-    
-    player.needs_dice_selection = False
-    message = f"{player.name}は「{dice_name}」を選択しました。"
-    return jsonify({'message': message})
+def _slot_options_payload():
+    # 確率は非公開でよいので、名前と説明のみ返す
+    return {'slot_options': [{'index': i, 'name': slot['name'], 'description': slot['description']}
+                             for i, slot in enumerate(SLOT_OPTIONS)]}
+
+
+# 選択肢の一覧は変わらないので、起動時にJSONと圧縮版を作っておく
+DICE_OPTIONS_PAYLOAD = StaticPayload(_dice_options_payload())
+SLOT_OPTIONS_PAYLOAD = StaticPayload(_slot_options_payload())
+BOARDS_PAYLOAD = StaticPayload({'boards': board_catalogue(), 'default': DEFAULT_BOARD_NAME})
+# 盤面の配置も雛形ごとに1つ作っておき、同じ盤面のゲームで共有する
+BOARD_LAYOUT_PAYLOADS = {name: StaticPayload(render_layout(template)) for name, template in TEMPLATES.items()}
+# コンピューターの判断と/analysisに使う表も雛形ごとに作っておき、リクエストの処理では引くだけにする
+for _template in TEMPLATES.values():
+    analysis.prepare(_template, Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy()))
+
+
+@app.route('/get_boards', methods=['GET'])
+def get_boards():
+    # 選べる盤面の一覧
+    return BOARDS_PAYLOAD.response(request, app.response_class)
 
 
 @app.route('/get_dice_options', methods=['GET'])
 def get_dice_options():
-    # 従来のオプションと謎サイコロオプションをまとめたリストを作る
-    # 謎サイコロは確率を非公開にするため、probabilitiesを返さない、または偽のデータにする
-    dice_options = []
-
-    # 通常のサイコロは従来通り確率を公開
-    for dice_option in PREDEFINED_DICE_OPTIONS:
-        dice_options.append({
-            'name': dice_option['name'],
-            'description': dice_option['description'],
-            'probabilities': dice_option['probabilities']  # 従来通り公開
-        })
-
-    # 謎サイコロは確率を非表示。ここではprobabilitiesを返さないか、空にする
-    from game_logic import MYSTERY_DICE_OPTIONS
-    for dice_option in MYSTERY_DICE_OPTIONS:
-        dice_options.append({
-            'name': dice_option['name'],
-            'description': dice_option['description'],
-            # 'probabilities': {} # もしくは返さない
-            # ここでは確率を返さないことで、クライアントは確率不明なサイコロとして受け取る
-        })
-
-    return jsonify({'dice_options': dice_options})
+    return DICE_OPTIONS_PAYLOAD.response(request, app.response_class)
 
 @app.route('/monty_hall_choice', methods=['POST'])
 def monty_hall_choice():
-    global game
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
     data = request.get_json()
-    player = game.players[game.current_player_index]
-
-    if not player.is_in_monty_hall:
-        return jsonify({'message': 'モンティ・ホールイベント中ではありません。'}), 400
-
-    if player.monty_hall_state.get('player_choice') is None:
-        # プレイヤーの最初の選択
-        choice = int(data.get('choice', 0))
-        if choice not in [1, 2, 3]:
-            return jsonify({'message': '1から3の数字を選んでください。'}), 400
-        player.monty_hall_state['player_choice'] = choice
-
-        # 開ける扉を決定
-        doors = [1, 2, 3]
-        doors.remove(player.monty_hall_state['prize_door'])
-        if player.monty_hall_state['player_choice'] != player.monty_hall_state['prize_door']:
-            doors.remove(player.monty_hall_state['player_choice'])
-        opened_door = random.choice(doors)
-        player.monty_hall_state['opened_door'] = opened_door
-
-        message = f"扉{opened_door}はハズレでした。選択を変更しますか？（はい/いいえ）"
-        return jsonify({'message': message, 'opened_door': opened_door})
-    else:
-        # プレイヤーの選択変更
-        change = data.get('change', 'いいえ')
-        if change.lower() == 'はい':
-            remaining_door = 6 - player.monty_hall_state['player_choice'] - player.monty_hall_state['opened_door']
-            player.monty_hall_state['player_choice'] = remaining_door
-
-        # 結果判定
-        monty_event = None
-        for cell in game.board.cells:
-            if cell.position == player.position and isinstance(cell.event, MontyHallEvent):
-                monty_event = cell.event
-                break
-
-        if monty_event is None:
-            monty_event = MontyHallEvent()  # デフォルト値を設定
-
-        if player.monty_hall_state['player_choice'] == player.monty_hall_state['prize_door']:
-            message = f"おめでとうございます！賞品を獲得しました。{monty_event.reward_steps}マス進みます。"
-            player.position += monty_event.reward_steps
-        else:
-            message = f"残念！ハズレでした。{monty_event.penalty_steps}マス戻ります。"
-            player.position -= monty_event.penalty_steps
-            if player.position < 0:
-                player.position = 0
-        player.is_in_monty_hall = False
-        player.monty_hall_state = {}
-        return jsonify({'message': message})
+    # 最初の選択ではchoice、扉が開いた後はchangeを使う
+    action = {'type': 'monty_hall_choice', 'choice': data.get('choice', 0), 'change': data.get('change', 'いいえ')}
+    return _perform(_request_game_id(), action)
 
 @app.route('/get_slot_options', methods=['GET'])
 def get_slot_options():
-    # スロット一覧を返す。確率は非公開でよいので、名前と説明のみ返す
-    slot_data = []
-    for i, slot in enumerate(SLOT_OPTIONS):
-        slot_data.append({
-            'index': i,
-            'name': slot['name'],
-            'description': slot['description']
-        })
-    return jsonify({'slot_options': slot_data})
+    return SLOT_OPTIONS_PAYLOAD.response(request, app.response_class)
 
 @app.route('/spin_slot', methods=['POST'])
 def spin_slot_endpoint():
-    global game
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
-    if not game.is_slot_event_active:
-        return jsonify({'message': '現在スロットイベント中ではありません。'}), 400
-
     data = request.get_json()
-    slot_index = data.get('slot_index', -1)
-    player_index = game.current_player_index
-
-    # スロットイベントではplayerはslot_orderに従い順番に回す
-    # クライアント側は適宜、現在誰の番か問い合わせて表示する必要あり
-    # ここでは、spin_slotを呼ぶ前にフロントが誰の番かを知っている想定
-
-    # 誰の番かをサーバーで管理するため、未実行のプレイヤーを追跡
-    # slot_orderの先頭が次に回すべきプレイヤー
-    if len(game.slot_order) == 0:
-        return jsonify({'message': '全員スロットを回し終えました。'}), 400
-
-    next_player_idx = game.slot_order[0]
-    if next_player_idx < 0 or next_player_idx >= len(game.players):
-        return jsonify({'message': '無効なプレイヤーインデックス。'}), 400
-
-    if slot_index < 0 or slot_index >= len(SLOT_OPTIONS):
-        return jsonify({'message': '無効なスロット選択です。'}), 400
-
-    player = game.players[next_player_idx]
-
-    # スロット結果を取得
-    res = spin_slot(slot_index)
-    steps = res['steps']
-    # 前進/後退処理
-    player.total_distance += steps
-    player.position += steps
-    player.position = player.position % game.board.size
-
-    result_msg = f"{player.name}は{SLOT_OPTIONS[slot_index]['name']}を回した！結果：{res['name']}（{steps}マス）"
-
-    # このプレイヤーは実行終了
-    game.slot_results[player.name] = result_msg
-    game.slot_order.pop(0)
-
-    # 全員終了したらイベント終了
-    if len(game.slot_order) == 0:
-        game.is_slot_event_active = False
-        # 全員の結果をまとめる
-        all_res = "\n".join(game.slot_results.values())
-        result_msg += f"\n全員スロット終了！結果まとめ：\n{all_res}"
-
-    return jsonify({'message': result_msg})
+    # 回すのはslot_orderの先頭のプレイヤー。誰の番かはサーバーで管理する
+    action = {'type': 'spin_slot', 'slot_index': data.get('slot_index', -1)}
+    return _perform(_request_game_id(), action)
 
 @app.route('/maze_progress', methods=['GET', 'POST'])
 def maze_progress():
-    global game
-    if game is None:
-        return jsonify({'message': 'ゲームが開始されていません。'}), 400
-
-    player = game.players[game.current_player_index]
-
-    if not player.is_in_maze or not player.maze:
-        return jsonify({'message': '迷路イベント中ではありません。'}), 400
-
-    if request.method == 'GET':
-        # 現在の選択肢を取得して返す
-        choices = player.maze.get_current_choices()
-        choices_info = []
-        for idx, choice in enumerate(choices):
-            choices_info.append({
-                'index': idx,
-                'description': choice['description'],
-                'probability': choice['probability']
-            })
-        message = f"{player.name}は現在「{player.maze.current_node}」にいます。次に進む道を選んでください。"
-        return jsonify({'message': message, 'choices': choices_info})
-    else:
+    game_id = _request_game_id()
+    if request.method == 'POST':
         # プレイヤーの選択を処理
         data = request.get_json()
-        choice_index = int(data.get('choice_index', -1))
-        result_message = player.maze.make_choice(choice_index)
-
-        # 迷路が終了したか確認
-        if player.maze.is_finished:
-            player.is_in_maze = False
-            if player.maze.is_success:
-                player.position += player.maze.reward_steps
-                result_message += f"\n{player.name}は迷路を突破し、{player.maze.reward_steps}マス進みました！"
+        action = {'type': 'maze_choice', 'choice_index': data.get('choice_index', -1)}
+        return _perform(game_id, action)
+
+    # 現在の選択肢を取得して返す
+    with registry.session(game_id) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        try:
+            return jsonify(actions.maze_choices(game))
+        except ActionError as error:
+            return jsonify({'message': error.message}), error.status
+
+def _batch_step(game_id, game, action, steps, entries):
+    # 1つ適用するごとに版が進む(actions.play)。操作ごとの乱数はその版で決まるため
+    player_index = _acting_player(game, action)
+    version = game.version
+    # ジャーナルには履歴と同じ形の操作を書く
+    entry = actions.canonical_action(game, action)
+    result = _apply(game_id, game, entry)
+    steps.append(_step(game, action, player_index, result))
+    if journal is not None:
+        entries.append(journal.entry(game_id, game, entry, version, result['message']))
+    return result
+
+
+def _acting_player(game, action):
+    # 操作する人の席。スロットは回す順番の先頭の人
+    if action.get('type') == 'spin_slot' and game.slot_order:
+        return game.slot_order[0]
+    return game.current_player_index
+
+
+def _step(game, action, player_index, result):
+    # 応答のstepsに入れる1件分。操作の直後に呼ぶ
+    step = {'type': action.get('type'), 'player': player_index}
+    if step['type'] == 'roll_dice':
+        step['roll'] = game.last_roll
+    step.update(result)
+    return step
+
+
+def _auto_play(game_id, game, steps, entries, choose=None, limit=BATCH_MAX_ACTIONS):
+    """人の操作が必要になるか、ゲームが終わるか、上限に達するまで進め、止まった理由を返す。
+
+    コンピューターの席はaiが、それ以外の席はchoose(game, decision, seat)が操作を選ぶ。
+    chooseが無いかNoneを返せば、人の操作を待つ。
+    """
+    while len(steps) < limit:
+        decision, seat = actions.pending_decision(game)
+        if decision is None:
+            return 'game_over'
+        if game.players[seat].is_cpu:
+            action = ai.decide(game, decision, seat)
+            CPU_ACTIONS.inc(decision)
+        else:
+            action = choose(game, decision, seat) if choose is not None else None
+            if action is None:
+                return 'human_input'
+        _batch_step(game_id, game, action, steps, entries)
+    return 'max_actions'
+
+
+def _batch_policy(name):
+    # 方針は計算結果を持つものがあるので、名前ごとに1つ作って使い回す
+    policy = batch_policies.get(name)
+    if policy is None:
+        policy = batch_policies[name] = POLICIES[name]()
+    return policy
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """複数の操作をまとめて実行する。1つでも受け付けられなければ全部取り消す。
+
+    actions: 順に実行する操作の一覧。例: [{"type": "roll_dice"}, {"type": "spin_slot", "slot_index": 1}]
+    auto: 続けて自動で進める設定。players(席番号の一覧、省略時は全員)の番の間、
+          policyの方針で操作し、それ以外の人の番になったら止まる。trueなら既定の設定
+    """
+    data = request.get_json(silent=True) or {}
+    action_list = data.get('actions') or []
+    if not isinstance(action_list, list) or not all(isinstance(action, dict) for action in action_list):
+        return jsonify({'message': 'actionsには操作の一覧を指定してください。'}), 400
+    if len(action_list) > BATCH_MAX_ACTIONS:
+        return jsonify({'message': f"一度に実行できる操作は{BATCH_MAX_ACTIONS}件までです。"}), 400
+
+    auto = data.get('auto')
+    if auto is True:
+        auto = {}
+    elif auto is False:
+        auto = None
+    if auto is not None:
+        if not isinstance(auto, dict):
+            return jsonify({'message': 'autoには設定の辞書かtrueを指定してください。'}), 400
+        policy_name = auto.get('policy', 'random')
+        if policy_name not in POLICIES and policy_name != 'cpu':
+            return jsonify({'message': f"不明な方針です: {policy_name}"}), 400
+        try:
+            seats = None if auto.get('players') is None else {int(seat) for seat in auto['players']}
+            limit = min(int(auto.get('max_actions', BATCH_MAX_ACTIONS)), BATCH_MAX_ACTIONS)
+        except (TypeError, ValueError):
+            return jsonify({'message': 'playersとmax_actionsには数値を指定してください。'}), 400
+        # 方針の選択はゲームの乱数とは別にする。選んだ操作はそのまま記録されるので再現できる
+        rng = random.Random(auto['seed']) if auto.get('seed') is not None else random
+        if policy_name == 'cpu':
+            decide = ai.decide
+        else:
+            policy = _batch_policy(policy_name)
+
+            def decide(game, decision, seat):
+                return actions.policy_action(policy, game, decision, seat, rng)
+
+        def choose(game, decision, seat):
+            if seats is not None and seat not in seats:
+                return None
+            return decide(game, decision, seat)
+
+    game_id = _request_game_id()
+    with registry.session(game_id, write=True) as game:
+        if game is None:
+            return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+        start_version = game.version
+        saved = actions.checkpoint(game)
+        steps = []
+        entries = []
+        try:
+            for action in action_list:
+                _batch_step(game_id, game, action, steps, entries)
+            if auto is not None:
+                stopped = _auto_play(game_id, game, steps, entries, choose, limit)
             else:
-                player.position -= player.maze.penalty_steps
-                if player.position < 0:
-                    player.position = 0
-                result_message += f"\n{player.name}は迷路で迷い、{player.maze.penalty_steps}マス戻りました。"
-            player.maze = None
-
-        return jsonify({'message': result_message})
+                # 指定した操作の後も、コンピューターの番は進めておく
+                stopped = _auto_play(game_id, game, steps, entries, limit=len(steps) + BATCH_MAX_ACTIONS)
+                if stopped == 'human_input':
+                    stopped = 'done'
+        except ActionError as error:
+            actions.restore(game, saved)
+            return jsonify({'message': f"{len(steps) + 1}番目の操作を実行できませんでした: {error.message}",
+                            'failed_index': len(steps)}), error.status
+        except BaseException:
+            actions.restore(game, saved)
+            raise
+
+        decision, player_index = actions.pending_decision(game)
+        summary = {'stopped': stopped, 'pending': {'decision': decision, 'player': player_index}}
+        if not steps:
+            payload = _game_state(game, _request_since())
+            payload.update(summary, steps=[])
+            return jsonify(payload)
+        message = '\n'.join(step['message'] for step in steps)
+        payload = _publish(game_id, game, start_version, message)
+        if journal is not None:
+            journal.record_entries(game_id, game, entries)
+        # 各操作のメッセージはstepsに入っているので、応答には件数だけを書く
+        payload['message'] = f"{len(steps)}件の操作を実行しました。"
+        payload.update(summary, steps=steps)
+        return jsonify(payload)
+
+@app.route('/replay', methods=['POST'])
+def replay():
+    """シードと操作の一覧からゲームを最初から進め直す。
+
+    game_idを指定すると、そのゲームのシードと履歴で進め直し、今の状態と一致するか(matches)を返す。
+    指定しなければ、本文の設定(/start_gameと同じ)とseed、actionsの一覧で新しく進めるだけで、
+    ゲームは作らない。負荷試験などで同じ進行を何度でも再現するのに使う。
+    """
+    data = request.get_json(silent=True) or {}
+    game_id = data.get('game_id')
+    if game_id is not None:
+        with registry.session(game_id) as game:
+            if game is None:
+                return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+            players = [Player(player.name, player.character, is_cpu=player.is_cpu) for player in game.players]
+            settings = (players, game.board, Dice(dict(game.dice.probabilities)), game.max_turns, game.seed)
+            if game.history is None:
+                # 保存した状態から戻したゲームは、最初からの操作が分からない
+                return jsonify({'message': 'このゲームには操作の履歴が残っていないため、再現できません。'}), 400
+            history = list(game.history)
+            expected = _game_state(game)
+    else:
+        try:
+            players, board, max_turns, seed = _game_settings(data)
+        except ValueError as error:
+            return jsonify({'message': str(error)}), 400
+        if seed is None:
+            return jsonify({'message': 'seedを指定してください。'}), 400
+        history = data.get('actions', [])
+        if not isinstance(history, list) or not all(isinstance(action, dict) for action in history):
+            return jsonify({'message': 'actionsには操作の一覧を指定してください。'}), 400
+        if len(history) > BATCH_MAX_ACTIONS:
+            return jsonify({'message': f"一度に送れる操作は{BATCH_MAX_ACTIONS}件までです。"}), 400
+        settings = (players, board, Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy()), max_turns, seed)
+        expected = None
+
+    players, board, dice, max_turns, seed = settings
+    replayed = Game(players, board, dice, max_turns=max_turns, seed=seed)
+    replayed.start()
+    steps = []
+    for action in history:
+        player_index = _acting_player(replayed, action)
+        try:
+            result = actions.play(replayed, action)
+        except ActionError as error:
+            return jsonify({'message': f"{len(steps) + 1}番目の操作を実行できませんでした: {error.message}",
+                            'failed_index': len(steps)}), error.status
+        steps.append(_step(replayed, action, player_index, result))
+
+    payload = {'seed': seed, 'state': _game_state(replayed), 'steps': steps}
+    if expected is not None:
+        payload['matches'] = payload['state'] == expected
+    return jsonify(payload)
+
+@app.route('/events', methods=['GET'])
+def events():
+    # Server-Sent Eventsでゲームの更新を受け取る
+    game_id = request.args.get('game_id')
+    if registry.get(game_id) is None:
+        return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+    subscription = broadcaster.subscribe(game_id)
+    return Response(
+        stream(broadcaster, subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/spectate', methods=['GET'])
+def spectate():
+    # 観戦用の読み取り専用の配信。最初に状態全体(state)、以後は手番ごとの差分(update)が届く
+    game_id = request.args.get('game_id')
+    if registry.get(game_id) is None:
+        return jsonify({'message': NOT_STARTED_MESSAGE}), 400
+    subscription = spectators.subscribe(game_id)
+    return Response(
+        stream(spectators, subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/start_tournament', methods=['POST'])
+def start_tournament():
+    """トーナメントを始める。
+
+    entrants: 参加者の一覧。例: [{"name": "あなた", "kind": "human"}, {"name": "CPU1", "kind": "cpu"}]
+    format: bracket(勝ち抜き戦)かround_robin(総当たり戦)。table_sizeは1つの卓の人数
+    """
+    data = request.get_json(silent=True) or {}
+    entrant_list = data.get('entrants')
+    if not isinstance(entrant_list, list) or not all(isinstance(entrant, dict) for entrant in entrant_list):
+        return jsonify({'message': 'entrantsには参加者の一覧を指定してください。'}), 400
+    try:
+        table_size = int(data.get('table_size', 2))
+        max_turns = int(data.get('max_turns', 20))
+        seed = None if data.get('seed') is None else int(data['seed'])
+    except (TypeError, ValueError):
+        return jsonify({'message': 'table_size、max_turns、seedには数値を指定してください。'}), 400
+    entrants = [Entrant(str(entrant.get('name') or f"参加者{i+1}"), entrant.get('kind', 'cpu'),
+                        entrant.get('character', 'default.png'))
+                for i, entrant in enumerate(entrant_list)]
+    try:
+        tournament = Tournament(entrants, data.get('format', 'bracket'), table_size, max_turns,
+                                data.get('board', DEFAULT_BOARD_NAME), seed)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    tournaments.start(tournament)
+    return jsonify(tournament.to_dict())
+
+@app.route('/tournament', methods=['GET'])
+def tournament_status():
+    # 組み合わせ、各対戦の状況(人のいる対戦はgame_id)、順位表
+    tournament_id = request.args.get('tournament_id')
+    tournament = tournaments.get(tournament_id)
+    if tournament is None:
+        return jsonify({'message': 'トーナメントがありません。'}), 400
+    payload = tournament.to_dict()
+    return _conditional(payload, f"{tournament_id}.{payload['version']}")
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheusのテキスト形式で計測値を返す
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def metrics_profile():
+    if not profiler_allowed:
+        return jsonify({'message': 'プロファイラーは有効になっていません。'}), 403
+    if request.method == 'GET':
+        # 呼び出し経路ごとの回数(flamegraph.plで読める形式)
+        return Response(profiler.collapsed(), mimetype='text/plain')
+
+    data = request.get_json(silent=True) or {}
+    if data.get('reset'):
+        profiler.reset()
+    if 'enabled' in data:
+        if data['enabled']:
+            interval_ms = float(data.get('interval_ms', 10))
+            if interval_ms < 1:
+                return jsonify({'message': 'interval_msは1以上にしてください。'}), 400
+            profiler.start(interval_ms / 1000)
+        else:
+            profiler.stop()
+    return jsonify({'running': profiler.running, 'samples': profiler.samples,
+                    'interval_ms': profiler.interval * 1000 if profiler.interval else None})
 
 # エラーハンドラーの追加
 @app.errorhandler(404)
 def not_found_error(error):
     return jsonify({'message': 'Not Found'}), 404
 
+@app.errorhandler(VersionConflict)
+def version_conflict_error(error):
+    return jsonify({'message': '他の操作と競合しました。もう一度お試しください。'}), 409
+
 @app.errorhandler(500)
 def internal_error(error):
     return jsonify({'message': 'Internal Server Error'}), 500
@@ -0,0 +1,253 @@
+"""ASGIサーバーで動かすための入口。
+
+    uvicorn asgi:app
+
+ルートとゲームの処理はapp.pyのものをそのまま使う。/eventsと/spectateの配信だけはasyncioで直接扱い、
+待っている接続はスレッドを使わないので、1プロセスで数万の接続を保てる。
+それ以外のルートはFlaskのアプリをスレッドプールで呼ぶ。ゲームを変える操作(POST)は
+ゲームごとのasyncio.Lockで1つずつ流すので、同じゲームへの操作が重なってもスレッドが
+ロック待ちで埋まらない。
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import app as web
+from pubsub import astream
+
+# Flaskのアプリを呼ぶスレッドの数
+THREADS = int(os.environ.get('SUGOROKU_ASGI_THREADS', 32))
+# これより大きいリクエスト本文は受け付けない
+MAX_BODY = 1024 * 1024
+KEEPALIVE = 15
+
+
+class GameLocks:
+    """ゲームごとのasyncio.Lock。使っている間だけ持ち、誰も使わなくなれば捨てる。
+
+    イベントループのスレッドからだけ使う。
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, game_id):
+        entry = self._locks.get(game_id)
+        if entry is None:
+            entry = self._locks[game_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[game_id]
+
+
+def _environ(scope, body):
+    # ASGIのscopeからWSGIのenvironを作る
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """WSGIのアプリを呼び、(ステータス, ヘッダー, 本文) を返す。スレッドプールで動かす。"""
+    started = []
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+        return chunks.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+    status, headers = started
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    return int(status.split(' ', 1)[0]), headers, b''.join(chunks)
+
+
+def _game_id(scope, body):
+    # ロックに使うgame_id。クエリかJSONの本文から探す
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if 'game_id' in query:
+        return query['game_id'][0]
+    if body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if isinstance(data, dict) and isinstance(data.get('game_id'), str):
+            return data['game_id']
+    return None
+
+
+async def _read_body(receive):
+    # 本文をすべて読む。途中で切断されたらNone、大きすぎればValueError
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY:
+            raise ValueError(len(body))
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class SugorokuASGI:
+    def __init__(self, wsgi_app, broadcaster, registry, threads=THREADS, keepalive=KEEPALIVE, spectators=None):
+        self.wsgi_app = wsgi_app
+        # ルート → 配信元。/spectateは観戦者向けの配信
+        self.streams = {'/events': broadcaster}
+        if spectators is not None:
+            self.streams['/spectate'] = spectators
+        self.registry = registry
+        self.threads = threads
+        self.keepalive = keepalive
+        self.locks = GameLocks()
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] in self.streams and scope['method'] == 'GET':
+                await self._events(scope, receive, send, scope['path'])
+            else:
+                await self._wsgi(scope, receive, send)
+        else:
+            raise ValueError(f"対応していない接続の種類です: {scope['type']}")
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='sugoroku-asgi')
+        return self.executor
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown(wait=True)
+                    self.executor = None
+                web.tournaments.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _wsgi(self, scope, receive, send):
+        try:
+            body = await _read_body(receive)
+        except ValueError:
+            await _send_json(send, 413, {'message': 'リクエストが大きすぎます。'})
+            return
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, body)
+        game_id = _game_id(scope, body) if scope['method'] == 'POST' else None
+        if game_id is None:
+            status, headers, content = await loop.run_in_executor(
+                self._executor(), call_wsgi, self.wsgi_app, environ)
+        else:
+            async with self.locks.hold(game_id):
+                status, headers, content = await loop.run_in_executor(
+                    self._executor(), call_wsgi, self.wsgi_app, environ)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def _events(self, scope, receive, send, route):
+        # Server-Sent Eventsでゲームの更新を送る。待っている間はスレッドを使わない
+        broadcaster = self.streams[route]
+        game_id = _game_id(scope, b'')
+        if self.registry.get(game_id) is None:
+            web.REQUESTS.inc(route, 'GET', '400')
+            await _send_json(send, 400, {'message': web.NOT_STARTED_MESSAGE})
+            return
+        web.REQUESTS.inc(route, 'GET', '200')
+        loop = asyncio.get_running_loop()
+        if route == '/spectate':
+            # 最初に送る状態全体を作るときにゲームのロックを待つことがあるので、スレッドで登録する
+            subscription = await loop.run_in_executor(self._executor(), broadcaster.subscribe_async, game_id, loop)
+        else:
+            subscription = broadcaster.subscribe_async(game_id, loop)
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        disconnected.add_done_callback(lambda _: subscription.close())
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                    (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            async for frame in astream(broadcaster, subscription, self.keepalive):
+                # 観戦者向けの配信はバイト列にしてある
+                if isinstance(frame, str):
+                    frame = frame.encode('utf-8')
+                await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            broadcaster.unsubscribe(subscription)
+
+
+app = SugorokuASGI(web.app, web.broadcaster, web.registry, spectators=web.spectators)
@@ -0,0 +1,101 @@
+"""ベンチマークをまとめて実行し、結果をJSONで保存する。
+
+--baselineに以前の結果を渡すと、時間が閾値より悪くなった項目を表示して終了コード1で終わる。
+
+    python -m benchmarks --output bench.json
+    python -m benchmarks --output new.json --baseline bench.json --threshold 0.15
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+from benchmarks import bench_fanout, bench_load, bench_micro, bench_snapshot
+
+
+def collect(args):
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+    }
+    if 'micro' in args.suites:
+        results['micro'] = bench_micro.run(args.repeat, args.min_time)
+    if 'snapshot' in args.suites:
+        game = bench_snapshot.build_game()
+        results['snapshot'] = {name: bench_snapshot.bench_codec(codec, game)
+                               for name, codec in (('snapshot', bench_snapshot.snapshot),
+                                                   ('json', bench_snapshot.serialization))}
+    if 'load' in args.suites:
+        results['load'] = bench_load.run(args.games, args.concurrency, args.players, args.turns)
+    if 'fanout' in args.suites:
+        results['fanout'] = bench_fanout.run(args.viewers)
+    return results
+
+
+def timings(results):
+    """比べる値(小さいほど良い)を (名前, 値) で返す。"""
+    for name, result in results.get('micro', {}).items():
+        yield f"micro.{name}.ns_per_op", result['ns_per_op']
+    for name, result in results.get('snapshot', {}).items():
+        yield f"snapshot.{name}.encode_us", result['encode_us']
+        yield f"snapshot.{name}.decode_us", result['decode_us']
+    for route, result in results.get('load', {}).get('routes', {}).items():
+        yield f"load.{route}.p50_us", result['p50_us']
+        yield f"load.{route}.p95_us", result['p95_us']
+    if 'fanout' in results:
+        yield 'fanout.us_per_delivery', results['fanout']['us_per_delivery']
+
+
+def compare(results, baseline, threshold):
+    """baselineよりthresholdの割合を超えて遅くなった項目を返す。"""
+    previous = dict(timings(baseline))
+    regressions = []
+    for name, value in timings(results):
+        before = previous.get(name)
+        if before and value > before * (1 + threshold):
+            regressions.append({'name': name, 'baseline': before, 'current': value, 'ratio': value / before})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマークをまとめて実行する')
+    parser.add_argument('--suites', nargs='+', default=['micro', 'snapshot', 'load'],
+                        choices=['micro', 'snapshot', 'load', 'fanout'])
+    parser.add_argument('--output', help='結果を書き込むJSONファイル(省略時は標準出力)')
+    parser.add_argument('--baseline', help='比べる以前の結果のJSONファイル')
+    parser.add_argument('--threshold', type=float, default=0.1, help='遅くなったとみなす割合')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--viewers', type=int, default=5000)
+    args = parser.parse_args()
+
+    results = collect(args)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            results['regressions'] = compare(results, json.load(f), args.threshold)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    for regression in results.get('regressions', ()):
+        print(f"遅くなりました: {regression['name']} {regression['baseline']:.1f} -> "
+              f"{regression['current']:.1f} ({regression['ratio']:.2f}倍)", file=sys.stderr)
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""観戦者への配信(pubsub.FanOut)の速さを測る。
+
+asyncioの購読者をviewers人つなぎ、updates回の更新を配り終えるまでの時間から、
+1人に1回届けるのにかかった時間を出す。同時に、配信の最中にpublishを呼んだ側が
+待たされた時間(操作したリクエストの遅れに当たる)も測る。
+
+    python -m benchmarks.bench_fanout --viewers 10000 --updates 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from pubsub import FanOut, astream
+
+
+async def _viewer(fan, subscription, received):
+    async for frame in astream(fan, subscription, 15):
+        received[0] += 1
+
+
+async def _run(viewers, updates):
+    fan = FanOut(lambda game_id: {'version': 0, 'players': []})
+    loop = asyncio.get_running_loop()
+    subscriptions = [fan.subscribe_async('bench', loop) for _ in range(viewers)]
+    received = [0]
+    tasks = [asyncio.ensure_future(_viewer(fan, s, received)) for s in subscriptions]
+    # 最初の状態全体と接続時の1行を受け取り終えるまで待つ
+    while received[0] < viewers * 2:
+        await asyncio.sleep(0.001)
+
+    publish_times = []
+    started = time.perf_counter()
+    for version in range(1, updates + 1):
+        payload = {'version': version, 'since': version - 1,
+                   'players': [{'index': 0, 'position': version}], 'message': 'プレイヤー1は3マス進んだ！'}
+        before = time.perf_counter()
+        fan.publish('bench', 'update', payload, version)
+        publish_times.append(time.perf_counter() - before)
+        await asyncio.sleep(0)
+    expected = viewers * (updates + 2)
+    while received[0] < expected:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+
+    for subscription in subscriptions:
+        subscription.close()
+    await asyncio.gather(*tasks)
+    fan.stop()
+    deliveries = viewers * updates
+    publish_times.sort()
+    return {
+        'viewers': viewers,
+        'updates': updates,
+        'elapsed_s': elapsed,
+        'deliveries_per_s': deliveries / elapsed,
+        'us_per_delivery': elapsed / deliveries * 1e6,
+        'publish_max_us': publish_times[-1] * 1e6,
+    }
+
+
+def run(viewers=5000, updates=20):
+    return asyncio.run(_run(viewers, updates))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='観戦者への配信の速さ')
+    parser.add_argument('--viewers', type=int, default=5000)
+    parser.add_argument('--updates', type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.viewers, args.updates), indent=2))
+
+
+if __name__ == '__main__':
+    main()
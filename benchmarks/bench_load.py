@@ -0,0 +1,166 @@
+"""app.test_client()でゲームを最初から最後まで遊ぶ負荷生成器。
+
+ブラウザと同じ順にエンドポイントを呼び、スロット・迷路・モンティ・ホールの流れも通す。
+--concurrencyの数だけスレッドを立て、それぞれが自分のクライアントでゲームを続けて遊ぶ。
+ルートごとの応答時間の分位点と、全体の処理量をJSONで出す。
+
+    python -m benchmarks.bench_load --games 200 --concurrency 8
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+
+class LoadClient:
+    """1スレッド分のクライアント。呼び出しごとに応答時間を記録する。"""
+
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        self.latencies = {}
+        self.errors = {}
+        self.requests = 0
+
+    def call(self, method, route, game_id, **data):
+        started = time.perf_counter()
+        if method == 'GET':
+            response = self.client.get(f'{route}?game_id={game_id}')
+        else:
+            response = self.client.post(route, json=dict(data, game_id=game_id))
+        self.latencies.setdefault(route, []).append(time.perf_counter() - started)
+        self.requests += 1
+        if response.status_code >= 500:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    def play(self, num_players, max_turns, max_requests=20000):
+        """1ゲームを終わるまで遊び、操作の種類ごとの回数を返す。"""
+        rng = self.rng
+        started = time.perf_counter()
+        response = self.client.post('/start_game', json={'num_players': num_players, 'max_turns': max_turns})
+        self.latencies.setdefault('/start_game', []).append(time.perf_counter() - started)
+        game_id = response.get_json()['game_id']
+        flows = {}
+        for _ in range(max_requests):
+            state = self.call('GET', '/get_game_state', game_id).get_json()
+            if state['is_over']:
+                return flows
+            player = state['players'][state['current_player_index']]
+            if player['is_in_monty_hall']:
+                flow = 'monty_hall'
+                self.call('POST', '/monty_hall_choice', game_id, choice=rng.randint(1, 3))
+                self.call('POST', '/monty_hall_choice', game_id, change=rng.choice(['はい', 'いいえ']))
+            elif player['is_in_maze']:
+                flow = 'maze'
+                while True:
+                    choices = self.call('GET', '/maze_progress', game_id)
+                    if choices.status_code != 200:
+                        break
+                    count = len(choices.get_json()['choices'])
+                    self.call('POST', '/maze_progress', game_id, choice_index=rng.randrange(count))
+            elif player['needs_dice_selection']:
+                flow = 'dice_selection'
+                self.call('POST', '/select_dice', game_id, dice_index=rng.randrange(5))
+            elif state['is_slot_event_active']:
+                flow = 'slot'
+                self.call('POST', '/spin_slot', game_id, slot_index=rng.randrange(3))
+            else:
+                flow = 'roll'
+                self.call('POST', '/roll_dice', game_id)
+            flows[flow] = flows.get(flow, 0) + 1
+        raise RuntimeError(f"{max_requests}回のリクエストでゲームが終わりませんでした。")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(games=100, concurrency=4, num_players=4, max_turns=20, seed=0):
+    import app as web
+
+    remaining = [games]
+    lock = threading.Lock()
+    clients = [LoadClient(web.app.test_client(), random.Random(f"{seed}:{i}")) for i in range(concurrency)]
+    flows = {}
+    failures = []
+
+    def worker(load_client):
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                played = load_client.play(num_players, max_turns)
+            except Exception as error:
+                with lock:
+                    failures.append(repr(error))
+                continue
+            with lock:
+                for flow, count in played.items():
+                    flows[flow] = flows.get(flow, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for load_client in clients:
+        for route, latencies in load_client.latencies.items():
+            routes.setdefault(route, []).extend(latencies)
+    errors = {}
+    for load_client in clients:
+        for route, count in load_client.errors.items():
+            errors[route] = errors.get(route, 0) + count
+    requests = sum(len(latencies) for latencies in routes.values())
+
+    route_stats = {}
+    for route, latencies in sorted(routes.items()):
+        latencies.sort()
+        route_stats[route] = {
+            'count': len(latencies),
+            'mean_us': sum(latencies) / len(latencies) * 1e6,
+            'p50_us': percentile(latencies, 0.5) * 1e6,
+            'p95_us': percentile(latencies, 0.95) * 1e6,
+            'p99_us': percentile(latencies, 0.99) * 1e6,
+            'max_us': latencies[-1] * 1e6,
+        }
+    return {
+        'games': games - len(failures),
+        'failed_games': failures[:10],
+        'concurrency': concurrency,
+        'players': num_players,
+        'max_turns': max_turns,
+        'elapsed_s': elapsed,
+        'requests': requests,
+        'requests_per_s': requests / elapsed if elapsed else None,
+        'games_per_s': (games - len(failures)) / elapsed if elapsed else None,
+        'server_errors': errors,
+        'flows': dict(sorted(flows.items())),
+        'routes': route_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ゲームを通しで遊ぶ負荷生成器')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.games, args.concurrency, args.players, args.turns, args.seed),
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
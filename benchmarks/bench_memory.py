@@ -0,0 +1,57 @@
+"""部屋(ゲーム)1つあたりのメモリ使用量を測る。
+
+/start_gameと同じ手順でゲームを作ってレジストリに入れ、数ターン進めた状態で
+tracemallocの増分を部屋の数で割る。
+
+    python -m benchmarks.bench_memory --rooms 2000
+"""
+import argparse
+import random
+import tracemalloc
+
+from game_logic import Dice, Game, Player, PREDEFINED_DICE_OPTIONS, build_default_board
+from rooms import GameRegistry
+
+
+def new_game(num_players, rng):
+    players = [Player(f"プレイヤー{i+1}", 'default.png') for i in range(num_players)]
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    game = Game(players, build_default_board(), dice, rng=rng)
+    game.start()
+    return game
+
+
+def measure(label, build, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build() for _ in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{label:10s} {used / count:9.0f} bytes")
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description='部屋あたりのメモリ使用量')
+    parser.add_argument('--rooms', type=int, default=2000)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=8)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    measure('board', build_default_board, args.rooms)
+    measure('player', lambda: Player('プレイヤー1'), args.rooms * args.players)
+
+    def room():
+        game = new_game(args.players, rng)
+        # 迷路やモンティ・ホールの途中の人がいる状態にする
+        for _ in range(args.turns * args.players):
+            game.next_turn()
+        registry.create(game)
+
+    registry = GameRegistry(max_rooms=args.rooms * 2)
+    measure('room', room, args.rooms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""よく通る処理のマイクロベンチマーク。
+
+サイコロ、スロット、手番の進行、マスのイベント検索、ゲーム状態のJSON化、/analysisの表引きを
+それぞれ繰り返し測り、1回あたりの時間(ナノ秒)をJSONで出す。
+
+    python -m benchmarks.bench_micro --repeat 7
+"""
+import argparse
+import json
+import random
+import timeit
+
+from game_logic import (
+    Dice, Game, Player, PREDEFINED_DICE_OPTIONS, SLOT_OPTIONS, build_default_board, spin_slot
+)
+
+
+def new_game(num_players=4, rng=None):
+    players = [Player(f"プレイヤー{i+1}", 'default.png') for i in range(num_players)]
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    game = Game(players, build_default_board(), dice, max_turns=10 ** 9, rng=rng)
+    game.start()
+    return game
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """functionを十分な回数まとめて呼び、1回あたりの時間を返す。"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    # autorangeは0.2秒以上になる回数を選ぶので、min_timeに合わせて増やす
+    number = max(1, int(number * min_time / 0.2))
+    times = sorted(t / number * 1e9 for t in timer.repeat(repeat=repeat, number=number))
+    return {'ns_per_op': times[len(times) // 2], 'min_ns': times[0], 'number': number, 'repeat': repeat}
+
+
+def benchmarks(seed=0):
+    """名前と測る関数の組を返す。状態を持つものはここで用意する。"""
+    rng = random.Random(seed)
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    board = build_default_board()
+    positions = [rng.randrange(board.size) for _ in range(1024)]
+
+    game = new_game(rng=rng)
+
+    def next_turn():
+        # 迷路やモンティ・ホールに入ったままでも手番は進むので、通常の進行だけを測れる
+        if game.is_slot_event_active:
+            game.is_slot_event_active = False
+            game.slot_order = []
+        game.next_turn()
+
+    def event_lookup():
+        event_at = board.event_at
+        for position in positions:
+            event_at(position)
+
+    # 状態のJSON化はappの関数をそのまま使う
+    import app as web
+    state_game = new_game(rng=rng)
+    for _ in range(12):
+        state_game.next_turn()
+    state_game.commit_changes()
+    registry_id = web.registry.create(state_game)
+    client = web.app.test_client()
+
+    def game_state_json():
+        json.dumps(web._game_state(state_game), ensure_ascii=False)
+
+    def game_state_encoder():
+        web.json_encoder(web._game_state(state_game))
+
+    def game_state_request():
+        client.get(f'/get_game_state?game_id={registry_id}')
+
+    import analysis
+
+    return [
+        ('dice_roll', lambda: dice.roll(rng)),
+        ('dice_roll_many_1000', lambda: dice.roll_many(1000, rng)),
+        ('spin_slot', lambda: spin_slot(len(SLOT_OPTIONS) - 1, rng)),
+        ('game_next_turn', next_turn),
+        ('board_event_at_1024', event_lookup),
+        ('game_state_json', game_state_json),
+        ('game_state_encoder', game_state_encoder),
+        ('dice_options_request', lambda: client.get('/get_dice_options')),
+        ('get_game_state_request', game_state_request),
+        ('analysis_lookup', lambda: analysis.analyze_player(state_game, 0, 5)),
+    ]
+
+
+def run(repeat=5, min_time=0.2, only=None, seed=0):
+    results = {}
+    for name, function in benchmarks(seed):
+        if only and name not in only:
+            continue
+        results[name] = measure(function, repeat, min_time)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='よく通る処理のマイクロベンチマーク')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='1回の計測にかける最低秒数')
+    parser.add_argument('--only', nargs='*', help='測るベンチマークの名前')
+    args = parser.parse_args()
+    print(json.dumps(run(args.repeat, args.min_time, args.only), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""スナップショット形式とJSON形式の大きさ・速度を比べる。
+
+    python -m benchmarks.bench_snapshot
+"""
+import random
+import timeit
+
+import actions
+import serialization
+import snapshot
+from game_logic import Dice, Game, Player, PREDEFINED_DICE_OPTIONS, build_default_board
+from policies import POLICIES
+
+
+def build_game(num_players=4, turns=10, seed=0):
+    # 4人・40マスのゲームを、サーバーと同じくactions.playでturnsターン目まで進めた状態を作る
+    players = [Player(f"プレイヤー{i+1}", f"avatar{i+1}.png") for i in range(num_players)]
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    # シードはサーバーが決めるもの(game_logic.new_seed)と同じ16文字にそろえる
+    game = Game(players, build_default_board(), dice, seed=f"{seed:016x}")
+    game.start()
+    policy = POLICIES['random']()
+    rng = random.Random(seed)
+    while game.current_turn <= turns:
+        decision, player_index = actions.pending_decision(game)
+        if decision is None:
+            break
+        actions.play(game, actions.policy_action(policy, game, decision, player_index, rng))
+    return game
+
+
+def bench_codec(codec, game, number=2000):
+    blob = codec.dumps(game)
+    encode = timeit.timeit(lambda: codec.dumps(game), number=number) / number
+    decode = timeit.timeit(lambda: codec.loads(blob), number=number) / number
+    return {'bytes': len(blob), 'encode_us': encode * 1e6, 'decode_us': decode * 1e6}
+
+
+def main():
+    game = build_game()
+    for name, codec in (('snapshot', snapshot), ('json', serialization)):
+        result = bench_codec(codec, game)
+        print(f"{name:9s} {result['bytes']:6d} bytes  "
+              f"encode {result['encode_us']:8.1f} us  decode {result['decode_us']:8.1f} us")
+
+
+if __name__ == '__main__':
+    main()
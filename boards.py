@@ -0,0 +1,210 @@
+"""盤面の雛形。
+
+盤面はconfig/boards/<名前>.jsonから起動時に一度だけ読み込み、値を確かめて
+変更できないBoardTemplateにしておく。ゲームを作るときは雛形をそのまま参照するので、
+ゲームごとに盤面を組み立て直したり複製したりしない。イベントは状態を持たないので共有してよい。
+
+    {
+      "format": 1,
+      "version": 1,
+      "title": "標準の40マス",
+      "size": 40,
+      "columns": 10,
+      "events": [
+        {"position": 3, "kind": "slot_machine"},
+        {"position": 5, "kind": "forward", "steps": 2},
+        {"position": 12, "kind": "maze", "maze": "forest"},
+        ...
+      ]
+    }
+
+kindはgame_logic.EVENT_FACTORIESの名前。forwardとbackwardはsteps、mazeは省略できるmaze
+(mazes/の迷路の名前)を取る。columnsは画面で1行に並べるマスの数。
+"""
+import os
+import re
+from types import MappingProxyType
+
+from config import CONFIG_DIR, ConfigError, load_config
+from game_logic import EVENT_FACTORIES, Board, BoardIndex, make_event
+from markov import board_key
+
+DEFAULT_BOARD_NAME = 'default'
+BOARD_DIR = os.path.join(CONFIG_DIR, 'boards')
+# 雛形でない盤面(保存データから戻した、今の設定に無い盤面など)を画面に並べるときの列数
+DEFAULT_COLUMNS = 10
+# 盤面の大きさの上限。索引やシミュレーターは1万マスまでの盤面を想定している。
+# コンピューターの判断に使う表は起動時に雛形ごとに作る(1万マスで数秒。ai.table_rolls)
+MAX_BOARD_SIZE = int(os.environ.get('SUGOROKU_MAX_BOARD_SIZE', 10000))
+_BOARD_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+# 引数を取るイベントと、設定ファイルでの引数の名前
+_ARGUMENTS = {'forward': 'steps', 'backward': 'steps', 'maze': 'maze'}
+
+
+class BoardTemplate(Board):
+    """変更できない盤面。"""
+
+    __slots__ = ('name', 'version', 'title', 'columns', 'cache_key', '_frozen')
+
+    def __init__(self, name, version, title, size, columns, events):
+        super().__init__(size)
+        for position, event in events.items():
+            super().add_event(position, event)
+        self.name = name
+        self.version = version
+        self.title = title
+        self.columns = columns
+        self.events = MappingProxyType(self.events)
+        # 索引も先に作っておく
+        self._index = BoardIndex(self.events)
+        # 計算結果のキャッシュに使うキー(markov.board_key)も先に求めておく
+        self.cache_key = board_key(self)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('盤面の雛形は変更できません。')
+        super().__setattr__(name, value)
+
+    def add_event(self, position, event):
+        raise AttributeError('盤面の雛形は変更できません。')
+
+    # 変更できないので、複製せずに同じものを共有すればよい
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"BoardTemplate({self.name!r}, version={self.version}, size={self.size})"
+
+
+def _positive_int(value, where):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ConfigError(f"{where}には1以上の整数を指定してください。")
+    return value
+
+
+def compile_board(name, data):
+    """設定の辞書を確かめ、BoardTemplateにする。"""
+    where = f"盤面「{name}」"
+    size = _positive_int(data.get('size'), f"{where}のsize")
+    if not 2 <= size <= MAX_BOARD_SIZE:
+        raise ConfigError(f"{where}のsizeは2以上{MAX_BOARD_SIZE}以下にしてください。")
+    columns = _positive_int(data.get('columns', min(size, DEFAULT_COLUMNS)), f"{where}のcolumns")
+    events = {}
+    for spec in data.get('events', []):
+        if not isinstance(spec, dict):
+            raise ConfigError(f"{where}のeventsの書き方が正しくありません。")
+        position = spec.get('position')
+        if not isinstance(position, int) or isinstance(position, bool) or not 0 <= position < size:
+            raise ConfigError(f"{where}のイベントの位置{position}が盤面の外です。")
+        if position in events:
+            raise ConfigError(f"{where}のマス{position}にイベントが2つあります。")
+        kind = spec.get('kind')
+        if kind not in EVENT_FACTORIES:
+            raise ConfigError(f"{where}のマス{position}のイベント{kind}は使えません。")
+        argument = None
+        key = _ARGUMENTS.get(kind)
+        if key == 'steps':
+            argument = _positive_int(spec.get('steps'), f"{where}のマス{position}のsteps")
+        elif key is not None and spec.get(key) is not None:
+            argument = spec[key]
+            if not isinstance(argument, str):
+                raise ConfigError(f"{where}のマス{position}の{key}には名前を文字列で指定してください。")
+        try:
+            events[position] = make_event(kind, argument)
+        except (TypeError, ValueError) as error:
+            raise ConfigError(f"{where}のマス{position}: {error}") from None
+    return BoardTemplate(name, data['version'], str(data.get('title', name)), size, columns, events)
+
+
+def load_boards(directory=BOARD_DIR):
+    """ディレクトリ内の盤面をすべて読み込み、名前 → 雛形 の辞書で返す。"""
+    templates = {}
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        if not _BOARD_NAME.match(name):
+            raise ConfigError(f"盤面の名前が不正です: {name}")
+        templates[name] = compile_board(name, load_config(filename, directory))
+    if DEFAULT_BOARD_NAME not in templates:
+        raise ConfigError(f"{directory}に標準の盤面{DEFAULT_BOARD_NAME}.jsonがありません。")
+    return templates
+
+
+def board_signature(board):
+    # 盤面の中身を表すタプル。同じ中身の盤面を雛形に置き換えるのに使う
+    return (board.size, tuple((position, board.events[position].kind, board.events[position].argument())
+                              for position in board.index.positions))
+
+
+TEMPLATES = load_boards()
+_by_signature = {board_signature(template): template for template in TEMPLATES.values()}
+
+
+def board_template(name=DEFAULT_BOARD_NAME):
+    """名前から盤面の雛形を返す。無ければValueError。"""
+    template = TEMPLATES.get(name) if isinstance(name, str) else None
+    if template is None:
+        raise ValueError(f"盤面「{name}」はありません。")
+    return template
+
+
+def intern_board(board):
+    """保存データから戻した盤面を、中身が同じ雛形に置き換える。同じものが無ければそのまま返す。"""
+    if isinstance(board, BoardTemplate):
+        return board
+    return _by_signature.get(board_signature(board), board)
+
+
+def board_layout(board):
+    """画面に並べるための大きさ。"""
+    return {'size': board.size, 'columns': getattr(board, 'columns', min(board.size, DEFAULT_COLUMNS))}
+
+
+# マスに表示する短い記号
+EVENT_GLYPHS = {
+    'dice_selection': '選',
+    'maze': '迷',
+    'monty_hall': '扉',
+    'slot_machine': '★',
+}
+
+
+def event_glyph(event):
+    if event.kind == 'forward':
+        return f"+{event.steps}"
+    if event.kind == 'backward':
+        return f"-{event.steps}"
+    return EVENT_GLYPHS.get(event.kind, '?')
+
+
+def render_layout(board):
+    """クライアントが盤面を描くのに必要なものをまとめる。
+
+    マスは1行にcolumns個ずつ、行ごとに向きを変えて(蛇行して)並べる。
+    cellsはマスの番号順の [列, 行]。
+    """
+    layout = board_layout(board)
+    columns = layout['columns']
+    cells = []
+    for position in range(board.size):
+        row, column = divmod(position, columns)
+        if row % 2 == 1:
+            column = columns - 1 - column
+        cells.append([column, row])
+    events = [{'position': position, 'kind': board.events[position].kind, 'name': board.events[position].name,
+               'glyph': event_glyph(board.events[position])}
+              for position in board.index.positions]
+    layout.update(rows=-(-board.size // columns), cells=cells, events=events)
+    return layout
+
+
+def board_catalogue():
+    # /get_boardsで返す一覧
+    return [dict(board_layout(template), name=name, title=template.title, version=template.version,
+                 events=len(template.events))
+            for name, template in TEMPLATES.items()]
@@ -0,0 +1,89 @@
+"""サイコロとスロットの一覧を設定ファイルから読み込む。
+
+設定はconfig/に置く(SUGOROKU_CONFIG_DIRで別の場所を指定できる)。どのファイルも
+"format" に形式の版、"version" に内容の版を持つ。読み込むときに値を確かめ、
+おかしな設定ならConfigErrorで起動を止める。
+
+    config/dice.json    {"format": 1, "version": 1, "predefined": [...], "mystery": [...]}
+    config/slots.json   {"format": 1, "version": 1, "slots": [...]}
+    config/boards/*.json 盤面(boards.pyで読む)
+
+サイコロの確率はJSONのキーが文字列になるので、読み込むときに目を整数に戻す。
+"""
+import json
+import math
+import os
+
+CONFIG_DIR = os.environ.get(
+    'SUGOROKU_CONFIG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config'))
+# このコードが読める設定ファイルの形式の版
+CONFIG_FORMAT = 1
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def load_config(name, directory=None):
+    """設定ファイルを読み、形式の版を確かめて返す。"""
+    path = os.path.join(directory or CONFIG_DIR, name)
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as error:
+        raise ConfigError(f"設定ファイル{path}を読めません: {error}") from None
+    if not isinstance(data, dict) or data.get('format') != CONFIG_FORMAT:
+        raise ConfigError(f"設定ファイル{path}の形式の版が{CONFIG_FORMAT}ではありません。")
+    if not isinstance(data.get('version'), int):
+        raise ConfigError(f"設定ファイル{path}にversionがありません。")
+    return data
+
+
+def _check_total(total, where):
+    if not math.isclose(total, 1.0, abs_tol=1e-6):
+        raise ConfigError(f"{where}の確率の合計が1になっていません: {total}")
+
+
+def _dice_option(option, where):
+    try:
+        probabilities = {int(face): float(prob) for face, prob in option['probabilities'].items()}
+        result = {'name': str(option['name']), 'probabilities': probabilities,
+                  'description': str(option.get('description', ''))}
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise ConfigError(f"{where}の書き方が正しくありません。") from None
+    if not probabilities or any(face < 1 or prob < 0 for face, prob in probabilities.items()):
+        raise ConfigError(f"{where}の目は1以上、確率は0以上にしてください。")
+    _check_total(sum(probabilities.values()), where)
+    return result
+
+
+def load_dice_options(directory=None):
+    """(公開するサイコロの一覧, 確率を伏せるサイコロの一覧) を返す。"""
+    data = load_config('dice.json', directory)
+    predefined = [_dice_option(option, f"dice.jsonのpredefined[{i}]")
+                  for i, option in enumerate(data.get('predefined', []))]
+    mystery = [_dice_option(option, f"dice.jsonのmystery[{i}]")
+               for i, option in enumerate(data.get('mystery', []))]
+    if not predefined:
+        raise ConfigError('dice.jsonのpredefinedに少なくとも1つのサイコロが必要です(最初のものをゲームで使います)。')
+    return predefined, mystery
+
+
+def load_slot_options(directory=None):
+    data = load_config('slots.json', directory)
+    slots = []
+    for i, slot in enumerate(data.get('slots', [])):
+        where = f"slots.jsonのslots[{i}]"
+        try:
+            results = [{'name': str(res['name']), 'steps': int(res['steps']), 'prob': float(res['prob'])}
+                       for res in slot['results']]
+            slots.append({'name': str(slot['name']), 'description': str(slot.get('description', '')),
+                          'results': results})
+        except (KeyError, TypeError, ValueError):
+            raise ConfigError(f"{where}の書き方が正しくありません。") from None
+        if not results or any(res['prob'] < 0 for res in results):
+            raise ConfigError(f"{where}には確率が0以上の結果が必要です。")
+        _check_total(sum(res['prob'] for res in results), where)
+    if not slots:
+        raise ConfigError('slots.jsonに少なくとも1つのスロットが必要です。')
+    return slots
@@ -1,98 +1,153 @@
+import enum
 import random
+import secrets
+import time
+
+from config import load_dice_options, load_slot_options
+from maze import DEFAULT_MAZE_NAME, maze_graph
+from sampling import alias_table
+
+# スロットとサイコロの一覧はconfig/の設定ファイルから読み込む
+SLOT_OPTIONS = load_slot_options()
+# PREDEFINED_DICE_OPTIONSは確率を公開するサイコロ、MYSTERY_DICE_OPTIONSは確率を伏せるサイコロ。
+# ゲーム共通のサイコロにはPREDEFINED_DICE_OPTIONSの最初のものを使う
+PREDEFINED_DICE_OPTIONS, MYSTERY_DICE_OPTIONS = load_dice_options()
+
+# サイコロ選択イベントで選べるサイコロ。/select_diceのdice_indexはこの並びの番号
+DICE_CATALOGUE = PREDEFINED_DICE_OPTIONS + MYSTERY_DICE_OPTIONS
+# /start_gameで指定できるシードの長さの上限
+MAX_SEED_LENGTH = 64
+# /start_gameと/start_tournamentで指定できるターン数の上限
+MAX_TURNS = 1000
+
+
+def new_seed():
+    # ゲームのシード。64ビット分の16進の文字列
+    return secrets.token_hex(8)
+
+
+def action_rng(seed, version):
+    # 操作ごとの乱数。シードと操作前の版だけで決まるので、プロセスや他のゲームの影響を受けない
+    return random.Random(f"{seed}:{version}")
+
+class PlayerState(enum.IntFlag):
+    # プレイヤーが抱えている、解決待ちのイベント
+    NONE = 0
+    NEEDS_DICE_SELECTION = 0x01
+    IN_MONTY_HALL = 0x02
+    IN_MAZE = 0x04
+
+
+def _state_flag(flag):
+    # PlayerStateの1ビットを、従来どおりの真偽値の属性として読み書きする
+    def get(self):
+        return bool(self.state & flag)
+
+    def set(self, value):
+        if value:
+            self.state |= flag
+        else:
+            self.state &= ~flag
+
+    return property(get, set)
+
+
+class MontyHallState:
+    __slots__ = ('prize_door', 'player_choice', 'opened_door')
+
+    def __init__(self, prize_door, player_choice=None, opened_door=None):
+        self.prize_door = prize_door
+        self.player_choice = player_choice
+        self.opened_door = opened_door
+
+    def to_dict(self):
+        return {'prize_door': self.prize_door, 'player_choice': self.player_choice,
+                'opened_door': self.opened_door}
 
-SLOT_OPTIONS = [
-    {
-        'name': 'スロットA',
-        'description': '大当たり率は低いが、当たれば+5マス！ ハズレもそこそこ。',
-        'results': [
-            {'name': '大当たり', 'steps': 5, 'prob': 0.1},
-            {'name': '中当たり', 'steps': 2, 'prob': 0.3},
-            {'name': 'ハズレ', 'steps': -2, 'prob': 0.6}
-        ]
-    },
-    {
-        'name': 'スロットB',
-        'description': '無難なスロット。大当たりは出にくいが、ハズレも少ない。',
-        'results': [
-            {'name': '大当たり', 'steps': 3, 'prob': 0.15},
-            {'name': '中当たり', 'steps': 2, 'prob': 0.5},
-            {'name': 'ハズレ', 'steps': -1, 'prob': 0.35}
-        ]
-    },
-    {
-        'name': 'スロットC',
-        'description': '低リスク低リターン。ほぼ中当たりで安定している。',
-        'results': [
-            {'name': '大当たり', 'steps': 4, 'prob': 0.05},
-            {'name': '中当たり', 'steps': 2, 'prob': 0.9},
-            {'name': 'ハズレ', 'steps': -1, 'prob': 0.05}
-        ]
-    }
-]
-
-# プリセットされたサイコロオプションを定義
-PREDEFINED_DICE_OPTIONS = [
-    {
-        'name': '標準のサイコロ',
-        'probabilities': {1: 1/6, 2: 1/6, 3: 1/6, 4: 1/6, 5: 1/6, 6: 1/6},
-        'description': '各目が均等に出るサイコロです。'
-    },
-    # 他のサイコロオプションを追加できます
-    
-]
-MYSTERY_DICE_OPTIONS = [
-    {
-        'name': '謎のサイコロA',
-        'probabilities': {1: 0.05, 2: 0.05, 3: 0.2, 4: 0.2, 5: 0.3, 6: 0.2},
-        'description': '内部的に偏ったサイコロ。詳細は非公開。'
-    },
-    {
-        'name': '謎のサイコロB',
-        'probabilities': {1: 0.4, 2: 0.2, 3: 0.15, 4: 0.1, 5: 0.1, 6: 0.05},
-        'description': '内部的に偏ったサイコロ。詳細は非公開。'
-    }
-]
 
 class Player:
-    def __init__(self, name, character='default.png'):
+    __slots__ = ('name', 'position', 'character', 'dice', 'state', 'monty_hall_state', 'maze',
+                 'total_distance', 'is_cpu')
+
+    def __init__(self, name, character='default.png', is_cpu=False):
         self.name = name
         self.position = 0
         self.character = character
         self.dice = None  # プレイヤー専用のサイコロ
-        self.needs_dice_selection = False  # サイコロ選択が必要か
-        self.is_in_monty_hall = False
-        self.monty_hall_state = {}
-        self.is_in_maze = False
+        self.state = PlayerState.NONE
+        # モンティ・ホールの途中のときだけMontyHallStateを持つ
+        self.monty_hall_state = None
         self.maze = None
         # 累計移動距離を管理する新しい属性を追加
         self.total_distance = 0
+        # サーバー(ai.py)が操作するコンピューターのプレイヤーか
+        self.is_cpu = is_cpu
+
+    needs_dice_selection = _state_flag(PlayerState.NEEDS_DICE_SELECTION)  # サイコロ選択が必要か
+    is_in_monty_hall = _state_flag(PlayerState.IN_MONTY_HALL)
+    is_in_maze = _state_flag(PlayerState.IN_MAZE)
 
 class Dice:
+    __slots__ = ('_probabilities', '_sampler')
+
     def __init__(self, probabilities):
         self.probabilities = probabilities  # {1: 0.2, 2: 0.15, ...}
 
-    def roll(self):
-        faces = list(self.probabilities.keys())
-        probs = list(self.probabilities.values())
-        return random.choices(faces, probs)[0]
+    @property
+    def probabilities(self):
+        return self._probabilities
+
+    @probabilities.setter
+    def probabilities(self, probabilities):
+        # 確率を差し替えたら抽選表を作り直す
+        self._probabilities = probabilities
+        self._sampler = None
+
+    def invalidate(self):
+        # probabilitiesの辞書をその場で書き換えた場合に呼ぶ
+        self._sampler = None
+
+    @property
+    def sampler(self):
+        if self._sampler is None:
+            self._sampler = alias_table(tuple(self._probabilities.items()))
+        return self._sampler
+
+    def roll(self, rng=random):
+        return self.sampler.sample(rng)
+
+    def roll_many(self, count, rng=random):
+        return self.sampler.sample_many(count, rng)
 
 class Cell:
+    __slots__ = ('position', 'event')
+
     def __init__(self, position, event=None):
         self.position = position
         self.event = event
 
 class Event:
+    # 保存・復元時にイベントを再生成するための種類名
+    kind = None
+
     def __init__(self, name, description, effect):
         self.name = name
         self.description = description
         self.effect = effect  # イベントの効果を持つ関数
 
+    def argument(self):
+        # make_eventで同じイベントを作り直すための引数。引数の無いイベントはNone
+        return getattr(self, 'steps', None)
+
 def forward_event_factory(steps):
     def effect(player, game):
         player.position += steps
         message = f"{player.name}は{steps}マス進んだ！"
         return message
-    return Event(f"{steps}マス進む", f"プレイヤーが{steps}マス進みます。", effect)
+    event = Event(f"{steps}マス進む", f"プレイヤーが{steps}マス進みます。", effect)
+    event.kind = 'forward'
+    event.steps = steps
+    return event
 
 def backward_event_factory(steps):
     def effect(player, game):
@@ -104,10 +159,15 @@ def backward_event_factory(steps):
             # ループ対応: positionをboard.sizeでmod
             player.position = player.position % game.board.size
         return f"{player.name}は{steps}マス戻った！"
-    return Event(f"{steps}マス戻る", f"プレイヤーが{steps}マス戻ります。", effect)
+    event = Event(f"{steps}マス戻る", f"プレイヤーが{steps}マス戻ります。", effect)
+    event.kind = 'backward'
+    event.steps = steps
+    return event
 
 
 class DiceSelectionEvent(Event):
+    kind = 'dice_selection'
+
     def __init__(self):
         super().__init__(
             name="サイコロ選択",
@@ -121,57 +181,60 @@ class DiceSelectionEvent(Event):
         return message
 
 class ProbabilityMazeEvent(Event):
-    def __init__(self):
+    kind = 'maze'
+
+    def __init__(self, maze=DEFAULT_MAZE_NAME):
         super().__init__(
             name="確率の迷路",
             description="確率的な迷路に挑戦します。",
             effect=self.start_maze
         )
+        # 迷路の構造は同じ定義のイベントすべてで共有する
+        self.graph = maze_graph(maze)
+
+    @property
+    def reward_steps(self):
+        return self.graph.reward_steps
+
+    @property
+    def penalty_steps(self):
+        return self.graph.penalty_steps
+
+    def argument(self):
+        if self.graph.name == DEFAULT_MAZE_NAME:
+            return None
+        return self.graph.name
 
     def start_maze(self, player, game):
-        maze = ProbabilityMaze()
+        maze = ProbabilityMaze(self.graph)
         player.is_in_maze = True
         player.maze = maze
         message = f"{player.name}は確率の迷路に挑戦します！"
         return message
 
 class ProbabilityMaze:
-    def __init__(self):
-        # 迷路の構造を定義します。各ノードで次に進める道とその確率、説明を持ちます。
-        self.maze_structure = {
-            'start': [
-                {'to': 'A', 'probability': 0.5, 'description': '広い道が続いている。'},
-                {'to': 'B', 'probability': 0.5, 'description': '薄暗い小道が見える。'}
-            ],
-            'A': [
-                {'to': 'C', 'probability': 0.7, 'description': '鳥のさえずりが聞こえる道。'},
-                {'to': 'D', 'probability': 0.3, 'description': '風が強い道。'}
-            ],
-            'B': [
-                {'to': 'D', 'probability': 0.6, 'description': '湿った土の道。'},
-                {'to': 'E', 'probability': 0.4, 'description': '花の香りが漂う道。'}
-            ],
-            'C': [
-                {'to': 'goal', 'probability': 1.0, 'description': '光が差し込む出口が見える。'}
-            ],
-            'D': [
-                {'to': 'fail', 'probability': 1.0, 'description': '行き止まりだ。'}
-            ],
-            'E': [
-                {'to': 'goal', 'probability': 0.5, 'description': '静かな道。'},
-                {'to': 'fail', 'probability': 0.5, 'description': '怪しい音が聞こえる道。'}
-            ],
-        }
-        self.current_node = 'start'
+    """迷路を進んでいるプレイヤーの現在地。迷路の構造(graph)は共有し、ここには持たない。"""
+
+    __slots__ = ('graph', 'current_node', 'is_success', 'is_finished', 'path_taken')
+
+    def __init__(self, graph=None):
+        self.graph = graph or maze_graph()
+        self.current_node = self.graph.start
         self.is_success = False
         self.is_finished = False
-        self.reward_steps = 5  # 成功時の報酬を増やす
-        self.penalty_steps = 2  # 失敗時のペナルティを設定
         self.path_taken = []
 
+    @property
+    def reward_steps(self):
+        return self.graph.reward_steps
+
+    @property
+    def penalty_steps(self):
+        return self.graph.penalty_steps
+
     def get_current_choices(self):
         # 現在のノードから進める選択肢を返します
-        return self.maze_structure.get(self.current_node, [])
+        return self.graph.choices(self.current_node)
 
     def make_choice(self, choice_index):
         # プレイヤーの選択に基づいて次のノードに進みます
@@ -179,10 +242,10 @@ class ProbabilityMaze:
         if choice_index < 0 or choice_index >= len(choices):
             return "無効な選択肢です。"
         choice = choices[choice_index]
-        self.current_node = choice['to']
+        self.current_node = choice.to
         self.path_taken.append(self.current_node)
 
-        message = f"あなたは「{choice['description']}」を選びました。\n"
+        message = f"あなたは「{choice.description}」を選びました。\n"
         if self.current_node == 'goal':
             self.is_success = True
             self.is_finished = True
@@ -196,6 +259,8 @@ class ProbabilityMaze:
         return message
 
 class MontyHallEvent(Event):
+    kind = 'monty_hall'
+
     def __init__(self):
         super().__init__(
             name="モンティ・ホールの挑戦",
@@ -207,15 +272,13 @@ class MontyHallEvent(Event):
 
     def start_monty_hall(self, player, game):
         player.is_in_monty_hall = True
-        player.monty_hall_state = {
-            'prize_door': random.randint(1, 3),
-            'player_choice': None,
-            'opened_door': None
-        }
+        player.monty_hall_state = MontyHallState(game.rng.randint(1, 3))
         message = f"{player.name}はモンティ・ホールの挑戦に挑みます。1〜3の扉から1つを選んでください。"
         return message
 
 class SlotMachineEvent(Event):
+    kind = 'slot_machine'
+
     def __init__(self):
         super().__init__(
             name="全員参加スロットイベント",
@@ -244,17 +307,91 @@ class SlotMachineEvent(Event):
         game.slot_results = {}
         return f"{player.name}がイベントを発生させた！全員が順番にスロットを回します。"
 
+# 種類名からイベントを生成する関数の一覧。引数を持つイベント(マス数や迷路の名前)は引数を1つ受け取る
+EVENT_FACTORIES = {
+    'forward': forward_event_factory,
+    'backward': backward_event_factory,
+    'dice_selection': DiceSelectionEvent,
+    'maze': ProbabilityMazeEvent,
+    'monty_hall': MontyHallEvent,
+    'slot_machine': SlotMachineEvent,
+}
+
+
+def make_event(kind, argument=None):
+    factory = EVENT_FACTORIES[kind]
+    if argument is None:
+        return factory()
+    return factory(argument)
+
+
+class BoardIndex:
+    # イベントの検索用にBoardから一度だけ作る索引。ボードを変更すると作り直される
+    def __init__(self, events):
+        self.positions = sorted(events)
+        self.positions_by_kind = {}
+        self.descriptions = {}
+        for position in self.positions:
+            event = events[position]
+            self.positions_by_kind.setdefault(event.kind, []).append(position)
+            self.descriptions.setdefault(event.name, event.description)
+        # APIでそのまま返す一覧もここで作っておく
+        self.event_positions = [
+            {'position': position, 'event_name': events[position].name, 'kind': events[position].kind}
+            for position in self.positions
+        ]
+        self.event_descriptions = [
+            {'name': name, 'description': description}
+            for name, description in self.descriptions.items()
+        ]
+
+
 class Board:
+    __slots__ = ('size', 'events', '_index')
+
     def __init__(self, size):
         self.size = size
-        self.cells = [Cell(i) for i in range(size)]
+        # イベントのあるマスだけを持つ 位置 → イベント の辞書。マスごとのオブジェクトは持たない
+        self.events = {}
+        self._index = None
+
+    @property
+    def cells(self):
+        # 全マスのCellが必要なときだけ作る
+        return [Cell(i, self.events.get(i)) for i in range(self.size)]
 
     def add_event(self, position, event):
         if 0 <= position < self.size:
-            self.cells[position].event = event
+            self.events[position] = event
+            self._index = None
+
+    def event_at(self, position):
+        return self.events.get(position)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = BoardIndex(self.events)
+        return self._index
+
+    def positions_of(self, kind):
+        return self.index.positions_by_kind.get(kind, [])
+
+# クライアントに公開している状態の項目。版ごとの差分はこの単位で追跡する
+GAME_STATE_FIELDS = ('current_player_index', 'is_over', 'is_slot_event_active')
+PLAYER_STATE_FIELDS = ('name', 'position', 'character', 'is_in_monty_hall', 'is_in_maze', 'needs_dice_selection',
+                       'is_cpu')
+
+def build_default_board():
+    # 標準の盤面(config/boards/default.json)。変更できない雛形を全員で共有する
+    from boards import board_template
+    return board_template()
 
 class Game:
-    def __init__(self, players, board, dice, max_turns=20):
+    # 計測用。設定すると、発生したイベントと効果の処理にかかった秒数で呼ばれる
+    event_observer = None
+
+    def __init__(self, players, board, dice, max_turns=20, rng=None, seed=None):
         self.players = players
         self.board = board
         self.dice = dice
@@ -262,6 +399,23 @@ class Game:
         self.is_over = False
         self.max_turns = max_turns
         self.current_turn = 1
+        # ゲームのシード。actions.playは操作ごとの乱数を (シード, 操作前の版) から作る
+        self.seed = seed if seed is not None else new_seed()
+        # サイコロやイベントの抽選に使う乱数。actions.playを通さずに進める場合(シミュレーションなど)は
+        # random.Randomを渡して使う
+        self.rng = rng if rng is not None else random.Random(self.seed)
+        # actions.playで行った操作の一覧。シードと合わせればゲームを最初から再現できる。
+        # スナップショットには入れないので、スナップショットから戻したゲームではNone(分からない)
+        self.history = []
+        # 直前の手番で出た目と発生したイベント(記録・集計用)
+        self.last_roll = None
+        self.last_event = None
+
+        # 操作のたびに1ずつ増える状態の版
+        self.version = 0
+        # 前回commit_changesした時点の公開状態と、各項目が最後に変わった版
+        self._observed = None
+        self._field_versions = None
 
         ### 変更開始：スロットイベント管理用フラグ ###
         self.is_slot_event_active = False
@@ -278,17 +432,19 @@ class Game:
         self.slot_order = []
         self.slot_trigger_player_index = None
         self.slot_results = {}
+        self.history = []
 
         for player in self.players:
             player.position = 0
             player.dice = None
-            player.needs_dice_selection = False
-            player.is_in_monty_hall = False
-            player.monty_hall_state = {}
-            player.is_in_maze = False
+            player.state = PlayerState.NONE
+            player.monty_hall_state = None
             player.maze = None
             player.total_distance = 0
 
+        # 開始時点の状態を差分の基準にする
+        self.commit_changes()
+
     def next_turn(self):
         # スロットイベント中はサイコロを振れないようにするなどの対策が必要
         # しかしここではユーザーがイベントを起こした後にroll_diceするケースを避けるため、
@@ -298,7 +454,8 @@ class Game:
 
         player = self.players[self.current_player_index]
         dice = player.dice if player.dice else self.dice
-        roll = dice.roll()
+        roll = dice.roll(self.rng)
+        self.last_roll = roll
 
         player.total_distance += roll
         player.position += roll
@@ -306,9 +463,16 @@ class Game:
 
         message = f"{player.name}はサイコロで{roll}が出た！"
 
-        current_cell = self.board.cells[player.position]
-        if current_cell.event:
-            event_message = current_cell.event.effect(player, self)
+        event = self.board.event_at(player.position)
+        self.last_event = event
+        if event:
+            observer = type(self).event_observer
+            if observer is None:
+                event_message = event.effect(player, self)
+            else:
+                started = time.perf_counter()
+                event_message = event.effect(player, self)
+                observer(event, time.perf_counter() - started)
             message += f"\nイベント発生！{event_message}"
 
         # プレイヤー交代処理
@@ -323,16 +487,83 @@ class Game:
 
         return message
 
+    def action_rng(self):
+        # 次の操作で使う乱数
+        return action_rng(self.seed, self.version)
+
+    def commit_changes(self):
+        # 操作が1つ終わるごとに呼ぶ。版を1つ進め、前回から変わった公開項目にその版を記録する
+        self.version += 1
+        observed = self._observe()
+        if self._observed is None or len(self._observed) != len(observed):
+            self._field_versions = [[self.version] * len(row) for row in observed]
+        else:
+            for versions, old_row, new_row in zip(self._field_versions, self._observed, observed):
+                for i, (old, new) in enumerate(zip(old_row, new_row)):
+                    if old != new:
+                        versions[i] = self.version
+        self._observed = observed
+        return self.version
+
+    def changes_since(self, since=None):
+        # since の版より後に変わった項目だけを (ゲームの項目, プレイヤーごとの項目) で返す
+        # sinceが無い、または差分を追跡していない場合はすべての項目を返す
+        observed = self._observe()
+        if since is None or self._observed is None or observed != self._observed:
+            versions = [[self.version] * len(row) for row in observed]
+            since = -1
+        else:
+            versions = self._field_versions
+        game_fields = {
+            field: value
+            for field, value, version in zip(GAME_STATE_FIELDS, observed[0], versions[0])
+            if version > since
+        }
+        players = []
+        for index, (row, row_versions) in enumerate(zip(observed[1:], versions[1:])):
+            changed = {
+                field: value
+                for field, value, version in zip(PLAYER_STATE_FIELDS, row, row_versions)
+                if version > since
+            }
+            if changed:
+                changed['index'] = index
+                players.append(changed)
+        return game_fields, players
+
+    def _observe(self):
+        # 先頭がゲーム全体の項目、続いてプレイヤーごとの項目
+        rows = [tuple(getattr(self, field) for field in GAME_STATE_FIELDS)]
+        for player in self.players:
+            rows.append(tuple(getattr(player, field) for field in PLAYER_STATE_FIELDS))
+        return rows
+
+
+# スロットごとの抽選表。(結果のリスト, 抽選表) を持ち、リストが差し替えられたら作り直す
+_slot_samplers = {}
+
+
+def slot_sampler(slot_index):
+    results = SLOT_OPTIONS[slot_index]['results']
+    cached = _slot_samplers.get(slot_index)
+    if cached is None or cached[0] is not results:
+        table = alias_table(tuple((i, res['prob']) for i, res in enumerate(results)))
+        cached = (results, table)
+        _slot_samplers[slot_index] = cached
+    return cached[1]
+
 
-def spin_slot(slot_index):
+def invalidate_slot_samplers():
+    # SLOT_OPTIONSの確率をその場で書き換えた場合に呼ぶ
+    _slot_samplers.clear()
+
+
+def spin_slot(slot_index, rng=random):
     # SLOT_OPTIONS[slot_index]から確率に応じて結果を決める
-    option = SLOT_OPTIONS[slot_index]
-    results = option['results']
-    # 累積確率で抽選
-    r = random.random()
-    cum = 0
-    for res in results:
-        cum += res['prob']
-        if r <= cum:
-            return res
-    return results[-1] 
\ No newline at end of file
+    results = SLOT_OPTIONS[slot_index]['results']
+    return results[slot_sampler(slot_index).sample(rng)]
+
+
+def spin_slot_many(slot_index, count, rng=random):
+    results = SLOT_OPTIONS[slot_index]['results']
+    return [results[i] for i in slot_sampler(slot_index).sample_many(count, rng)] 
\ No newline at end of file
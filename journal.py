@@ -0,0 +1,222 @@
+"""ゲームの操作を追記していくジャーナル。ワーカーが再起動しても進行中のゲームを復元できる。
+
+ディレクトリの中に journal-000001.log のような区切り(セグメント)ごとのファイルを作り、
+1行1レコードのJSONを追記する。
+
+    {"t": "snap", "g": ゲームID, "v": 版, "s": スナップショット(base64)}
+    {"t": "act",  "g": ゲームID, "v": 操作前の版, "a": 操作, "roll": 出目, "event": イベント, "m": メッセージ}
+    {"t": "end",  "g": ゲームID}
+    {"t": "ckpt"}
+
+操作の乱数はactions.playが (ゲームのシード, 操作前の版) から毎回作り直すので、スナップショットから
+操作を順に適用し直せば同じ状態になる。シードはスナップショットに含まれる。
+"roll" などは記録として残すだけで復元には使わない。
+
+書き込みは1レコードごとにOSへ渡し、fsyncはまとめて一定間隔で行う。
+ゲームごとにsnapshot_every回の操作でスナップショットを書くので、復元時に適用し直す
+操作は1ゲームあたり高々その回数。セグメントがsegment_bytesを超えたら、生きている
+ゲームの最新スナップショットと以降の操作だけを新しいセグメントに書き、古いものは消す。
+
+1つのディレクトリを使えるのは1プロセスだけ(ロックファイルで確認する)。
+"""
+import base64
+import fcntl
+import json
+import os
+import threading
+
+import actions
+import snapshot
+
+
+class JournalError(RuntimeError):
+    pass
+
+
+class GameJournal:
+    def __init__(self, directory, fsync_interval=0.05, snapshot_every=64, segment_bytes=16 * 1024 * 1024,
+                 codec=snapshot):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.segment_bytes = segment_bytes
+        self.codec = codec
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock_file = open(os.path.join(directory, 'journal.lock'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise JournalError(f"ジャーナル {directory} は他のプロセスが使用中です。")
+
+        self._lock = threading.Lock()
+        # ゲームごとの、最新のスナップショット以降のレコード(セグメントの切り替え用)
+        self._tails = {}
+        self._file = None
+        self._segment = 0
+        self._size = 0
+        self._dirty = False
+        self._closed = threading.Event()
+        self._flusher = None
+
+    # --- 復元 ---
+
+    def _segments(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('journal-') and name.endswith('.log'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def recover(self):
+        """ジャーナルからゲームを作り直し、(ゲームID, Game) の一覧を返す。
+
+        復元後は新しいセグメントに切り替えるので、以後の追記は復元した状態に続く。
+        """
+        segments = self._segments()
+        records = {}
+        for path in segments:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 書きかけで落ちた最後の行は捨てる
+                        continue
+                    kind = record.get('t')
+                    if kind == 'snap':
+                        records[record['g']] = [record]
+                    elif kind == 'act' and record['g'] in records:
+                        records[record['g']].append(record)
+                    elif kind == 'end':
+                        records.pop(record['g'], None)
+
+        games = []
+        for game_id, game_records in records.items():
+            snap = game_records[0]
+            game = self.codec.loads(base64.b64decode(snap['s']))
+            for record in game_records[1:]:
+                if record['v'] != game.version:
+                    continue
+                self.replay(game, record['a'])
+            games.append((game_id, game))
+
+        with self._lock:
+            self._open_segment(len(segments) and int(os.path.basename(segments[-1])[8:-4]))
+            for game_id, game in games:
+                self._write_snapshot(game_id, game)
+            self._write({'t': 'ckpt'})
+            self._sync()
+        for path in segments:
+            os.remove(path)
+        self._start_flusher()
+        return games
+
+    def replay(self, game, action):
+        actions.play(game, action)
+
+    # --- 書き込み ---
+
+    def _open_segment(self, previous):
+        if self._file is not None:
+            self._file.close()
+        self._segment = previous + 1
+        path = os.path.join(self.directory, f"journal-{self._segment:06d}.log")
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        self._file.write(line)
+        # プロセスが落ちてもOSに渡した分は残る。電源断に備えたfsyncはまとめて行う
+        self._file.flush()
+        self._size += len(line)
+        self._dirty = True
+        return line
+
+    def _write_snapshot(self, game_id, game):
+        blob = base64.b64encode(self.codec.dumps(game)).decode('ascii')
+        line = self._write({'t': 'snap', 'g': game_id, 'v': game.version, 's': blob})
+        self._tails[game_id] = [line]
+
+    def _sync(self):
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='journal-fsync', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            with self._lock:
+                self._sync()
+
+    def _rotate(self):
+        # 生きているゲームの最新スナップショット以降だけを新しいセグメントに写す
+        old = self._segments()
+        self._sync()
+        self._open_segment(self._segment)
+        for lines in self._tails.values():
+            for line in lines:
+                self._file.write(line)
+                self._size += len(line)
+        self._write({'t': 'ckpt'})
+        self._sync()
+        for path in old:
+            os.remove(path)
+
+    def start(self, game_id, game):
+        """新しいゲームを記録し、そのゲームのシードを返す。"""
+        with self._lock:
+            self._write_snapshot(game_id, game)
+        return game.seed
+
+    def entry(self, game_id, game, action, version, message=None):
+        """操作を適用した直後に呼び、記録する1件分を作る。出目などはこの時点のgameから取る。"""
+        record = {'t': 'act', 'g': game_id, 'v': version, 'a': action}
+        if action.get('type') == 'roll_dice':
+            record['roll'] = game.last_roll
+            record['event'] = game.last_event.kind if game.last_event is not None else None
+        if message is not None:
+            record['m'] = message
+        return record
+
+    def record(self, game_id, game, action, version, message=None):
+        """versionの状態に対してactionを適用したことを記録する。"""
+        self.record_entries(game_id, game, [self.entry(game_id, game, action, version, message)])
+
+    def record_entries(self, game_id, game, entries):
+        # まとめて適用した操作は、全部成功してからまとめて書く
+        with self._lock:
+            tail = self._tails.get(game_id)
+            if tail is None:
+                return
+            for record in entries:
+                tail.append(self._write(record))
+            if len(tail) > self.snapshot_every:
+                self._write_snapshot(game_id, game)
+            if self._size > self.segment_bytes:
+                self._rotate()
+
+    def end(self, game_id):
+        with self._lock:
+            if self._tails.pop(game_id, None) is None:
+                return
+            self._write({'t': 'end', 'g': game_id})
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+        self._lock_file.close()
+
+
+def open_journal(directory, **options):
+    # 既存のジャーナルから復元した (ゲームID, Game) の一覧も返す
+    journal = GameJournal(directory, **options)
+    return journal, journal.recover()
@@ -0,0 +1,387 @@
+"""盤面とサイコロからマルコフ連鎖を組み、結果の分布を抽選せずに計算する。
+
+1人の状態を (使用中のサイコロ, マス, 累計移動距離) とし、その同時分布を1手番ずつ進める。
+各ターンのマスの分布・止まったマスの頻度・累計移動距離の分布が正確に求まる。
+
+対話が必要なイベントは policies の方針が選ぶ確率で分岐させる。simulation.pyと同じく、
+止まった直後に解決したものとして扱う。
+他の人が起こすスロットイベントだけは人どうしの状態がからむので、
+各人の分布は独立とみなし、そのターンにスロットへ止まる確率で混ぜ合わせる。
+スロットの無い盤面や1人プレイでは厳密な値になる。
+
+NumPyが必要。
+"""
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from game_logic import DICE_CATALOGUE, PREDEFINED_DICE_OPTIONS, SLOT_OPTIONS, Dice
+from policies import RandomPolicy, maze_success_probability
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('マルコフ連鎖の計算にはNumPyが必要です: pip install numpy')
+
+
+def _normalize(weights):
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+def board_key(board):
+    # 盤面の設定を表すタプル。同じ設定なら同じ計算結果を使い回す
+    # 変更できない盤面(boards.BoardTemplate)は作ったときに求めた値を持っている
+    key = getattr(board, 'cache_key', None)
+    if key is not None:
+        return key
+    events = []
+    for position in board.index.positions:
+        event = board.events[position]
+        events.append((position, event.kind, event.argument(),
+                       getattr(event, 'reward_steps', None), getattr(event, 'penalty_steps', None)))
+    return (board.size, tuple(events))
+
+
+def dice_key(dice):
+    return tuple(sorted(dice.probabilities.items()))
+
+
+class LRUCache:
+    """使った順に古いものから捨てる、件数上限つきの辞書。複数のスレッドから使える。
+
+    pinで置いたもの(起動時に用意した表など)は件数に数えず、捨てない。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items) + len(self._pinned)
+
+    def get(self, key):
+        with self._lock:
+            value = self._pinned.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def pin(self, key, value):
+        with self._lock:
+            self._pinned[key] = value
+            self._items.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._pinned.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+class MarkovChain:
+    """1人分の (サイコロ, マス, 累計移動距離) の分布を1手番ずつ進める。
+
+    分布は [サイコロ, マス, 距離] の配列。サイコロ0はゲーム共通のサイコロ、
+    1以降はDICE_CATALOGUEの順。出目の分だけマスと距離を同時にずらした後、
+    イベントのあるマスの行だけを書き換える。
+    """
+
+    def __init__(self, board, dice, policy):
+        _require_numpy()
+        self.size = board.size
+        self.num_dice = len(DICE_CATALOGUE) + 1
+        self.dice_tables = []
+        for table in [dice.probabilities] + [option['probabilities'] for option in DICE_CATALOGUE]:
+            total = sum(table.values())
+            self.dice_tables.append([(face, prob / total) for face, prob in table.items()])
+        self.slot_cells = np.zeros(self.size)
+        for position in board.positions_of('slot_machine'):
+            self.slot_cells[position] = 1.0
+
+        # イベントのあるマスごとの分岐 [(行き先のマス, 新しいサイコロ, 距離の増減, 確率), ...]
+        self.branches = {}
+        for cell in board.index.positions:
+            self.branches[cell] = self._branches(board.events[cell], policy, cell)
+        self.event_cells = np.array(sorted(self.branches), dtype=np.int64)
+
+        # 他の人のスロットイベントで回すときの分布。同じ分布のマスはまとめて計算する
+        groups = {}
+        for cell in range(self.size):
+            spin = tuple(sorted(self._spin(policy, cell).items()))
+            groups.setdefault(spin, []).append(cell)
+        self.spin_groups = [(np.array(cells), spin) for spin, cells in groups.items()]
+
+        faces = [face for table in self.dice_tables for face, _ in table]
+        event_deltas = [0] + [delta for branches in self.branches.values() for _, _, delta, _ in branches]
+        spins = [steps for _, spin in self.spin_groups for steps, _ in spin]
+        self.turn_range = (min(faces) + min(event_deltas), max(faces) + max(event_deltas))
+        self.spin_range = (min(spins), max(spins))
+
+    def _spin(self, policy, position):
+        # スロットを1回回したときの {進んだ距離: 確率}
+        spin = {}
+        for weight, option in zip(_normalize(policy.slot_weights(position)), SLOT_OPTIONS):
+            for res in option['results']:
+                if weight > 0 and res['prob'] > 0:
+                    spin[res['steps']] = spin.get(res['steps'], 0.0) + weight * res['prob']
+        return spin
+
+    def _branches(self, event, policy, cell):
+        size = self.size
+        kind = event.kind
+        if kind == 'forward':
+            return [((cell + event.steps) % size, None, 0, 1.0)]
+        if kind == 'backward':
+            return [((cell - event.steps) % size, None, -event.steps, 1.0)]
+        if kind == 'dice_selection':
+            weights = _normalize(policy.dice_weights(cell))
+            return [(cell, i + 1, 0, w) for i, w in enumerate(weights) if w > 0]
+        if kind == 'maze':
+            success = maze_success_probability(policy, event.graph)
+            return [((cell + event.reward_steps) % size, None, 0, success),
+                    (max(cell - event.penalty_steps, 0), None, 0, 1.0 - success)]
+        if kind == 'monty_hall':
+            # 扉を変えれば2/3、変えなければ1/3で当たる
+            switch = policy.switch_probability(cell)
+            win = switch * 2 / 3 + (1 - switch) / 3
+            return [((cell + event.reward_steps) % size, None, 0, win),
+                    (max(cell - event.penalty_steps, 0), None, 0, 1.0 - win)]
+        if kind == 'slot_machine':
+            return [((cell + steps) % size, None, steps, prob)
+                    for steps, prob in self._spin(policy, cell).items()]
+        raise ValueError(f"マルコフ連鎖で扱えないイベントです: {event.name}")
+
+    def new_distribution(self, width, offset):
+        distribution = np.zeros((self.num_dice, self.size, width))
+        distribution[0, 0, offset] = 1.0
+        return distribution
+
+    def turn(self, distribution, window):
+        """自分の手番を1回進めた分布と、サイコロで止まったマスの確率を返す。"""
+        lo, hi = window
+        current = distribution[:, :, lo:hi]
+        landed = np.zeros_like(distribution)
+        for dice_state, table in enumerate(self.dice_tables):
+            rows = current[dice_state]
+            if not rows.any():
+                continue
+            for face, prob in table:
+                landed[dice_state, :, lo + face:hi + face] += prob * np.roll(rows, face, axis=0)
+        landing = landed.sum(axis=(0, 2))
+
+        # イベントのマスに止まった分を取り除いてから、行き先へ配り直す
+        result = landed.copy()
+        result[:, self.event_cells, :] = 0.0
+        for cell, branches in self.branches.items():
+            rows = landed[:, cell, :]
+            if not landing[cell]:
+                continue
+            for target, new_dice, delta, prob in branches:
+                if new_dice is None:
+                    shifted = result[:, target, :]
+                    source = rows
+                else:
+                    shifted = result[new_dice, target, :]
+                    source = rows.sum(axis=0)
+                if delta == 0:
+                    shifted += prob * source
+                elif delta > 0:
+                    shifted[..., delta:] += prob * source[..., :-delta]
+                else:
+                    shifted[..., :delta] += prob * source[..., -delta:]
+        return result, landing
+
+    def spin(self, distribution, window):
+        """スロットを1回回した後の分布を返す。"""
+        lo, hi = window
+        result = np.zeros_like(distribution)
+        for cells, spin in self.spin_groups:
+            if len(cells) == self.size:
+                # 全マスで同じ分布なら、マス方向は回転だけで済む
+                rows = distribution[:, :, lo:hi]
+                for steps, prob in spin:
+                    result[:, :, lo + steps:hi + steps] += prob * np.roll(rows, steps, axis=1)
+                continue
+            rows = distribution[:, cells, lo:hi]
+            for steps, prob in spin:
+                result[:, (cells + steps) % self.size, lo + steps:hi + steps] += prob * rows
+        return result
+
+
+class MarkovAnalysis:
+    """num_players人でmax_turnsターン遊んだときの分布。
+
+    landing[席, ターン, マス]: そのターンにサイコロで止まる確率
+    position[席, ターン, マス]: そのターンの手番の後にいるマスの確率
+    distance[席, 距離 + distance_offset]: 最終的な累計移動距離の確率
+    """
+
+    def __init__(self, chains, num_players, max_turns):
+        size = chains[0].size
+        # 累計移動距離が取りうる範囲。1ターンにつき自分の手番1回と他の人のスロット分
+        low = max_turns * (min(c.turn_range[0] for c in chains)
+                           + (num_players - 1) * min(0, min(c.spin_range[0] for c in chains)))
+        high = max_turns * (max(c.turn_range[1] for c in chains)
+                            + (num_players - 1) * max(0, max(c.spin_range[1] for c in chains)))
+        self.size = size
+        self.num_players = num_players
+        self.max_turns = max_turns
+        self.distance_offset = -min(low, 0)
+        width = self.distance_offset + high + 1
+
+        self.landing = np.zeros((num_players, max_turns, size))
+        self.position = np.zeros((num_players, max_turns, size))
+        distributions = [chain.new_distribution(width, self.distance_offset) for chain in chains]
+
+        # 分布に0でない値がある距離の範囲だけを計算する
+        support = [(self.distance_offset, self.distance_offset + 1)] * num_players
+        for turn in range(max_turns):
+            for seat in range(num_players):
+                chain = chains[seat]
+                lo, hi = support[seat]
+                distributions[seat], landing = chain.turn(distributions[seat], (lo, hi))
+                support[seat] = (lo + min(0, chain.turn_range[0]), hi + max(0, chain.turn_range[1]))
+                self.landing[seat, turn] = landing
+
+                # この人がスロットに止まったら、他の全員も1回ずつ回す
+                trigger = float(landing @ chain.slot_cells)
+                if trigger > 0:
+                    for other in range(num_players):
+                        if other == seat:
+                            continue
+                        other_chain = chains[other]
+                        lo, hi = support[other]
+                        spun = other_chain.spin(distributions[other], (lo, hi))
+                        spun -= distributions[other]
+                        spun *= trigger
+                        distributions[other] += spun
+                        support[other] = (lo + min(0, other_chain.spin_range[0]),
+                                          hi + max(0, other_chain.spin_range[1]))
+
+            for seat in range(num_players):
+                self.position[seat, turn] = distributions[seat].sum(axis=(0, 2))
+
+        self.distance = np.array([d.sum(axis=(0, 1)) for d in distributions])
+
+    def heatmap(self, seat=None):
+        # ゲーム全体でマスごとに止まる回数の期待値。seatを省略すると全員の合計
+        landing = self.landing if seat is None else self.landing[seat:seat + 1]
+        return landing.sum(axis=(0, 1))
+
+    def expected_distance(self):
+        values = np.arange(self.distance.shape[1]) - self.distance_offset
+        return self.distance @ values
+
+    def win_probabilities(self):
+        # 勝者は累計移動距離が最大の人。同点なら席の若い人(Game.next_turnのmaxと同じ)
+        cdf = np.cumsum(self.distance, axis=1)
+        below = cdf - self.distance
+        wins = []
+        for seat in range(self.num_players):
+            p = self.distance[seat].copy()
+            for other in range(self.num_players):
+                if other < seat:
+                    p *= below[other]
+                elif other > seat:
+                    p *= cdf[other]
+            wins.append(float(p.sum()))
+        return np.array(wins)
+
+    def distance_percentile(self, seat, q):
+        cdf = np.cumsum(self.distance[seat])
+        return int(np.searchsorted(cdf, q / 100 - 1e-12)) - self.distance_offset
+
+    def summary(self):
+        return {
+            'num_players': self.num_players,
+            'max_turns': self.max_turns,
+            'win_probability_by_seat': self.win_probabilities().tolist(),
+            'expected_total_distance_by_seat': self.expected_distance().tolist(),
+            'total_distance_percentiles_by_seat': [
+                {str(q): self.distance_percentile(seat, q) for q in (5, 25, 50, 75, 95)}
+                for seat in range(self.num_players)
+            ],
+            'landing_heatmap': self.heatmap().tolist(),
+            'final_position_by_seat': self.position[:, -1].tolist(),
+        }
+
+
+# 盤面・サイコロ・方針ごとの推移表と、人数・ターン数まで含めた計算結果
+_chains = LRUCache(maxsize=64)
+_analyses = LRUCache(maxsize=256)
+
+
+def chain_for(board, dice=None, policy=None):
+    dice = dice or Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'])
+    policy = policy or RandomPolicy()
+    key = (board_key(board), dice_key(dice), policy.key())
+    chain = _chains.get(key)
+    if chain is None:
+        chain = _chains.put(key, MarkovChain(board, dice, policy))
+    return chain
+
+
+def analyze(board, num_players=4, max_turns=20, policies=None, dice=None):
+    """盤面の分布を計算する。同じ設定の2回目以降は前回の結果をそのまま返す。
+
+    policiesが人数より少なければ順に繰り返して割り当てる。
+    """
+    policies = list(policies or [RandomPolicy()])
+    seat_policies = [policies[seat % len(policies)] for seat in range(num_players)]
+    dice = dice or Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'])
+    key = (board_key(board), dice_key(dice), tuple(p.key() for p in seat_policies),
+           num_players, max_turns)
+    analysis = _analyses.get(key)
+    if analysis is None:
+        chains = [chain_for(board, dice, policy) for policy in seat_policies]
+        analysis = _analyses.put(key, MarkovAnalysis(chains, num_players, max_turns))
+    return analysis
+
+
+def cache_info():
+    return {
+        'chains': _chains.info(),
+        'analyses': _analyses.info(),
+    }
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+
+    from game_logic import build_default_board
+    from policies import POLICIES
+
+    names = sys.argv[1:] or ['greedy']
+    result = analyze(build_default_board(), policies=[POLICIES[name]() for name in names])
+    print(json.dumps(result.summary(), ensure_ascii=False, indent=2))
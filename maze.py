@@ -0,0 +1,180 @@
+"""確率の迷路の構造。
+
+迷路の構造(MazeGraph)は定義ごとに1つだけ作って全員で共有し、変更できないようにしてある。
+各プレイヤーが持つのは game_logic.ProbabilityMaze の現在地と通った道だけ。
+
+標準の迷路以外は mazes/<名前>.json から読み込む。形式は次のとおり。
+
+    {
+      "reward_steps": 5,
+      "penalty_steps": 2,
+      "start": "start",
+      "nodes": {
+        "start": [{"to": "A", "probability": 0.5, "description": "広い道が続いている。"}, ...],
+        ...
+      }
+    }
+
+行き先の "goal" と "fail" は終点で、ノードとして定義しなくてよい。
+"""
+import json
+import os
+import re
+import sys
+import threading
+from types import MappingProxyType
+
+GOAL = sys.intern('goal')
+FAIL = sys.intern('fail')
+TERMINALS = (GOAL, FAIL)
+
+DEFAULT_MAZE_NAME = 'default'
+MAZE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mazes')
+_MAZE_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class _Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('迷路の構造は変更できません。')
+
+    def __delattr__(self, name):
+        raise AttributeError('迷路の構造は変更できません。')
+
+    # 変更できないので、複製せずに同じものを共有すればよい
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class MazeEdge(_Frozen):
+    """分かれ道の1本。"""
+
+    __slots__ = ('to', 'probability', 'description')
+
+    def __init__(self, to, probability, description):
+        object.__setattr__(self, 'to', to)
+        object.__setattr__(self, 'probability', probability)
+        object.__setattr__(self, 'description', description)
+
+    def __repr__(self):
+        return f"MazeEdge({self.to!r}, {self.probability!r})"
+
+
+class MazeGraph(_Frozen):
+    """迷路1つ分の構造。ノード名は sys.intern して全員で同じ文字列を指す。
+
+    nodesは終点を含むノード名の並びで、スナップショットではこの番号で保存する。
+    """
+
+    __slots__ = ('name', 'start', 'nodes', 'node_ids', 'edges', 'reward_steps', 'penalty_steps')
+
+    def __init__(self, name, nodes, start='start', reward_steps=5, penalty_steps=2):
+        start = sys.intern(start)
+        if start not in nodes:
+            raise ValueError(f"迷路「{name}」に開始ノード{start}がありません。")
+        names = [sys.intern(node) for node in nodes if node not in TERMINALS]
+        names = tuple(names) + TERMINALS
+        node_ids = {node: i for i, node in enumerate(names)}
+        edges = {}
+        for node, choices in nodes.items():
+            if node in TERMINALS:
+                raise ValueError(f"迷路「{name}」の終点{node}に道は作れません。")
+            node_edges = []
+            for choice in choices:
+                to = choice['to']
+                if to not in node_ids:
+                    raise ValueError(f"迷路「{name}」の{node}から、存在しないノード{to}へ道があります。")
+                node_edges.append(MazeEdge(names[node_ids[to]], float(choice.get('probability', 0.0)),
+                                           choice.get('description', '')))
+            edges[names[node_ids[node]]] = tuple(node_edges)
+
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'start', start)
+        object.__setattr__(self, 'nodes', names)
+        object.__setattr__(self, 'node_ids', MappingProxyType(node_ids))
+        object.__setattr__(self, 'edges', MappingProxyType(edges))
+        object.__setattr__(self, 'reward_steps', int(reward_steps))
+        object.__setattr__(self, 'penalty_steps', int(penalty_steps))
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, data['nodes'], data.get('start', 'start'),
+                   data.get('reward_steps', 5), data.get('penalty_steps', 2))
+
+    def choices(self, node):
+        return self.edges.get(node, ())
+
+    def intern(self, node):
+        # 保存データから戻したノード名を、共有している文字列に置き換える
+        try:
+            return self.nodes[self.node_ids[node]]
+        except KeyError:
+            raise ValueError(f"迷路「{self.name}」にノード{node}はありません。") from None
+
+    def __repr__(self):
+        return f"MazeGraph({self.name!r}, {len(self.nodes)} nodes)"
+
+
+# 標準の迷路。ノードの並びはスナップショット形式の版2までの番号と同じ
+DEFAULT_MAZE = MazeGraph(DEFAULT_MAZE_NAME, {
+    'start': [
+        {'to': 'A', 'probability': 0.5, 'description': '広い道が続いている。'},
+        {'to': 'B', 'probability': 0.5, 'description': '薄暗い小道が見える。'}
+    ],
+    'A': [
+        {'to': 'C', 'probability': 0.7, 'description': '鳥のさえずりが聞こえる道。'},
+        {'to': 'D', 'probability': 0.3, 'description': '風が強い道。'}
+    ],
+    'B': [
+        {'to': 'D', 'probability': 0.6, 'description': '湿った土の道。'},
+        {'to': 'E', 'probability': 0.4, 'description': '花の香りが漂う道。'}
+    ],
+    'C': [
+        {'to': 'goal', 'probability': 1.0, 'description': '光が差し込む出口が見える。'}
+    ],
+    'D': [
+        {'to': 'fail', 'probability': 1.0, 'description': '行き止まりだ。'}
+    ],
+    'E': [
+        {'to': 'goal', 'probability': 0.5, 'description': '静かな道。'},
+        {'to': 'fail', 'probability': 0.5, 'description': '怪しい音が聞こえる道。'}
+    ],
+}, reward_steps=5, penalty_steps=2)
+
+_graphs = {DEFAULT_MAZE_NAME: DEFAULT_MAZE}
+_lock = threading.Lock()
+
+
+def load_maze(path, name=None):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if name is None:
+        name = data.get('name') or os.path.splitext(os.path.basename(path))[0]
+    return MazeGraph.from_dict(name, data)
+
+
+def register_maze(graph):
+    with _lock:
+        _graphs[graph.name] = graph
+    return graph
+
+
+def maze_graph(name=DEFAULT_MAZE_NAME):
+    """名前から迷路を返す。初めて使う迷路はmazes/から読み込み、以後は同じものを返す。"""
+    graph = _graphs.get(name)
+    if graph is not None:
+        return graph
+    if not _MAZE_NAME.match(name):
+        raise ValueError(f"迷路の名前が不正です: {name}")
+    with _lock:
+        graph = _graphs.get(name)
+        if graph is None:
+            path = os.path.join(MAZE_DIR, f"{name}.json")
+            if not os.path.exists(path):
+                raise ValueError(f"迷路「{name}」が見つかりません。")
+            graph = _graphs[name] = load_maze(path, name)
+    return graph
@@ -0,0 +1,249 @@
+"""サーバーの計測値。/metrics からPrometheusのテキスト形式で返す。
+
+外部のライブラリは使わず、カウンター・ゲージ・ヒストグラムとサンプリング方式の
+プロファイラーだけを持つ。値はプロセスごとなので、複数ワーカーで動かす場合は
+ワーカーごとに集めることになる。
+"""
+import sys
+import threading
+from collections import Counter as _StackCounter
+
+# 応答時間のヒストグラムの区切り(秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# イベントの効果は迷路などを含めても短いので細かく区切る
+EVENT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in values]
+
+
+class Gauge(Metric):
+    """読み出すたびにfunctionを呼んで値を得るゲージ。"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, function):
+        super().__init__(name, help_text)
+        self.function = function
+
+    def samples(self):
+        return [f"{self.name} {_number(self.function())}"]
+
+
+class CallbackCounter(Metric):
+    """読み出すたびにfunctionを呼んで値を得るカウンター。functionは {ラベルの値のタプル: 値} を返す。
+
+    数を自分で数えているもの(キャッシュのヒット数など)をそのまま出すのに使う。
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames, function):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+                for labels, value in sorted(self.function().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # ラベルごとに [区切りごとの件数..., 区切りを超えた件数, 合計]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _labels(self.labelnames, labels, [('le', _number(float(bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_text = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class CountingRandom:
+    """乱数生成器を包み、メソッドごとに呼ばれた回数を数える。
+
+    操作の間だけgame.rngと差し替え、終わったらrecordで集計に足して元に戻す。
+    """
+
+    __slots__ = ('rng', 'draws')
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.draws = {}
+
+    def __getattr__(self, name):
+        method = getattr(self.rng, name)
+        draws = self.draws
+
+        def counted(*args, **kwargs):
+            draws[name] = draws.get(name, 0) + 1
+            return method(*args, **kwargs)
+        return counted
+
+    def record(self, counter):
+        for name, count in self.draws.items():
+            counter.inc(name, amount=count)
+
+
+class SamplingProfiler:
+    """一定間隔で全スレッドのスタックを覗き、呼び出し経路ごとの回数を数える。
+
+    結果はflamegraph.plなどで読める「関数;関数;... 回数」の形式で返す。
+    止めている間は何もしないので、実行中のサーバーで必要なときだけ動かす。
+    """
+
+    def __init__(self, max_depth=64, max_stacks=10000):
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.interval = None
+        self.samples = 0
+        self._stacks = _StackCounter()
+        self._lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.01):
+        with self._lock:
+            if self._thread is not None:
+                self.interval = interval
+                return
+            self.interval = interval
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,),
+                                            name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self, stop):
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            del frames
+            with self._lock:
+                self.samples += 1
+                for stack in stacks:
+                    # 経路の種類が増えすぎたら、既に数えている経路だけを数える
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
@@ -0,0 +1,208 @@
+"""game_logicのゲームをそのまま複数プロセスで回すモンテカルロ実行器。
+
+simulation.pyが効果を配列で真似るのに対し、こちらはWebと同じGameとactionsを使うので、
+ルールを変えたときの確認にも使える。
+
+各ゲームの乱数は (シード, ゲーム番号) だけから作るので、プロセス数やチャンクの大きさを
+変えても同じシードなら結果はビット単位で一致する。集計は整数の足し算だけで、
+チャンクは順番どおりにまとめる。
+
+    python montecarlo.py --games 20000 --players 4 --policy greedy random --workers 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+from actions import apply_action, pending_decision, policy_action
+from game_logic import PREDEFINED_DICE_OPTIONS, Dice, Game, Player, build_default_board
+from policies import POLICIES, RandomPolicy
+from serialization import board_from_dict, board_to_dict
+
+# 1ゲームの操作数の上限。ルールの誤りで終わらないゲームがあっても止まるように
+MAX_ACTIONS = 100000
+
+
+def game_rng(seed, index):
+    # 文字列のシードはハッシュの種に左右されないので、どのプロセスでも同じ乱数列になる
+    return random.Random(f"{seed}:{index}")
+
+
+class MonteCarloConfig:
+    """ワーカーに渡すゲームの設定。ボードは辞書にして渡す。"""
+
+    def __init__(self, num_players=4, max_turns=20, policies=None, board=None):
+        self.num_players = num_players
+        self.max_turns = max_turns
+        self.policies = list(policies or [RandomPolicy()])
+        self.board = board_to_dict(board or build_default_board())
+
+    def policy_for(self, seat):
+        # 方針が人数より少なければsimulation.pyと同じく順に繰り返して割り当てる
+        return self.policies[seat % len(self.policies)]
+
+
+class MonteCarloStats:
+    """ゲームの集計。値はすべて整数なので、まとめる順番が同じなら結果も同じになる。"""
+
+    def __init__(self, num_players):
+        self.num_players = num_players
+        self.games = 0
+        self.turns = 0
+        self.actions = 0
+        self.wins = [0] * num_players
+        self.distance_sum = [0] * num_players
+        self.distance_square_sum = [0] * num_players
+        self.event_counts = {}
+        self.decisions = {}
+        self.monty_hall = {'attempts': 0, 'switched': 0, 'wins': 0}
+        self.maze = {'attempts': 0, 'successes': 0}
+
+    def record_game(self, game):
+        self.games += 1
+        winner = max(range(self.num_players), key=lambda i: game.players[i].total_distance)
+        self.wins[winner] += 1
+        for seat, player in enumerate(game.players):
+            self.distance_sum[seat] += player.total_distance
+            self.distance_square_sum[seat] += player.total_distance ** 2
+
+    def merge(self, other):
+        self.games += other.games
+        self.turns += other.turns
+        self.actions += other.actions
+        for seat in range(self.num_players):
+            self.wins[seat] += other.wins[seat]
+            self.distance_sum[seat] += other.distance_sum[seat]
+            self.distance_square_sum[seat] += other.distance_square_sum[seat]
+        for counts, other_counts in ((self.event_counts, other.event_counts),
+                                     (self.decisions, other.decisions),
+                                     (self.monty_hall, other.monty_hall),
+                                     (self.maze, other.maze)):
+            for key, count in other_counts.items():
+                counts[key] = counts.get(key, 0) + count
+        return self
+
+    def summary(self):
+        games = max(self.games, 1)
+        means = [s / games for s in self.distance_sum]
+        stddevs = [max(sq / games - mean ** 2, 0.0) ** 0.5
+                   for sq, mean in zip(self.distance_square_sum, means)]
+        monty = dict(self.monty_hall)
+        monty['win_rate'] = monty['wins'] / monty['attempts'] if monty['attempts'] else None
+        maze = dict(self.maze)
+        maze['success_rate'] = maze['successes'] / maze['attempts'] if maze['attempts'] else None
+        return {
+            'games': self.games,
+            'win_rate_by_seat': [w / games for w in self.wins],
+            'mean_total_distance_by_seat': means,
+            'stddev_total_distance_by_seat': stddevs,
+            'actions_per_game': self.actions / games,
+            'event_counts': dict(sorted(self.event_counts.items())),
+            'decisions': dict(sorted(self.decisions.items())),
+            'monty_hall': monty,
+            'maze': maze,
+        }
+
+
+def play_game(config, board, rng, stats):
+    """1ゲームを最後まで進めてstatsに記録する。"""
+    players = [Player(f"プレイヤー{i+1}", 'default.png') for i in range(config.num_players)]
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    game = Game(players, board, dice, max_turns=config.max_turns, rng=rng)
+    game.start()
+
+    decisions = stats.decisions
+    for _ in range(MAX_ACTIONS):
+        decision, player_index = pending_decision(game)
+        if decision is None:
+            break
+        player = game.players[player_index]
+        maze = player.maze
+        action = policy_action(config.policy_for(player_index), game, decision, player_index)
+        if decision == 'monty_hall_change':
+            switched = action['change'] == 'はい'
+            state = player.monty_hall_state
+            final_choice = 6 - state.player_choice - state.opened_door if switched else state.player_choice
+            stats.monty_hall['attempts'] += 1
+            stats.monty_hall['switched'] += switched
+            stats.monty_hall['wins'] += final_choice == state.prize_door
+        apply_action(game, action)
+        stats.actions += 1
+        decisions[decision] = decisions.get(decision, 0) + 1
+
+        if decision == 'roll_dice':
+            stats.turns += 1
+            if game.last_event is not None:
+                kind = game.last_event.kind
+                stats.event_counts[kind] = stats.event_counts.get(kind, 0) + 1
+        elif decision == 'maze_choice' and maze.is_finished:
+            stats.maze['attempts'] += 1
+            stats.maze['successes'] += maze.is_success
+    else:
+        raise RuntimeError(f"{MAX_ACTIONS}回の操作でゲームが終わりませんでした。")
+    stats.record_game(game)
+    return game
+
+
+def _run_chunk(task):
+    # ワーカーで実行する単位。ボードはチャンクごとに一度だけ組み立てる
+    config, seed, start, stop = task
+    board = board_from_dict(config.board)
+    stats = MonteCarloStats(config.num_players)
+    for index in range(start, stop):
+        play_game(config, board, game_rng(seed, index), stats)
+    return stats
+
+
+def iter_partial_results(num_games, config=None, seed=0, workers=None, chunk_size=250):
+    """チャンクが終わるたびに、それまでの集計を返すジェネレーター。"""
+    config = config or MonteCarloConfig()
+    tasks = [(config, seed, start, min(start + chunk_size, num_games))
+             for start in range(0, num_games, chunk_size)]
+    total = MonteCarloStats(config.num_players)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield total.merge(_run_chunk(task))
+        return
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        # imapは投げた順に結果を返すので、まとめる順番はプロセス数によらない
+        for stats in pool.imap(_run_chunk, tasks):
+            yield total.merge(stats)
+
+
+def run(num_games, config=None, seed=0, workers=None, chunk_size=250, progress=None):
+    stats = None
+    for stats in iter_partial_results(num_games, config, seed, workers, chunk_size):
+        if progress is not None:
+            progress(stats)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='すごろくのモンテカルロ実行')
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=250)
+    parser.add_argument('--policy', nargs='+', default=['random'], choices=sorted(POLICIES))
+    parser.add_argument('--progress', action='store_true', help='途中の集計を標準エラーに出す')
+    args = parser.parse_args()
+
+    config = MonteCarloConfig(args.players, args.turns, [POLICIES[name]() for name in args.policy])
+
+    def progress(stats):
+        rates = ' '.join(f"{w / stats.games:.3f}" for w in stats.wins)
+        print(f"{stats.games}/{args.games} 勝率: {rates}", file=sys.stderr)
+
+    stats = run(args.games, config, args.seed, args.workers, args.chunk_size,
+                progress if args.progress else None)
+    print(json.dumps(stats.summary(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""対話が必要なイベント(サイコロ選択・スロット・モンティ・ホール・迷路)の自動プレイ方針。
+
+方針は選択肢ごとの重み(選ぶ確率)を返す。シミュレーターは重みからまとめて抽選し、
+1ゲームずつ動かす場合はchoose_*で1つ選ぶ。
+"""
+import random
+
+from game_logic import DICE_CATALOGUE, SLOT_OPTIONS
+from maze import DEFAULT_MAZE
+
+
+def dice_expectation(probabilities):
+    total = sum(probabilities.values())
+    return sum(face * prob for face, prob in probabilities.items()) / total
+
+
+def slot_expectation(slot_option):
+    return sum(res['steps'] * res['prob'] for res in slot_option['results'])
+
+
+def maze_success_probability(policy, graph=None):
+    # 方針に従って迷路を進んだときにゴールへ着く確率。道の行き先は選択で決まる
+    graph = graph or DEFAULT_MAZE
+    memo = {'goal': 1.0, 'fail': 0.0}
+
+    def visit(node, depth=0):
+        if node in memo:
+            return memo[node]
+        choices = graph.choices(node)
+        if not choices or depth > len(graph.nodes):
+            return 0.0
+        weights = _normalize(policy.maze_weights(node, choices, graph))
+        memo[node] = sum(w * visit(choice.to, depth + 1) for w, choice in zip(weights, choices))
+        return memo[node]
+
+    return visit(graph.start)
+
+
+def _normalize(weights):
+    total = sum(weights)
+    if total <= 0:
+        raise ValueError('重みの合計が0です。')
+    return [w / total for w in weights]
+
+
+def _one_hot(index, size):
+    weights = [0.0] * size
+    weights[index] = 1.0
+    return weights
+
+
+def _pick(rng, weights):
+    weights = _normalize(weights)
+    r = rng.random()
+    cum = 0.0
+    for i, w in enumerate(weights):
+        cum += w
+        if r < cum:
+            return i
+    return len(weights) - 1
+
+
+class Policy:
+    """方針の基本クラス。既定ではすべて一様に選ぶ。
+
+    position_dependentがTrueの方針は、今いるマスによって重みが変わる。
+    """
+
+    name = 'random'
+    position_dependent = False
+
+    def key(self):
+        # 計算結果を使い回すときの識別子。設定値を持つ方針は上書きして含める
+        return (type(self).__name__,)
+
+    def dice_weights(self, position=None):
+        return [1.0] * len(DICE_CATALOGUE)
+
+    def slot_weights(self, position=None):
+        return [1.0] * len(SLOT_OPTIONS)
+
+    def switch_probability(self, position=None):
+        return 0.5
+
+    def maze_weights(self, node, choices, graph=None):
+        return [1.0] * len(choices)
+
+    def choose_dice(self, rng=random, position=None):
+        return _pick(rng, self.dice_weights(position))
+
+    def choose_slot(self, rng=random, position=None):
+        return _pick(rng, self.slot_weights(position))
+
+    def switch_door(self, rng=random, position=None):
+        return rng.random() < self.switch_probability(position)
+
+    def choose_maze_branch(self, node, choices, rng=random, graph=None):
+        return _pick(rng, self.maze_weights(node, choices, graph))
+
+
+class RandomPolicy(Policy):
+    pass
+
+
+class FixedPolicy(Policy):
+    """常に同じ選択をする方針。比較実験で1つの選択肢だけを評価したいときに使う。"""
+
+    name = 'fixed'
+
+    def __init__(self, dice_index=0, slot_index=0, switch=True, maze_index=0):
+        self.dice_index = dice_index
+        self.slot_index = slot_index
+        self.switch = switch
+        self.maze_index = maze_index
+
+    def key(self):
+        return (type(self).__name__, self.dice_index, self.slot_index, self.switch, self.maze_index)
+
+    def dice_weights(self, position=None):
+        return _one_hot(self.dice_index, len(DICE_CATALOGUE))
+
+    def slot_weights(self, position=None):
+        return _one_hot(self.slot_index, len(SLOT_OPTIONS))
+
+    def switch_probability(self, position=None):
+        return 1.0 if self.switch else 0.0
+
+    def maze_weights(self, node, choices, graph=None):
+        return _one_hot(min(self.maze_index, len(choices) - 1), len(choices))
+
+
+class GreedyPolicy(Policy):
+    """その場の期待値が最も高い選択肢を選ぶ方針。"""
+
+    name = 'greedy'
+
+    def __init__(self):
+        self._best_dice = max(range(len(DICE_CATALOGUE)),
+                              key=lambda i: dice_expectation(DICE_CATALOGUE[i]['probabilities']))
+        self._best_slot = max(range(len(SLOT_OPTIONS)), key=lambda i: slot_expectation(SLOT_OPTIONS[i]))
+        # 迷路ごとに、各ノードからゴールに着けるかどうか
+        self._maze_values = {DEFAULT_MAZE.name: self._solve_maze(DEFAULT_MAZE)}
+
+    @staticmethod
+    def _solve_maze(graph):
+        # 各ノードからゴールに着けるかどうか(1か0)を後ろから求める
+        values = {'goal': 1.0, 'fail': 0.0}
+
+        def visit(node, seen=()):
+            if node in values:
+                return values[node]
+            if node in seen:
+                return 0.0
+            choices = graph.choices(node)
+            values[node] = max((visit(c.to, seen + (node,)) for c in choices), default=0.0)
+            return values[node]
+
+        for node in graph.edges:
+            visit(node)
+        return values
+
+    def dice_weights(self, position=None):
+        return _one_hot(self._best_dice, len(DICE_CATALOGUE))
+
+    def slot_weights(self, position=None):
+        return _one_hot(self._best_slot, len(SLOT_OPTIONS))
+
+    def switch_probability(self, position=None):
+        # 扉を変えると2/3で当たる
+        return 1.0
+
+    def maze_weights(self, node, choices, graph=None):
+        graph = graph or DEFAULT_MAZE
+        solved = self._maze_values.get(graph.name)
+        if solved is None:
+            solved = self._maze_values[graph.name] = self._solve_maze(graph)
+        values = [solved.get(c.to, 0.0) for c in choices]
+        return _one_hot(values.index(max(values)), len(choices))
+
+
+POLICIES = {
+    'random': RandomPolicy,
+    'greedy': GreedyPolicy,
+    'fixed': FixedPolicy,
+}
@@ -0,0 +1,366 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+# Subscription.closeがキューに入れる印。待っている受信側をすぐに起こす
+_CLOSED = object()
+
+
+class Subscription:
+    # AsyncSubscriptionと違い、起こす合図はいらない
+    loop = None
+
+    def __init__(self, game_id, maxsize, max_bytes=None):
+        self.game_id = game_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        # 溜まっているフレームの大きさの上限。Noneなら件数だけで制限する
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        # 受信が追いつかず溢れた購読者は閉じ、クライアントに再接続させる
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def put(self, frame):
+        # 溢れたらFalse
+        with self._lock:
+            if self.max_bytes is not None and self.pending_bytes + len(frame) > self.max_bytes:
+                return False
+            try:
+                self.queue.put_nowait(frame)
+            except queue.Full:
+                return False
+            self.pending_bytes += len(frame)
+        return True
+
+    def clear(self):
+        # 溜まっているフレームを捨てる
+        with self._lock:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.pending_bytes = 0
+
+    def close(self):
+        self.closed = True
+        try:
+            self.queue.put_nowait(_CLOSED)
+        except queue.Full:
+            # 溜まっているなら受信側は待っておらず、次に取り出した後でclosedに気づく
+            pass
+
+    def get(self, timeout):
+        # 届いたフレームを1つ返す。timeout秒何も無いか、閉じられたらNone
+        try:
+            frame = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if frame is _CLOSED:
+            return None
+        with self._lock:
+            self.pending_bytes -= len(frame)
+        return frame
+
+
+class AsyncSubscription:
+    """asyncioのタスクで待つ購読者。待っている間はスレッドを使わない。
+
+    putはどのスレッドから呼んでもよい。起こす合図はBroadcasterがイベントループごとに
+    まとめて送るので、購読者が多くてもループへの合図は配信1回につき1つで済む。
+    """
+
+    def __init__(self, game_id, maxsize, loop, max_bytes=None):
+        self.game_id = game_id
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        self.loop = loop
+        self.frames = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._lock = threading.Lock()
+
+    def put(self, frame):
+        with self._lock:
+            if len(self.frames) >= self.maxsize:
+                return False
+            if self.max_bytes is not None and self.pending_bytes + len(frame) > self.max_bytes:
+                return False
+            self.frames.append(frame)
+            self.pending_bytes += len(frame)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.frames.clear()
+            self.pending_bytes = 0
+
+    def wake(self):
+        # イベントループのスレッドで呼ぶ
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def get(self, timeout):
+        # 届いたフレームを1つ返す。timeout秒何も無いか、閉じられたらNone
+        while not self.frames:
+            if self.closed:
+                return None
+            self._ready.clear()
+            timer = self.loop.call_later(timeout, self._ready.set)
+            try:
+                await self._ready.wait()
+            finally:
+                timer.cancel()
+            if not self.frames:
+                return None
+        with self._lock:
+            frame = self.frames.popleft()
+            self.pending_bytes -= len(frame)
+        return frame
+
+
+# イベントループで一度に起こす購読者の数
+WAKE_CHUNK = 256
+
+
+def _wake_all(subscriptions, start=0):
+    end = start + WAKE_CHUNK
+    for subscription in subscriptions[start:end]:
+        subscription.wake()
+    if end < len(subscriptions):
+        # 残りは後回しにし、その間にほかのリクエストの処理を進められるようにする
+        asyncio.get_running_loop().call_soon(_wake_all, subscriptions, end)
+
+
+class Broadcaster:
+    """ゲームごとの購読者に、Server-Sent Eventsの形式で更新を配る。
+
+    メッセージは配信前に一度だけ文字列化し、同じものを全購読者のキューに入れる。
+    """
+
+    def __init__(self, queue_size=64, dumps=None, max_bytes=None):
+        self.queue_size = queue_size
+        # payloadをJSONのバイト列にする関数。省略時は標準のjson
+        self.dumps = dumps
+        self.max_bytes = max_bytes
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, game_id):
+        return self.attach(Subscription(game_id, self.queue_size, self.max_bytes))
+
+    def subscribe_async(self, game_id, loop):
+        return self.attach(AsyncSubscription(game_id, self.queue_size, loop, self.max_bytes))
+
+    def attach(self, subscription):
+        with self._lock:
+            self._subscribers[subscription.game_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.game_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.game_id]
+
+    def subscriber_count(self, game_id):
+        with self._lock:
+            return len(self._subscribers.get(game_id, ()))
+
+    def total_subscribers(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def close(self, game_id):
+        # ゲームが無くなったら、購読中のストリームを終わらせる
+        with self._lock:
+            subscribers = self._subscribers.pop(game_id, ())
+        for subscription in subscribers:
+            subscription.close()
+
+    def publish(self, game_id, event, payload, event_id=None):
+        with self._lock:
+            subscribers = list(self._subscribers.get(game_id, ()))
+        if not subscribers:
+            return 0
+        self._deliver(game_id, subscribers, self._frame(event, payload, event_id))
+        return len(subscribers)
+
+    def _frame(self, event, payload, event_id):
+        return format_event(event, payload, event_id, self.dumps)
+
+    def _deliver(self, game_id, subscribers, frame):
+        waking = defaultdict(list)
+        for subscription in subscribers:
+            if not subscription.put(frame) and not self._overflow(game_id, subscription):
+                subscription.close()
+            elif subscription.loop is not None:
+                waking[subscription.loop].append(subscription)
+        for loop, subscriptions in waking.items():
+            loop.call_soon_threadsafe(_wake_all, subscriptions)
+
+    def _overflow(self, game_id, subscription):
+        # 溢れた購読者を生かしておけるならTrue。ここでは閉じて再接続させる
+        return False
+
+
+class FanOut(Broadcaster):
+    """観戦者向けの配信。
+
+    publishは更新を待ち行列に入れるだけですぐ戻り、専用のスレッドが一度だけバイト列にして
+    全員に配る。そのため観戦者が何人いても、操作したリクエストの応答は遅くならない。
+    各観戦者に溜められる大きさはmax_bytesまでで、追いつけなくなった観戦者は溜まった差分を
+    捨て、代わりにその時点の状態全体(stateイベント)を1つだけ受け取る。
+
+    snapshotはgame_idから状態全体の辞書を返す関数(ゲームが無ければNone)。
+    状態全体は版ごとに一度だけ作り、同じ版のあいだは使い回す。
+    """
+
+    def __init__(self, snapshot, queue_size=256, max_bytes=256 * 1024, dumps=None, on_resync=None):
+        super().__init__(queue_size, dumps, max_bytes)
+        self.snapshot = snapshot
+        # 追いつけない観戦者に状態全体を送り直すたびに呼ぶ(計測用)
+        self.on_resync = on_resync
+        self._updates = queue.SimpleQueue()
+        self._dispatch_lock = threading.Lock()
+        self._versions = {}
+        self._states = {}
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _frame(self, event, payload, event_id):
+        # 全員に同じバイト列を渡すので、送るときに観戦者ごとに変換しなくてよい
+        return format_event(event, payload, event_id, self.dumps).encode('utf-8')
+
+    def attach(self, subscription):
+        # 最初に状態全体を送る。配信と同時に起きても差分を取りこぼさないよう、配信を止めてから登録する
+        with self._dispatch_lock:
+            frame = self.state_frame(subscription.game_id)
+            if frame is not None:
+                subscription.put(frame)
+            return super().attach(subscription)
+
+    def state_frame(self, game_id):
+        latest = self._versions.get(game_id)
+        cached = self._states.get(game_id)
+        if cached is not None and latest is not None and cached[0] == latest:
+            return cached[1]
+        payload = self.snapshot(game_id)
+        if payload is None:
+            return None
+        version = payload.get('version')
+        frame = self._frame('state', payload, version)
+        self._states[game_id] = (version, frame)
+        self._versions.setdefault(game_id, version)
+        return frame
+
+    def publish(self, game_id, event, payload, event_id=None):
+        # 観戦者がいなければ何もしない。payloadはこの後変更しないこと
+        if not self._subscribers.get(game_id):
+            return 0
+        self._start()
+        self._updates.put((game_id, event, payload, event_id))
+        return None
+
+    def _overflow(self, game_id, subscription):
+        subscription.clear()
+        if self.on_resync is not None:
+            self.on_resync()
+        frame = self.state_frame(game_id)
+        return frame is not None and subscription.put(frame)
+
+    def close(self, game_id):
+        super().close(game_id)
+        self._versions.pop(game_id, None)
+        self._states.pop(game_id, None)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='spectator-fanout', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._updates.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            game_id, event, payload, event_id = item
+            try:
+                with self._dispatch_lock:
+                    if event_id is not None:
+                        self._versions[game_id] = event_id
+                    Broadcaster.publish(self, game_id, event, payload, event_id)
+            except Exception:
+                logger.exception('観戦者への配信に失敗しました: %s', game_id)
+
+    def flush(self, timeout=5):
+        """待ち行列にある更新を配り終えるまで待つ。テストやベンチマーク用。"""
+        done = threading.Event()
+        self._start()
+        self._updates.put(done)
+        return done.wait(timeout)
+
+    def stop(self):
+        if self._thread is not None:
+            self._updates.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def format_event(event, payload, event_id=None, dumps=None):
+    if dumps is None:
+        data = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    else:
+        data = dumps(payload).decode('utf-8')
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {data}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream(broadcaster, subscription, keepalive=15):
+    # SSEのレスポンス本体。一定時間何もなければコメント行を送って接続を保つ
+    try:
+        yield 'retry: 3000\n\n'
+        while not subscription.closed:
+            frame = subscription.get(keepalive)
+            if frame is None:
+                if not subscription.closed:
+                    yield ': keepalive\n\n'
+            else:
+                yield frame
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+async def astream(broadcaster, subscription, keepalive=15):
+    # streamのasyncio版。AsyncSubscriptionと組み合わせる
+    try:
+        yield 'retry: 3000\n\n'
+        while not subscription.closed:
+            frame = await subscription.get(keepalive)
+            if frame is None:
+                if not subscription.closed:
+                    yield ': keepalive\n\n'
+            else:
+                yield frame
+    finally:
+        broadcaster.unsubscribe(subscription)
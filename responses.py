@@ -0,0 +1,116 @@
+"""JSONの応答を速く返すための部品。
+
+変わらない一覧(サイコロやスロットの選択肢)は起動時に一度だけJSONにして、
+gzip(brotliがあればbrも)で圧縮したものと一緒に持っておく。
+手番ごとの状態の応答には、SUGOROKU_JSONで選んだエンコーダーを使う。
+"""
+import gzip
+import hashlib
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    # ゲームの状態には数値をキーにした辞書(サイコロの確率など)があるのでOPT_NON_STR_KEYSを付ける
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# 名前と、objをUTF-8のJSONのバイト列にする関数
+ENCODERS = {'json': _stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = _orjson_dumps
+
+
+def get_encoder(name=None):
+    """名前のエンコーダーを返す。省略時は使える中で最も速いもの。"""
+    if not name:
+        return ENCODERS['orjson'] if 'orjson' in ENCODERS else ENCODERS['json']
+    if name not in ENCODERS:
+        raise ValueError(f"使えないJSONエンコーダーです: {name}(使えるもの: {', '.join(sorted(ENCODERS))})")
+    return ENCODERS[name]
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonifyで使うエンコーダーを差し替える。
+
+    扱えない型が含まれていれば、Flask標準のエンコードに戻す。
+    """
+
+    def __init__(self, app, encoder=None):
+        super().__init__(app)
+        self.encoder = encoder or get_encoder()
+
+    def dumps_bytes(self, obj):
+        try:
+            return self.encoder(obj)
+        except TypeError:
+            return super().dumps(obj).encode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def _accepted(accept_encoding):
+    # Accept-Encodingから受け付ける圧縮方式を取り出す(q=0は除く)
+    accepted = set()
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticPayload:
+    """変わらない応答の本文を、圧縮した版と一緒に作り置きしたもの。"""
+
+    def __init__(self, payload, max_age=300):
+        self.body = _stdlib_dumps(payload)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.max_age = max_age
+        # 圧縮して小さくなるものだけを持つ。brを先に試す
+        self.variants = []
+        if brotli is not None:
+            self._add_variant('br', brotli.compress(self.body))
+        self._add_variant('gzip', gzip.compress(self.body, compresslevel=9, mtime=0))
+
+    def _add_variant(self, coding, body):
+        if len(body) < len(self.body):
+            self.variants.append((coding, body))
+
+    def choose(self, accept_encoding):
+        """クライアントが受け付ける中で最も小さい本文と、その圧縮方式を返す。"""
+        if accept_encoding:
+            accepted = _accepted(accept_encoding)
+            for coding, body in self.variants:
+                if coding in accepted or '*' in accepted:
+                    return coding, body
+        return None, self.body
+
+    def response(self, request, response_class):
+        coding, body = self.choose(request.headers.get('Accept-Encoding', ''))
+        response = response_class(body, mimetype='application/json')
+        if coding is not None:
+            response.headers['Content-Encoding'] = coding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        # 圧縮方式ごとに本文が違うので、ETagにも方式を含める
+        response.set_etag(f"{self.etag}-{coding}" if coding else self.etag)
+        return response.make_conditional(request)
@@ -0,0 +1,190 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import snapshot
+from store import VersionConflict
+
+
+class Room:
+    def __init__(self, game_id, game, version=0, blob=None):
+        self.game_id = game_id
+        self.game = game
+        # 同じ部屋へのリクエストを直列化するためのロック
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+        # 共有ストア使用時、手元のgameがストア上のどの版から作られたか
+        self.version = version
+        self.blob = blob
+
+
+class GameRegistry:
+    """ゲームIDごとにGameを保持するレジストリ。
+
+    部屋は最終アクセス順に並べて保持し、TTLを過ぎた部屋と
+    max_roomsを超えた古い部屋から順に破棄する。
+
+    storeを渡すと、ゲームの正本はストア側に置かれ、手元の部屋は
+    そのキャッシュになる。書き込みは版番号による楽観的排他で行うので、
+    複数のワーカーやホストで同じゲームを扱える。
+
+    on_closeはゲームそのものが無くなったときだけ呼ぶ。ストアを使う場合、
+    手元のキャッシュから部屋を追い出してもゲームはストアに残るので呼ばない。
+    """
+
+    def __init__(self, max_rooms=10000, ttl=3600, store=None, codec=snapshot, on_close=None):
+        self.max_rooms = max_rooms
+        self.ttl = ttl
+        self.store = store
+        self.codec = codec
+        # ゲームが無くなったときにゲームIDを受け取るコールバック。ロックの外で呼ぶ
+        self.on_close = on_close
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def create(self, game, game_id=None):
+        # game_idは復元時など、決まったIDで部屋を作り直すときだけ渡す
+        game_id = game_id or uuid.uuid4().hex
+        room = Room(game_id, game)
+        if self.store is not None:
+            room.blob = self.codec.dumps(game)
+            room.version = self.store.save(game_id, room.blob, 0)
+        with self._lock:
+            self._rooms[game_id] = room
+            evicted = self._evict_locked(time.monotonic())
+        self._evicted(evicted)
+        return game_id
+
+    def get(self, game_id):
+        if not game_id:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            room = self._rooms.get(game_id)
+            expired = room is not None and now - room.last_access > self.ttl
+            if expired:
+                del self._rooms[game_id]
+                room = None
+            if room is not None:
+                room.last_access = now
+                self._rooms.move_to_end(game_id)
+                return room
+        if expired:
+            self._evicted([game_id])
+        if self.store is None:
+            return None
+        # 他のワーカーが作った部屋かもしれないのでストアから読む。
+        # ストアに無いIDの部屋は作らない(でたらめなIDで本物の部屋が追い出されないように)
+        loaded = self.store.load(game_id)
+        if loaded is None:
+            return None
+        version, blob = loaded
+        room = Room(game_id, self.codec.loads(blob), version, blob)
+        with self._lock:
+            # 読んでいる間に他のスレッドが同じ部屋を作っていればそちらを使う
+            room = self._rooms.setdefault(game_id, room)
+            room.last_access = now
+            self._rooms.move_to_end(game_id)
+            evicted = self._evict_locked(now)
+        self._evicted(evicted)
+        return room
+
+    def remove(self, game_id):
+        if self.store is not None:
+            self.store.delete(game_id)
+        with self._lock:
+            removed = self._rooms.pop(game_id, None) is not None
+        if removed:
+            self._closed(game_id)
+        return removed
+
+    def evict_expired(self):
+        with self._lock:
+            evicted = self._evict_locked(time.monotonic())
+        self._evicted(evicted)
+        return len(evicted)
+
+    @contextmanager
+    def session(self, game_id, write=False):
+        # 部屋のロックを取った状態でGameを渡す。部屋が無ければNoneを渡す
+        room = self.get(game_id)
+        if room is None:
+            yield None
+            return
+        with room.lock:
+            if self.store is None:
+                yield room.game
+                return
+            if not self._refresh(room):
+                # ストアからゲームが消えている
+                with self._lock:
+                    self._rooms.pop(game_id, None)
+                self._closed(game_id)
+                yield None
+                return
+            try:
+                yield room.game
+            except BaseException:
+                # 途中で失敗した変更はストアに書かないので、手元の状態も捨てる
+                self._discard(room)
+                raise
+            if write:
+                self._write_back(room)
+
+    def _refresh(self, room):
+        # ストア上の版が手元と違えば読み直す。ゲームが無くなっていればFalse
+        loaded = self.store.load(room.game_id, room.version)
+        if loaded is None:
+            return False
+        version, blob = loaded
+        if blob is not None:
+            room.game = self.codec.loads(blob)
+            room.blob = blob
+            room.version = version
+        return True
+
+    def _write_back(self, room):
+        blob = self.codec.dumps(room.game)
+        if blob == room.blob:
+            return
+        try:
+            room.version = self.store.save(room.game_id, blob, room.version)
+        except VersionConflict:
+            # 手元の状態は他のワーカーの更新と食い違っているので捨てる
+            self._discard(room)
+            raise
+        room.blob = blob
+
+    def _discard(self, room):
+        # 版を0に戻すと、次回の_refreshで必ずストアから読み直される
+        room.game = None
+        room.version = 0
+        room.blob = None
+
+    def _evict_locked(self, now):
+        # 先頭ほどアクセスが古いので、条件を満たさなくなった時点で打ち切れる。
+        # 追い出した部屋のIDを返すので、呼び出し側がロックを放してから_evictedに渡す
+        evicted = []
+        while self._rooms:
+            game_id, room = next(iter(self._rooms.items()))
+            if len(self._rooms) > self.max_rooms or now - room.last_access > self.ttl:
+                del self._rooms[game_id]
+                evicted.append(game_id)
+            else:
+                break
+        return evicted
+
+    def _evicted(self, game_ids):
+        # ストアがあればゲームはストアに残っているので、キャッシュから外すだけ
+        if self.store is None:
+            for game_id in game_ids:
+                self._closed(game_id)
+
+    def _closed(self, game_id):
+        if self.on_close is not None:
+            self.on_close(game_id)
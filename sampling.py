@@ -0,0 +1,73 @@
+import random
+from functools import lru_cache
+
+
+class AliasTable:
+    """Walkerのエイリアス法による離散分布の抽選表。
+
+    作成はO(n)、1回の抽選は乱数1つでO(1)。
+    """
+
+    __slots__ = ('outcomes', 'prob', 'alias', 'size')
+
+    def __init__(self, outcomes, weights):
+        outcomes = tuple(outcomes)
+        weights = [float(w) for w in weights]
+        if not outcomes or len(outcomes) != len(weights):
+            raise ValueError('出目と確率の数が一致しません。')
+        total = sum(weights)
+        if total <= 0 or any(w < 0 for w in weights):
+            raise ValueError('確率は0以上で、合計が正である必要があります。')
+
+        n = len(weights)
+        # 平均が1になるよう拡大し、1未満と1以上の組を作っていく(Voseの方法)
+        scaled = [w * n / total for w in weights]
+        prob = [0.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # 丸め誤差で残ったものは確率1として扱う
+        for i in large + small:
+            prob[i] = 1.0
+
+        self.outcomes = outcomes
+        self.prob = prob
+        self.alias = alias
+        self.size = n
+
+    def sample(self, rng=random):
+        u = rng.random() * self.size
+        i = int(u)
+        if u - i < self.prob[i]:
+            return self.outcomes[i]
+        return self.outcomes[self.alias[i]]
+
+    def sample_many(self, count, rng=random):
+        outcomes = self.outcomes
+        prob = self.prob
+        alias = self.alias
+        size = self.size
+        draw = rng.random
+        results = []
+        append = results.append
+        for _ in range(count):
+            u = draw() * size
+            i = int(u)
+            append(outcomes[i] if u - i < prob[i] else outcomes[alias[i]])
+        return results
+
+
+@lru_cache(maxsize=256)
+def alias_table(items):
+    # 同じ分布の表は使い回す。itemsは ((出目, 確率), ...) のタプル
+    return AliasTable([outcome for outcome, _ in items], [weight for _, weight in items])
@@ -0,0 +1,131 @@
+import json
+
+from boards import intern_board
+from game_logic import Board, Dice, Game, MontyHallState, Player, ProbabilityMaze, make_event
+from maze import DEFAULT_MAZE_NAME, maze_graph
+
+
+def _dice_to_list(dice):
+    if dice is None:
+        return None
+    return [[face, prob] for face, prob in dice.probabilities.items()]
+
+
+def _dice_from_list(data):
+    if data is None:
+        return None
+    return Dice({int(face): prob for face, prob in data})
+
+
+def _event_to_list(event):
+    if event.kind is None:
+        raise ValueError(f"保存できないイベントです: {event.name}")
+    argument = event.argument()
+    if argument is None:
+        return [event.kind]
+    return [event.kind, argument]
+
+
+def player_to_dict(player):
+    maze = None
+    if player.maze is not None:
+        maze = {
+            'graph': player.maze.graph.name,
+            'current_node': player.maze.current_node,
+            'is_success': player.maze.is_success,
+            'is_finished': player.maze.is_finished,
+            'path_taken': player.maze.path_taken,
+        }
+    return {
+        'name': player.name,
+        'position': player.position,
+        'character': player.character,
+        'dice': _dice_to_list(player.dice),
+        'needs_dice_selection': player.needs_dice_selection,
+        'is_in_monty_hall': player.is_in_monty_hall,
+        'monty_hall_state': player.monty_hall_state.to_dict() if player.monty_hall_state else {},
+        'is_in_maze': player.is_in_maze,
+        'maze': maze,
+        'total_distance': player.total_distance,
+        'is_cpu': player.is_cpu,
+    }
+
+
+def player_from_dict(data):
+    player = Player(data['name'], data['character'], data.get('is_cpu', False))
+    player.position = data['position']
+    player.dice = _dice_from_list(data['dice'])
+    player.needs_dice_selection = data['needs_dice_selection']
+    player.is_in_monty_hall = data['is_in_monty_hall']
+    if data['monty_hall_state']:
+        player.monty_hall_state = MontyHallState(**data['monty_hall_state'])
+    player.is_in_maze = data['is_in_maze']
+    if data['maze'] is not None:
+        graph = maze_graph(data['maze'].get('graph', DEFAULT_MAZE_NAME))
+        maze = ProbabilityMaze(graph)
+        maze.current_node = graph.intern(data['maze']['current_node'])
+        maze.is_success = data['maze']['is_success']
+        maze.is_finished = data['maze']['is_finished']
+        maze.path_taken = [graph.intern(node) for node in data['maze']['path_taken']]
+        player.maze = maze
+    player.total_distance = data['total_distance']
+    return player
+
+
+def board_to_dict(board):
+    events = []
+    for position in board.index.positions:
+        events.append([position] + _event_to_list(board.events[position]))
+    return {'size': board.size, 'events': events}
+
+
+def board_from_dict(data):
+    board = Board(data['size'])
+    for position, *spec in data['events']:
+        board.add_event(position, make_event(*spec))
+    # 設定にある盤面と同じなら、作り直したものの代わりに共有の雛形を使う
+    return intern_board(board)
+
+
+def game_to_dict(game):
+    return {
+        'players': [player_to_dict(player) for player in game.players],
+        'board': board_to_dict(game.board),
+        'dice': _dice_to_list(game.dice),
+        'current_player_index': game.current_player_index,
+        'is_over': game.is_over,
+        'max_turns': game.max_turns,
+        'current_turn': game.current_turn,
+        'version': game.version,
+        'is_slot_event_active': game.is_slot_event_active,
+        'slot_order': game.slot_order,
+        'slot_trigger_player_index': game.slot_trigger_player_index,
+        'slot_results': game.slot_results,
+        'seed': game.seed,
+    }
+
+
+def game_from_dict(data):
+    players = [player_from_dict(p) for p in data['players']]
+    game = Game(players, board_from_dict(data['board']), _dice_from_list(data['dice']),
+                max_turns=data['max_turns'], seed=data.get('seed'))
+    # 履歴はスナップショットと同じく保存しない
+    game.history = None
+    game.current_player_index = data['current_player_index']
+    game.is_over = data['is_over']
+    game.current_turn = data['current_turn']
+    game.version = data.get('version', 0)
+    game.is_slot_event_active = data['is_slot_event_active']
+    game.slot_order = list(data['slot_order'])
+    game.slot_trigger_player_index = data['slot_trigger_player_index']
+    game.slot_results = dict(data['slot_results'])
+    return game
+
+
+def dumps(game):
+    # 空白を詰めたUTF-8のJSONにしてストアに保存する
+    return json.dumps(game_to_dict(game), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(blob):
+    return game_from_dict(json.loads(blob))
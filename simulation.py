@@ -0,0 +1,371 @@
+"""NumPyでN個のゲームを同時に進めるヘッドレスシミュレーター。
+
+位置・累計移動距離・使用中のサイコロを (ゲーム数, 人数) の配列で持ち、
+全ゲームを1手ずつ揃えて進める。対話が必要なイベントは policies の方針で自動的に選ぶ。
+
+イベントの効果はgame_logicとapp.pyの処理と同じにしてある。
+対話イベントは本来その人の次の手番の前に解決されるが、その間に状態が変わるのは
+他の人が起こしたスロットイベントだけなので、ここでは止まった直後に解決する。
+
+    python simulation.py --games 100000 --players 4 --policy greedy random
+
+NumPyが必要。Webサーバーの実行には不要なのでrequirements.txtには含めていない。
+"""
+import argparse
+import json
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from game_logic import (
+    DICE_CATALOGUE,
+    PREDEFINED_DICE_OPTIONS,
+    SLOT_OPTIONS,
+    MontyHallEvent,
+    build_default_board,
+)
+from policies import POLICIES, GreedyPolicy, maze_success_probability
+from sampling import AliasTable
+
+# マスごとのイベントの種類を表す番号
+NO_EVENT, FORWARD, BACKWARD, DICE_SELECTION, MAZE, MONTY_HALL, SLOT_MACHINE = range(7)
+_KIND_CODES = {
+    'forward': FORWARD,
+    'backward': BACKWARD,
+    'dice_selection': DICE_SELECTION,
+    'maze': MAZE,
+    'monty_hall': MONTY_HALL,
+    'slot_machine': SLOT_MACHINE,
+}
+
+# サイコロ選択前に使う、ゲーム共通のサイコロを表す番号
+DEFAULT_DICE = -1
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('シミュレーターにはNumPyが必要です: pip install numpy')
+
+
+class CompiledBoard:
+    """Boardをマスごとの配列にしたもの。"""
+
+    def __init__(self, board):
+        _require_numpy()
+        self.size = board.size
+        self.kind = np.zeros(board.size, dtype=np.int8)
+        self.steps = np.zeros(board.size, dtype=np.int64)
+        self.reward = np.zeros(board.size, dtype=np.int64)
+        self.penalty = np.zeros(board.size, dtype=np.int64)
+        for position, event in board.events.items():
+            code = _KIND_CODES.get(event.kind)
+            if code is None:
+                raise ValueError(f"シミュレーターが扱えないイベントです: {event.name}")
+            self.kind[position] = code
+            self.steps[position] = getattr(event, 'steps', 0) or 0
+            self.reward[position] = getattr(event, 'reward_steps', 0)
+            self.penalty[position] = getattr(event, 'penalty_steps', 0)
+
+
+class _VectorSampler:
+    # AliasTableをNumPy配列にして、まとめて抽選する
+    def __init__(self, outcomes, weights):
+        table = AliasTable(outcomes, weights)
+        self.outcomes = np.asarray(table.outcomes)
+        self.prob = np.asarray(table.prob)
+        self.alias = np.asarray(table.alias)
+
+    def sample(self, generator, count):
+        u = generator.random(count) * len(self.prob)
+        i = u.astype(np.int64)
+        take = (u - i) < self.prob[i]
+        return np.where(take, self.outcomes[i], self.outcomes[self.alias[i]])
+
+
+def _dice_sampler(probabilities):
+    return _VectorSampler(list(probabilities), list(probabilities.values()))
+
+
+class SimulationResult:
+    def __init__(self, num_players, policies):
+        self.num_players = num_players
+        self.policy_names = [policy.name for policy in policies]
+        self.games = 0
+        self.wins = np.zeros(num_players, dtype=np.int64)
+        self.total_distance_sum = np.zeros(num_players, dtype=np.float64)
+        # 勝者が最後に使っていたサイコロ(DEFAULT_DICEは添字0)ごとの勝利数と保持数
+        self.wins_by_dice = np.zeros(len(DICE_CATALOGUE) + 1, dtype=np.int64)
+        self.held_by_dice = np.zeros(len(DICE_CATALOGUE) + 1, dtype=np.int64)
+        self.final_distance = []
+        # 1ターン(1人1回の手番)で進んだ距離の分布。添字はADVANCE_OFFSETだけずらす
+        self.advance_histogram = np.zeros(self.ADVANCE_RANGE, dtype=np.int64)
+        self.event_counts = np.zeros(7, dtype=np.int64)
+        self.monty_hall = {'attempts': 0, 'switched': 0, 'wins': 0, 'switch_wins': 0}
+        self.maze = {'attempts': 0, 'successes': 0}
+        self.slot_spins = np.zeros(len(SLOT_OPTIONS), dtype=np.int64)
+        self.slot_steps = np.zeros(len(SLOT_OPTIONS), dtype=np.int64)
+
+    ADVANCE_OFFSET = 64
+    ADVANCE_RANGE = 192
+
+    def merge(self, other):
+        # 並列実行した結果をまとめる
+        self.games += other.games
+        self.wins += other.wins
+        self.total_distance_sum += other.total_distance_sum
+        self.wins_by_dice += other.wins_by_dice
+        self.held_by_dice += other.held_by_dice
+        self.final_distance.extend(other.final_distance)
+        self.advance_histogram += other.advance_histogram
+        self.event_counts += other.event_counts
+        for key in self.monty_hall:
+            self.monty_hall[key] += other.monty_hall[key]
+        for key in self.maze:
+            self.maze[key] += other.maze[key]
+        self.slot_spins += other.slot_spins
+        self.slot_steps += other.slot_steps
+        return self
+
+    def summary(self):
+        games = max(self.games, 1)
+        distances = np.concatenate(self.final_distance) if self.final_distance else np.zeros((0, self.num_players))
+        dice_names = ['ゲーム共通のサイコロ'] + [option['name'] for option in DICE_CATALOGUE]
+        advance = {
+            int(i - self.ADVANCE_OFFSET): int(count)
+            for i, count in enumerate(self.advance_histogram) if count
+        }
+        monty = dict(self.monty_hall)
+        stay_attempts = monty['attempts'] - monty['switched']
+        monty['switch_win_rate'] = monty['switch_wins'] / monty['switched'] if monty['switched'] else None
+        monty['stay_win_rate'] = ((monty['wins'] - monty['switch_wins']) / stay_attempts
+                                  if stay_attempts else None)
+        return {
+            'games': self.games,
+            'policies': self.policy_names,
+            'win_rate_by_seat': (self.wins / games).tolist(),
+            'mean_total_distance_by_seat': (self.total_distance_sum / games).tolist(),
+            'total_distance_percentiles': {
+                str(p): float(np.percentile(distances, p)) if distances.size else None
+                for p in (5, 25, 50, 75, 95)
+            },
+            'win_rate_by_final_dice': {
+                name: (int(wins) / int(held) if held else None)
+                for name, wins, held in zip(dice_names, self.wins_by_dice, self.held_by_dice)
+            },
+            'advance_per_turn': advance,
+            'event_counts': {
+                name: int(self.event_counts[code]) for name, code in _KIND_CODES.items()
+            },
+            'monty_hall': monty,
+            'maze_success_rate': (self.maze['successes'] / self.maze['attempts']
+                                  if self.maze['attempts'] else None),
+            'slot_mean_steps': {
+                option['name']: (int(steps) / int(spins) if spins else None)
+                for option, spins, steps in zip(SLOT_OPTIONS, self.slot_spins, self.slot_steps)
+            },
+        }
+
+
+def _weights_many(policy, method, positions):
+    # 方針の重みを (対象ゲーム数, 選択肢数) の配列にする。位置によらない方針は1回だけ聞く
+    if not policy.position_dependent:
+        weights = np.asarray(getattr(policy, method)(), dtype=np.float64)
+        return np.broadcast_to(weights / weights.sum(), (len(positions), len(weights)))
+    rows = {}
+    for position in np.unique(positions):
+        weights = np.asarray(getattr(policy, method)(int(position)), dtype=np.float64)
+        rows[int(position)] = weights / weights.sum()
+    return np.stack([rows[int(position)] for position in positions])
+
+
+def _choose_many(generator, weights):
+    # 行ごとの重みに従って1つずつ選ぶ
+    cumulative = np.cumsum(weights, axis=1)
+    r = generator.random(len(weights))[:, None] * cumulative[:, -1:]
+    return np.minimum((r >= cumulative).sum(axis=1), weights.shape[1] - 1)
+
+
+def _switch_many(generator, policy, positions):
+    if not policy.position_dependent:
+        p = policy.switch_probability()
+        return generator.random(len(positions)) < p
+    p = np.array([policy.switch_probability(int(position)) for position in positions])
+    return generator.random(len(positions)) < p
+
+
+class Simulator:
+    """同じボード・人数・方針でゲームをまとめて進める。"""
+
+    def __init__(self, board=None, num_players=4, max_turns=20, policies=None, dice=None):
+        _require_numpy()
+        board = board or build_default_board()
+        self.board = CompiledBoard(board)
+        self.num_players = num_players
+        self.max_turns = max_turns
+        policies = list(policies or [GreedyPolicy()])
+        # 方針が人数より少なければ繰り返して割り当てる
+        self.policies = [policies[i % len(policies)] for i in range(num_players)]
+        default = dice or PREDEFINED_DICE_OPTIONS[0]['probabilities']
+        self.default_sampler = _dice_sampler(default)
+        self.dice_samplers = [_dice_sampler(option['probabilities']) for option in DICE_CATALOGUE]
+        self.slot_samplers = [
+            _VectorSampler([res['steps'] for res in option['results']],
+                           [res['prob'] for res in option['results']])
+            for option in SLOT_OPTIONS
+        ]
+        # 迷路のマスごと・席ごとのゴールに着く確率。報酬と罰はboard.reward/penaltyにある
+        self.maze_success = np.zeros((num_players, self.board.size))
+        for position in board.positions_of('maze'):
+            graph = board.events[position].graph
+            for seat, policy in enumerate(self.policies):
+                self.maze_success[seat, position] = maze_success_probability(policy, graph)
+        monty = MontyHallEvent()
+        self.default_monty = (monty.reward_steps, monty.penalty_steps)
+
+    def run(self, num_games, seed=None, generator=None):
+        generator = generator or np.random.default_rng(seed)
+        result = SimulationResult(self.num_players, self.policies)
+        self._run(num_games, generator, result)
+        return result
+
+    def _roll(self, generator, dice):
+        # 使っているサイコロごとにまとめて振る
+        rolls = np.empty(len(dice), dtype=np.int64)
+        for dice_id in np.unique(dice):
+            mask = dice == dice_id
+            sampler = self.default_sampler if dice_id == DEFAULT_DICE else self.dice_samplers[dice_id]
+            rolls[mask] = sampler.sample(generator, int(mask.sum()))
+        return rolls
+
+    def _run(self, num_games, generator, result):
+        board = self.board
+        size = board.size
+        n, p = num_games, self.num_players
+        position = np.zeros((n, p), dtype=np.int64)
+        total = np.zeros((n, p), dtype=np.int64)
+        dice = np.full((n, p), DEFAULT_DICE, dtype=np.int64)
+
+        for _ in range(self.max_turns):
+            for seat in range(p):
+                before = total[:, seat].copy()
+                roll = self._roll(generator, dice[:, seat])
+                total[:, seat] += roll
+                position[:, seat] = (position[:, seat] + roll) % size
+                landed = position[:, seat].copy()
+                kind = board.kind[landed]
+                result.event_counts += np.bincount(kind, minlength=7)
+
+                mask = kind == FORWARD
+                position[mask, seat] += board.steps[landed[mask]]
+
+                mask = kind == BACKWARD
+                steps = board.steps[landed[mask]]
+                total[mask, seat] -= steps
+                moved = position[mask, seat] - steps
+                position[mask, seat] = np.where(moved < 0, moved % size, moved)
+
+                mask = kind == DICE_SELECTION
+                if mask.any():
+                    weights = _weights_many(self.policies[seat], 'dice_weights', landed[mask])
+                    dice[mask, seat] = _choose_many(generator, weights)
+
+                mask = kind == MONTY_HALL
+                if mask.any():
+                    self._monty_hall(generator, result, position, seat, mask, landed)
+
+                mask = kind == MAZE
+                if mask.any():
+                    count = int(mask.sum())
+                    cells = landed[mask]
+                    success = generator.random(count) < self.maze_success[seat, cells]
+                    delta = np.where(success, board.reward[cells], -board.penalty[cells])
+                    position[mask, seat] = np.maximum(position[mask, seat] + delta, 0)
+                    result.maze['attempts'] += count
+                    result.maze['successes'] += int(success.sum())
+
+                mask = kind == SLOT_MACHINE
+                if mask.any():
+                    self._slot_event(generator, result, position, total, seat, mask)
+
+                gained = total[:, seat] - before
+                result.advance_histogram += np.bincount(
+                    np.clip(gained + result.ADVANCE_OFFSET, 0, result.ADVANCE_RANGE - 1),
+                    minlength=result.ADVANCE_RANGE,
+                )
+
+        # 同点のときは先の席が勝つ(Game.next_turnのmaxと同じ)
+        winner = np.argmax(total, axis=1)
+        result.games += n
+        result.wins += np.bincount(winner, minlength=p)
+        result.total_distance_sum += total.sum(axis=0)
+        result.final_distance.append(total)
+        winner_dice = dice[np.arange(n), winner] + 1
+        result.wins_by_dice += np.bincount(winner_dice, minlength=len(DICE_CATALOGUE) + 1)
+        result.held_by_dice += np.bincount(dice.ravel() + 1, minlength=len(DICE_CATALOGUE) + 1)
+
+    def _monty_hall(self, generator, result, position, seat, mask, landed):
+        policy = self.policies[seat]
+        count = int(mask.sum())
+        switched = _switch_many(generator, policy, landed[mask])
+        # 最初の選択が当たりである確率は1/3。変えれば外れ、変えなければ当たり
+        first_pick_wins = generator.random(count) < 1 / 3
+        win = first_pick_wins != switched
+        reward = np.where(self.board.reward[landed[mask]] > 0, self.board.reward[landed[mask]],
+                          self.default_monty[0])
+        penalty = np.where(self.board.penalty[landed[mask]] > 0, self.board.penalty[landed[mask]],
+                           self.default_monty[1])
+        position[mask, seat] = np.maximum(position[mask, seat] + np.where(win, reward, -penalty), 0)
+        result.monty_hall['attempts'] += count
+        result.monty_hall['switched'] += int(switched.sum())
+        result.monty_hall['wins'] += int(win.sum())
+        result.monty_hall['switch_wins'] += int((win & switched).sum())
+
+    def _slot_event(self, generator, result, position, total, seat, mask):
+        # 止まった人の次の人から順に、止まった人まで全員が1回ずつ回す
+        size = self.board.size
+        games = np.flatnonzero(mask)
+        for offset in range(1, self.num_players + 1):
+            spinner = (seat + offset) % self.num_players
+            weights = _weights_many(self.policies[spinner], 'slot_weights', position[games, spinner] % size)
+            choice = _choose_many(generator, weights)
+            steps = np.empty(len(games), dtype=np.int64)
+            for slot_index in np.unique(choice):
+                chosen = choice == slot_index
+                steps[chosen] = self.slot_samplers[slot_index].sample(generator, int(chosen.sum()))
+            total[games, spinner] += steps
+            position[games, spinner] = (position[games, spinner] + steps) % size
+            result.slot_spins += np.bincount(choice, minlength=len(SLOT_OPTIONS))
+            result.slot_steps += np.bincount(choice, weights=steps, minlength=len(SLOT_OPTIONS)).astype(np.int64)
+
+
+def simulate(num_games, num_players=4, max_turns=20, policies=None, seed=None, board=None,
+             batch_size=100000):
+    """num_games回のゲームを、メモリを抑えるためbatch_sizeずつに分けて実行する。"""
+    simulator = Simulator(board, num_players, max_turns, policies)
+    generator = np.random.default_rng(seed)
+    result = SimulationResult(num_players, simulator.policies)
+    remaining = num_games
+    while remaining > 0:
+        count = min(batch_size, remaining)
+        simulator._run(count, generator, result)
+        remaining -= count
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='すごろくのヘッドレスシミュレーション')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--policy', nargs='+', default=['greedy'], choices=sorted(POLICIES))
+    args = parser.parse_args()
+    policies = [POLICIES[name]() for name in args.policy]
+    result = simulate(args.games, args.players, args.turns, policies, seed=args.seed)
+    print(json.dumps(result.summary(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
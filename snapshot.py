@@ -0,0 +1,369 @@
+"""Gameのバイナリスナップショット形式。
+
+serialization.pyのJSONと同じ内容を、数バイト単位のレコードに詰めて保存する。
+4人・40マスの標準的なゲームで100バイト未満に収まる。
+
+形式:
+    ヘッダー   b'S' + 形式の版(1バイト)
+    ゲーム     フラグ(1バイト), max_turns, current_turn, current_player_index, 状態の版, シード, サイコロ参照
+    ボード     size, イベント数, [位置の差分, イベントコード] * イベント数
+    プレイヤー 人数, [フラグ, position, total_distance, キャラクター参照, サイコロ参照, ...] * 人数
+    スロット   スロットイベントが一度でも起きていれば。順番、発生させたプレイヤー、結果メッセージ
+    迷路       迷路の名前の参照と、その迷路のノード番号で現在地と通った道
+
+整数はすべて可変長(LEB128)、負になり得る値はZigZag符号化する。
+操作の履歴(Game.history)は大きさがゲームの長さに比例するので保存しない。読み込んだゲームの履歴はNone。
+
+イベントはEVENT_KINDS上の番号で参照し、関数(クロージャ)そのものは保存しない。
+"""
+import struct
+
+from boards import intern_board
+from maze import DEFAULT_MAZE_NAME, maze_graph
+from game_logic import (
+    Board,
+    Dice,
+    Game,
+    MontyHallState,
+    Player,
+    ProbabilityMaze,
+    make_event,
+    DICE_CATALOGUE,
+)
+
+MAGIC = b'S'
+FORMAT_VERSION = 1
+
+# イベントの参照番号。並びを変えると過去のスナップショットが読めなくなるので末尾に追加すること
+EVENT_KINDS = ('forward', 'backward', 'dice_selection', 'maze', 'monty_hall', 'slot_machine')
+_EVENT_IDS = {kind: i for i, kind in enumerate(EVENT_KINDS)}
+
+# よく使う文字列の参照表。表に無い文字列はそのまま書き込む
+CHARACTERS = ('default.png', 'avatar1.png', 'avatar2.png', 'avatar3.png', 'avatar4.png')
+_CHARACTER_IDS = {name: i for i, name in enumerate(CHARACTERS)}
+
+# 迷路の名前の参照表
+MAZE_NAMES = (DEFAULT_MAZE_NAME,)
+_MAZE_NAME_IDS = {name: i for i, name in enumerate(MAZE_NAMES)}
+
+_DICE_CATALOGUE = [option['probabilities'] for option in DICE_CATALOGUE]
+_DICE_NONE = 0
+_DICE_INLINE = 0xFF
+_STRING_INLINE = 0xFF
+
+# ボードのイベントの引数の下位4ビット
+_ARGUMENT_TEXT = 0x0E
+_ARGUMENT_INT = 0x0F
+
+# ゲームのフラグ
+_GAME_OVER = 0x01
+_GAME_SLOT_ACTIVE = 0x02
+# スロットイベントの記録がある。終わった後も最後の結果は状態に残る
+_GAME_SLOT = 0x04
+
+# プレイヤーのフラグ
+_PLAYER_NEEDS_DICE = 0x01
+_PLAYER_MONTY_HALL = 0x02
+_PLAYER_MONTY_STATE = 0x04
+_PLAYER_MAZE = 0x08
+_PLAYER_HAS_MAZE = 0x10
+_PLAYER_CUSTOM_NAME = 0x20
+_PLAYER_CPU = 0x40
+
+_FLOAT = struct.Struct('<d')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class _Writer:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def byte(self, value):
+        self.buf.append(value)
+
+    def uint(self, value):
+        while value >= 0x80:
+            self.buf.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.buf.append(value)
+
+    def sint(self, value):
+        self.uint(value << 1 if value >= 0 else (~value << 1) | 1)
+
+    def text(self, value):
+        data = value.encode('utf-8')
+        self.uint(len(data))
+        self.buf += data
+
+    def ref(self, value, ids):
+        # 参照表にあれば番号、無ければ文字列そのもの
+        index = ids.get(value)
+        if index is None:
+            self.byte(_STRING_INLINE)
+            self.text(value)
+        else:
+            self.byte(index)
+
+    def dice(self, dice):
+        if dice is None:
+            self.byte(_DICE_NONE)
+            return
+        for i, probabilities in enumerate(_DICE_CATALOGUE):
+            if dice.probabilities == probabilities:
+                self.byte(i + 1)
+                return
+        self.byte(_DICE_INLINE)
+        self.uint(len(dice.probabilities))
+        for face, prob in dice.probabilities.items():
+            self.uint(face)
+            self.buf += _FLOAT.pack(prob)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        try:
+            value = self.data[self.pos]
+        except IndexError:
+            raise SnapshotError('スナップショットが途中で切れています。')
+        self.pos += 1
+        return value
+
+    def uint(self):
+        result = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def sint(self):
+        value = self.uint()
+        return (value >> 1) ^ -(value & 1)
+
+    def raw(self, length):
+        end = self.pos + length
+        if end > len(self.data):
+            raise SnapshotError('スナップショットが途中で切れています。')
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def text(self):
+        return bytes(self.raw(self.uint())).decode('utf-8')
+
+    def ref(self, table):
+        index = self.byte()
+        if index == _STRING_INLINE:
+            return self.text()
+        return table[index]
+
+    def dice(self):
+        ref = self.byte()
+        if ref == _DICE_NONE:
+            return None
+        if ref == _DICE_INLINE:
+            probabilities = {}
+            for _ in range(self.uint()):
+                face = self.uint()
+                probabilities[face] = _FLOAT.unpack(self.raw(_FLOAT.size))[0]
+            return Dice(probabilities)
+        return Dice(dict(_DICE_CATALOGUE[ref - 1]))
+
+
+def _write_board(w, board):
+    w.uint(board.size)
+    positions = board.index.positions
+    w.uint(len(positions))
+    previous = 0
+    for position in positions:
+        event = board.events[position]
+        kind_id = _EVENT_IDS.get(event.kind)
+        if kind_id is None:
+            raise SnapshotError(f"保存できないイベントです: {event.name}")
+        w.uint(position - previous)
+        previous = position
+        # 上位4ビットにイベント番号、下位4ビットにマス数(14以上は続けて書く)。
+        # 迷路の名前のような文字列の引数は0x0Eの後に続けて書く
+        argument = event.argument()
+        if argument is None:
+            w.byte(kind_id << 4)
+        elif isinstance(argument, str):
+            w.byte(kind_id << 4 | _ARGUMENT_TEXT)
+            w.text(argument)
+        elif 0 < argument < _ARGUMENT_TEXT:
+            w.byte(kind_id << 4 | argument)
+        else:
+            w.byte(kind_id << 4 | _ARGUMENT_INT)
+            w.sint(argument)
+
+
+def _read_board(r):
+    board = Board(r.uint())
+    position = 0
+    for _ in range(r.uint()):
+        position += r.uint()
+        code = r.byte()
+        kind = EVENT_KINDS[code >> 4]
+        argument = code & 0x0F
+        if argument == _ARGUMENT_INT:
+            argument = r.sint()
+        elif argument == _ARGUMENT_TEXT:
+            argument = r.text()
+        board.add_event(position, make_event(kind, argument or None))
+    # 設定にある盤面と同じなら、作り直したものの代わりに共有の雛形を使う
+    return intern_board(board)
+
+
+def _write_player(w, player, index):
+    flags = 0
+    if player.needs_dice_selection:
+        flags |= _PLAYER_NEEDS_DICE
+    if player.is_in_monty_hall:
+        flags |= _PLAYER_MONTY_HALL
+    if player.monty_hall_state:
+        flags |= _PLAYER_MONTY_STATE
+    if player.is_in_maze:
+        flags |= _PLAYER_MAZE
+    if player.maze is not None:
+        flags |= _PLAYER_HAS_MAZE
+    if player.name != _default_name(index):
+        flags |= _PLAYER_CUSTOM_NAME
+    if player.is_cpu:
+        flags |= _PLAYER_CPU
+    w.byte(flags)
+    w.uint(player.position)
+    w.sint(player.total_distance)
+    w.ref(player.character, _CHARACTER_IDS)
+    w.dice(player.dice)
+    if flags & _PLAYER_CUSTOM_NAME:
+        w.text(player.name)
+    if flags & _PLAYER_MONTY_STATE:
+        # 扉番号(1〜3、未選択は0)を2ビットずつ詰める
+        state = player.monty_hall_state
+        w.byte(state.prize_door
+               | (state.player_choice or 0) << 2
+               | (state.opened_door or 0) << 4)
+    if flags & _PLAYER_HAS_MAZE:
+        maze = player.maze
+        node_ids = maze.graph.node_ids
+        w.ref(maze.graph.name, _MAZE_NAME_IDS)
+        w.uint(node_ids[maze.current_node] << 2 | maze.is_success | maze.is_finished << 1)
+        w.uint(len(maze.path_taken))
+        for node in maze.path_taken:
+            w.uint(node_ids[node])
+
+
+def _read_player(r, index):
+    flags = r.byte()
+    position = r.uint()
+    total_distance = r.sint()
+    character = r.ref(CHARACTERS)
+    dice = r.dice()
+    name = r.text() if flags & _PLAYER_CUSTOM_NAME else _default_name(index)
+    player = Player(name, character, bool(flags & _PLAYER_CPU))
+    player.position = position
+    player.total_distance = total_distance
+    player.dice = dice
+    player.needs_dice_selection = bool(flags & _PLAYER_NEEDS_DICE)
+    player.is_in_monty_hall = bool(flags & _PLAYER_MONTY_HALL)
+    player.is_in_maze = bool(flags & _PLAYER_MAZE)
+    if flags & _PLAYER_MONTY_STATE:
+        packed = r.byte()
+        player.monty_hall_state = MontyHallState(
+            packed & 0x03,
+            (packed >> 2 & 0x03) or None,
+            (packed >> 4 & 0x03) or None,
+        )
+    if flags & _PLAYER_HAS_MAZE:
+        graph = maze_graph(r.ref(MAZE_NAMES))
+        nodes = graph.nodes
+        packed = r.uint()
+        maze = ProbabilityMaze(graph)
+        maze.current_node = nodes[packed >> 2]
+        maze.is_success = bool(packed & 0x01)
+        maze.is_finished = bool(packed & 0x02)
+        maze.path_taken = [nodes[r.uint()] for _ in range(r.uint())]
+        player.maze = maze
+    return player
+
+
+def _default_name(index):
+    return f"プレイヤー{index + 1}"
+
+
+def dumps(game):
+    w = _Writer()
+    w.buf += MAGIC
+    w.byte(FORMAT_VERSION)
+    flags = 0
+    if game.is_over:
+        flags |= _GAME_OVER
+    if game.is_slot_event_active:
+        flags |= _GAME_SLOT_ACTIVE
+    if game.slot_trigger_player_index is not None:
+        flags |= _GAME_SLOT
+    w.byte(flags)
+    w.uint(game.max_turns)
+    w.uint(game.current_turn)
+    w.uint(game.current_player_index)
+    w.uint(game.version)
+    w.text(game.seed)
+    w.dice(game.dice)
+    _write_board(w, game.board)
+    w.uint(len(game.players))
+    for i, player in enumerate(game.players):
+        _write_player(w, player, i)
+    if flags & _GAME_SLOT:
+        w.uint(len(game.slot_order))
+        for index in game.slot_order:
+            w.uint(index)
+        w.uint(game.slot_trigger_player_index)
+        # slot_resultsはプレイヤー名をキーにしているので、名前の代わりに番号を書く
+        names = [player.name for player in game.players]
+        w.uint(len(game.slot_results))
+        for name, message in game.slot_results.items():
+            w.uint(names.index(name))
+            w.text(message)
+    return bytes(w.buf)
+
+
+def loads(blob):
+    r = _Reader(memoryview(blob))
+    if bytes(r.raw(1)) != MAGIC:
+        raise SnapshotError('スナップショットではありません。')
+    version = r.byte()
+    if version != FORMAT_VERSION:
+        raise SnapshotError(f"対応していない形式の版です: {version}")
+    flags = r.byte()
+    max_turns = r.uint()
+    current_turn = r.uint()
+    current_player_index = r.uint()
+    state_version = r.uint()
+    seed = r.text()
+    dice = r.dice()
+    board = _read_board(r)
+    players = [_read_player(r, i) for i in range(r.uint())]
+
+    game = Game(players, board, dice, max_turns=max_turns, seed=seed)
+    game.history = None
+    game.current_turn = current_turn
+    game.current_player_index = current_player_index
+    game.version = state_version
+    game.is_over = bool(flags & _GAME_OVER)
+    game.is_slot_event_active = bool(flags & _GAME_SLOT_ACTIVE)
+    if flags & _GAME_SLOT:
+        game.slot_order = [r.uint() for _ in range(r.uint())]
+        game.slot_trigger_player_index = r.uint()
+        for _ in range(r.uint()):
+            name = players[r.uint()].name
+            game.slot_results[name] = r.text()
+    return game
@@ -6,6 +6,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const gameArea = document.getElementById('game_area');
     const startGameButton = document.getElementById('start_game_button');
     const numPlayersSelect = document.getElementById('num_players');
+    const boardSelect = document.getElementById('board_select');
     const messageArea = document.getElementById('message_area');
     const playerInfoDiv = document.getElementById('player_info');
     const nextTurnButton = document.getElementById('next_turn_button');
@@ -60,6 +61,28 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentPlayerIndex = 0;
     let isGameOver = false;
     let diceChart = null;
+    // サーバーが発行したゲームID。すべてのAPI呼び出しに付与する
+    let gameId = null;
+    // 最後に反映した状態とその版
+    let lastVersion = 0;
+    let lastState = null;
+    // ゲーム中に変わらない情報は一度だけ取得して使い回す
+    // 盤面の配置(/get_board_layout)。ゲーム中は変わらないので一度だけ取得する
+    let boardLayout = null;
+    let boardLayoutRequest = null;
+    // マスとイベントの記号を描いておく画面外のキャンバス。以後はコマだけを描き直す
+    let boardLayer = null;
+    // 最後に描いたコマのマス(プレイヤーの番号順)
+    let drawnPositions = null;
+    // キャラクターの画像は一度だけ読み込む
+    const avatarImages = {};
+    let diceOptions = null;
+    let slotOptions = null;
+    let eventSource = null;
+
+    function withGameId(url) {
+        return `${url}?game_id=${encodeURIComponent(gameId)}`;
+    }
 
     // === 変更開始: イベント解説文マッピング ===
     const eventExplanations = {
@@ -103,11 +126,22 @@ document.addEventListener('DOMContentLoaded', () => {
         characterSelects.forEach(select => {
             selectedCharacters.push(select.value);
         });
+        const cpuPlayers = [];
+        document.querySelectorAll('.cpu-checkbox').forEach((checkbox, index) => {
+            if (checkbox.checked) {
+                cpuPlayers.push(index);
+            }
+        });
 
         fetch('/start_game', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ num_players: numPlayers, characters: selectedCharacters })
+            body: JSON.stringify({
+                num_players: numPlayers,
+                characters: selectedCharacters,
+                cpu_players: cpuPlayers,
+                board: boardSelect.value || undefined
+            })
         })
         .then(response => {
             hideLoading();
@@ -121,12 +155,7 @@ document.addEventListener('DOMContentLoaded', () => {
             return response.json();
         })
         .then(data => {
-            setupDiv.style.display = 'none';
-            gameArea.style.display = 'block';
-            appendMessage(data.message);
-            getGameState().then(() => {
-                nextPlayerTurn();
-            });
+            enterGame(data.game_id, data.message);
         })
         .catch(error => {
             hideLoading();
@@ -135,6 +164,25 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     });
 
+    // 作ったゲーム、または参加するゲーム(/?game=ゲームID、トーナメントの対戦など)の画面に切り替える
+    function enterGame(id, message) {
+        gameId = id;
+        lastVersion = 0;
+        boardLayout = null;
+        boardLayoutRequest = null;
+        boardLayer = null;
+        drawnPositions = null;
+        setupDiv.style.display = 'none';
+        gameArea.style.display = 'block';
+        appendMessage(message);
+        updateDiceProbabilities();
+        fetchEventDescriptions();
+        openEventStream();
+        getGameState().then(() => {
+            nextPlayerTurn();
+        });
+    }
+
     nextTurnButton.addEventListener('click', () => {
         if (isGameOver) {
             appendMessage("ゲームは終了しました。");
@@ -148,7 +196,9 @@ document.addEventListener('DOMContentLoaded', () => {
     rollDiceButton.addEventListener('click', () => {
         showLoading();
         fetch('/roll_dice', {
-            method: 'POST'
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ game_id: gameId, since: lastVersion })
         })
         .then(response => {
             hideLoading();
@@ -162,18 +212,13 @@ document.addEventListener('DOMContentLoaded', () => {
             return response.json();
         })
         .then(data => {
-            appendMessage(data.message);
-            currentPlayerIndex = data.current_player_index;
-            isGameOver = data.is_over;
-            updatePlayerInfo(data.players);
-            updateDiceProbabilities();
-            updateGameBoard(data.players);
+            // 応答に更新後の状態が含まれているので、追加の問い合わせは不要
+            applyUpdate(data);
 
             rollDiceButton.disabled = true;
             nextTurnButton.disabled = false;
 
-            // サイコロ振った後ゲーム状態再取得
-            getGameState().then(() => {});
+            handlePendingEvent(data);
         })
         .catch(error => {
             hideLoading();
@@ -200,12 +245,20 @@ document.addEventListener('DOMContentLoaded', () => {
         loadingIndicator.style.display = 'none';
     }
     function appendMessage(message) {
+        // メッセージにはプレイヤーの名前が入るので、HTMLとしては扱わない
         const p = document.createElement('p');
-        p.innerHTML = message;
+        p.textContent = message;
         messageArea.appendChild(p);
         messageArea.scrollTop = messageArea.scrollHeight;
     }
 
+    // HTMLの文字列に埋め込む文字をエスケープする
+    function escapeHtml(text) {
+        return String(text).replace(/[&<>"']/g, c => ({
+            '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+        })[c]);
+    }
+
     // サイコロの分数表示用関数
     function toFraction(decimal) {
         const denominator = 6;
@@ -215,7 +268,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // ゲーム状態を取得
     function getGameState() {
-        return fetch('/get_game_state')
+        return fetch(withGameId('/get_game_state'))
         .then(response => {
             hideLoading();
             if (!response.ok) {
@@ -228,30 +281,8 @@ document.addEventListener('DOMContentLoaded', () => {
             return response.json();
         })
         .then(data => {
-            currentPlayerIndex = data.current_player_index;
-            isGameOver = data.is_over;
-            updatePlayerInfo(data.players);
-            updateDiceProbabilities();
-            updateGameBoard(data.players);
-            fetchEventDescriptions();
-
-            // イベント優先度: MontyHall > Maze > DiceSelection > Slot
-            const player = data.players[currentPlayerIndex];
-            if (player.is_in_monty_hall) {
-                handleMontyHallEvent(player);
-                return;
-            }
-            if (player.is_in_maze) {
-                handleMazeEvent(player);
-                return;
-            }
-            if (player.needs_dice_selection) {
-                handleDiceSelectionEvent(player);
-                return;
-            }
-            if (data.is_slot_event_active) {
-                handleSlotEvent();
-            }
+            applyState(data);
+            handlePendingEvent(data);
         })
         .catch(error => {
             hideLoading();
@@ -260,6 +291,116 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // 操作の応答、またはサーバーからの配信で受け取った更新を反映する
+    // 同じ更新が応答と配信の両方で届くので、版で二重反映を防ぐ
+    function applyUpdate(data) {
+        if (data.version !== undefined && data.version <= lastVersion) {
+            return false;
+        }
+        if (data.message) {
+            appendMessage(data.message);
+        }
+        // エラー応答には状態が含まれない
+        if (!data.players) {
+            return true;
+        }
+        if (data.since !== undefined && data.since > lastVersion) {
+            // 手元に無い版からの差分なので、全体を取り直す
+            getGameState();
+            return true;
+        }
+        applyState(data);
+        return true;
+    }
+
+    function applyState(data) {
+        // sinceを含む応答は変わった項目だけなので、手元の状態に重ねる
+        let state = data;
+        if (data.since !== undefined && lastState) {
+            state = Object.assign({}, lastState, data);
+            state.players = lastState.players.map(player => Object.assign({}, player));
+            data.players.forEach(changed => {
+                Object.assign(state.players[changed.index], changed);
+            });
+        }
+        lastState = state;
+        lastVersion = state.version;
+        currentPlayerIndex = state.current_player_index;
+        isGameOver = state.is_over;
+        updatePlayerInfo(state.players);
+        updateGameBoard(state.players);
+    }
+
+    function handlePendingEvent(data) {
+        if (!data.players || !lastState) {
+            return;
+        }
+        // イベント優先度: MontyHall > Maze > DiceSelection > Slot
+        const player = lastState.players[currentPlayerIndex];
+        if (player.is_in_monty_hall) {
+            handleMontyHallEvent(player);
+            return;
+        }
+        if (player.is_in_maze) {
+            handleMazeEvent(player);
+            return;
+        }
+        if (player.needs_dice_selection) {
+            handleDiceSelectionEvent(player);
+            return;
+        }
+        if (lastState.is_slot_event_active) {
+            handleSlotEvent();
+        }
+    }
+
+    // 同じゲームを見ている他のクライアントの操作もサーバーから配信される
+    function openEventStream() {
+        if (eventSource) {
+            eventSource.close();
+            eventSource = null;
+        }
+        if (!window.EventSource) {
+            return;
+        }
+        eventSource = new EventSource(withGameId('/events'));
+        eventSource.addEventListener('update', (event) => {
+            applyUpdate(JSON.parse(event.data));
+        });
+    }
+
+    // 観戦モード(/?watch=ゲームID)。操作はせず、/spectateの配信だけで画面を更新する。
+    // 最初と、配信に追いつけなかったときには状態全体(state)が届く
+    function startSpectating(watchId) {
+        gameId = watchId;
+        lastVersion = 0;
+        lastState = null;
+        setupDiv.style.display = 'none';
+        gameArea.style.display = 'block';
+        rollDiceButton.style.display = 'none';
+        nextTurnButton.style.display = 'none';
+        appendMessage('観戦モードです。');
+        updateDiceProbabilities();
+        fetchEventDescriptions();
+        if (!window.EventSource) {
+            appendMessage('このブラウザは観戦に対応していません。');
+            return;
+        }
+        eventSource = new EventSource(withGameId('/spectate'));
+        eventSource.addEventListener('state', (event) => {
+            const data = JSON.parse(event.data);
+            if (data.version >= lastVersion) {
+                applyState(data);
+            }
+        });
+        eventSource.addEventListener('update', (event) => {
+            // 状態全体が届くまでの差分は、その状態に含まれている
+            if (lastState) {
+                applyUpdate(JSON.parse(event.data));
+            }
+        });
+    }
+
     function updatePlayerInfo(players) {
         playerInfoDiv.innerHTML = '';
         players.forEach((player, index) => {
@@ -273,14 +414,20 @@ document.addEventListener('DOMContentLoaded', () => {
             img.height = 50;
 
             const nameP = document.createElement('p');
-            nameP.textContent = player.name;
+            nameP.textContent = player.is_cpu ? `${player.name}（CPU）` : player.name;
             if (index === currentPlayerIndex) {
                 nameP.style.fontWeight = 'bold';
                 nameP.style.color = 'red';
             }
-            const remainingSteps = 39 - player.position;
             const stepsP = document.createElement('p');
-            stepsP.textContent = `ループ地点までのマス数: ${remainingSteps}`;
+            // 盤面の大きさは配置が届いてから分かる。届くまでは数を出さない
+            if (boardLayout) {
+                const size = boardLayout.size;
+                const remainingSteps = size - 1 - (((player.position % size) + size) % size);
+                stepsP.textContent = `ループ地点までのマス数: ${remainingSteps}`;
+            } else {
+                stepsP.textContent = 'ループ地点までのマス数: -';
+            }
 
             div.appendChild(img);
             div.appendChild(nameP);
@@ -290,7 +437,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function updateDiceProbabilities() {
-        fetch('/get_dice_probabilities')
+        fetch(withGameId('/get_dice_probabilities'))
         .then(response => {
             hideLoading();
             if (!response.ok) {
@@ -378,7 +525,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function fetchEventDescriptions() {
-        fetch('/get_event_descriptions')
+        fetch(withGameId('/get_event_descriptions'))
         .then(response => {
             hideLoading();
             if (!response.ok) {
@@ -417,123 +564,177 @@ document.addEventListener('DOMContentLoaded', () => {
             rollDiceButton.disabled = true;
             return;
         }
-        fetch('/get_game_state')
-        .then(response => {
-            hideLoading();
-            if (!response.ok) {
-                return response.json().then(errorData => {
-                    throw new Error(errorData.message || 'サーバーエラー');
-                }).catch(() => {
-                    throw new Error('サーバーエラー');
-                });
-            }
-            return response.json();
-        })
-        .then(data => {
-            currentPlayerIndex = data.current_player_index;
-            const playerName = data.players[currentPlayerIndex].name;
-            appendMessage(`${playerName}さんのターンです。サイコロを振ってください。`);
-            rollDiceButton.disabled = false;
-            nextTurnButton.disabled = true;
-            updatePlayerInfo(data.players);
-        })
-        .catch(error => {
-            hideLoading();
-            console.error('Error:', error);
-            appendMessage(`次のターンへの移行中にエラーが発生しました：${error.message}`);
-        });
+        const playerName = lastState.players[currentPlayerIndex].name;
+        appendMessage(`${playerName}さんのターンです。サイコロを振ってください。`);
+        rollDiceButton.disabled = false;
+        nextTurnButton.disabled = true;
+        updatePlayerInfo(lastState.players);
     }
 
+    const CELL_SIZE = 70;
+    const TOKEN_SIZE = 24;
+
+    // イベントの種類ごとのマスの色
+    const eventColors = {
+        forward: '#d1e7dd',
+        backward: '#f8d7da',
+        dice_selection: '#fff3cd',
+        maze: '#cfe2ff',
+        monty_hall: '#e2e3e5',
+        slot_machine: '#f5e6ff'
+    };
+
     function updateGameBoard(players) {
-        const cellSize = 70;
-        const cols = 10;
-        const rows = 4;
-        ctx.clearRect(0, 0, gameBoard.width, gameBoard.height);
+        if (boardLayer) {
+            drawTokens(players);
+            return;
+        }
+        // 盤面の配置は最初の一度だけ取得し、届いたら最新の状態でコマを描く
+        if (!boardLayoutRequest) {
+            boardLayoutRequest = fetch(withGameId('/get_board_layout'))
+            .then(response => {
+                if (!response.ok) {
+                    return response.json().then(errorData => {
+                        throw new Error(errorData.message || 'サーバーエラー');
+                    }).catch(() => {
+                        throw new Error('サーバーエラー');
+                    });
+                }
+                return response.json();
+            })
+            .then(data => {
+                boardLayout = data;
+                drawBoardLayer();
+                drawTokens(lastState ? lastState.players : players);
+                updatePlayerInfo(lastState ? lastState.players : players);
+            })
+            .catch(error => {
+                // 次の更新でもう一度取りにいく
+                boardLayoutRequest = null;
+                console.error('Error:', error);
+                appendMessage(`ゲームボードの更新中にエラーが発生しました：${error.message}`);
+            });
+        }
+    }
 
-        fetch('/get_event_positions')
-        .then(response => {
-            hideLoading();
-            if (!response.ok) {
-                return response.json().then(errorData => {
-                    throw new Error(errorData.message || 'サーバーエラー');
-                }).catch(() => {
-                    throw new Error('サーバーエラー');
-                });
+    function cellOrigin(position) {
+        const cell = boardLayout.cells[position];
+        return { x: cell[0] * CELL_SIZE, y: cell[1] * CELL_SIZE };
+    }
+
+    // マスとイベントを画面外のキャンバスに一度だけ描き、画面に写す
+    function drawBoardLayer() {
+        const width = boardLayout.columns * CELL_SIZE;
+        const height = boardLayout.rows * CELL_SIZE;
+        boardLayer = document.createElement('canvas');
+        boardLayer.width = width;
+        boardLayer.height = height;
+        const layer = boardLayer.getContext('2d');
+
+        const events = {};
+        boardLayout.events.forEach(e => {
+            events[e.position] = e;
+        });
+        for (let i = 0; i < boardLayout.size; i++) {
+            const { x, y } = cellOrigin(i);
+            const event = events[i];
+            layer.fillStyle = event ? (eventColors[event.kind] || 'white') : 'white';
+            layer.fillRect(x, y, CELL_SIZE, CELL_SIZE);
+            layer.strokeStyle = 'black';
+            layer.strokeRect(x, y, CELL_SIZE, CELL_SIZE);
+            layer.fillStyle = 'black';
+            layer.font = '12px Arial';
+            layer.textAlign = 'left';
+            layer.fillText(i, x + 5, y + 15);
+            if (event) {
+                layer.font = 'bold 14px Arial';
+                layer.textAlign = 'right';
+                layer.fillText(event.glyph, x + CELL_SIZE - 5, y + 16);
             }
-            return response.json();
-        })
-        .then(data => {
-            const eventPositions = data.event_positions;
-            for (let i = 0; i < 40; i++) {
-                const row = Math.floor(i / cols);
-                let col = i % cols;
-                if (row % 2 === 1) {
-                    col = cols - 1 - col;
-                }
+        }
 
-                const x = col * cellSize;
-                const y = row * cellSize;
-                ctx.strokeStyle = 'black';
-                ctx.strokeRect(x, y, cellSize, cellSize);
-
-                const eventCell = eventPositions.find(e => e.position === i);
-                if (eventCell) {
-                    switch (eventCell.event_name) {
-                        case '2マス進む':
-                        case '5マス進む':
-                            ctx.fillStyle = '#d1e7dd';
-                            break;
-                        case '3マス戻る':
-                        case '4マス戻る':
-                            ctx.fillStyle = '#f8d7da';
-                            break;
-                        case 'サイコロ選択':
-                            ctx.fillStyle = '#fff3cd';
-                            break;
-                        case '確率の迷路':
-                            ctx.fillStyle = '#cfe2ff';
-                            break;
-                        case 'モンティ・ホールの挑戦':
-                            ctx.fillStyle = '#e2e3e5';
-                            break;
-                        case '全員参加スロットイベント':
-                            ctx.fillStyle = '#f5e6ff';
-                            break;
-                        default:
-                            ctx.fillStyle = 'white';
-                    }
-                    ctx.fillRect(x, y, cellSize, cellSize);
-                } else {
-                    ctx.fillStyle = 'white';
-                    ctx.fillRect(x, y, cellSize, cellSize);
+        // キャンバスの大きさを変えると内容は消える
+        gameBoard.width = width;
+        gameBoard.height = height;
+        ctx.drawImage(boardLayer, 0, 0);
+        drawnPositions = null;
+    }
+
+    function avatarImage(character) {
+        let img = avatarImages[character];
+        if (!img) {
+            img = new Image();
+            img.onload = () => {
+                // 読み込みが終わる前に描こうとしたマスを描き直す
+                if (boardLayer && lastState) {
+                    drawnPositions = null;
+                    drawTokens(lastState.players);
                 }
-                ctx.fillStyle = 'black';
-                ctx.font = '12px Arial';
-                ctx.fillText(i, x + 5, y + 15);
+            };
+            img.src = `/static/images/avatars/${character}`;
+            avatarImages[character] = img;
+        }
+        return img;
+    }
+
+    // 1マス分を静止レイヤーから写し直し、そのマスにいるコマを描く。
+    // 同じマスのコマが重ならないよう、プレイヤーの番号で置く場所を分ける
+    function paintCell(position, players, positions) {
+        const { x, y } = cellOrigin(position);
+        ctx.drawImage(boardLayer, x, y, CELL_SIZE, CELL_SIZE, x, y, CELL_SIZE, CELL_SIZE);
+        players.forEach((player, index) => {
+            if (positions[index] !== position) {
+                return;
+            }
+            const img = avatarImage(player.character);
+            if (!img.complete || !img.naturalWidth) {
+                return;
             }
+            const slot = index % 4;
+            const tx = x + 8 + (slot % 2) * (TOKEN_SIZE + 6);
+            const ty = y + 20 + Math.floor(slot / 2) * (TOKEN_SIZE + 2);
+            ctx.drawImage(img, tx, ty, TOKEN_SIZE, TOKEN_SIZE);
+        });
+    }
 
-            players.forEach((player, index) => {
-                const position = player.position;
-                const row = Math.floor(position / cols);
-                let col = position % cols;
-                if (row % 2 === 1) {
-                    col = cols - 1 - col;
+    // 前回から動いたコマのマス(動く前と後)だけを描き直す
+    function drawTokens(players) {
+        const size = boardLayout.size;
+        const positions = players.map(player => ((player.position % size) + size) % size);
+        const dirty = new Set();
+        positions.forEach((position, index) => {
+            const previous = drawnPositions && drawnPositions.length === positions.length
+                ? drawnPositions[index] : undefined;
+            if (previous !== position) {
+                dirty.add(position);
+                if (previous !== undefined) {
+                    dirty.add(previous);
                 }
-                const x = col * cellSize + cellSize / 2;
-                const y = row * cellSize + cellSize / 2;
-                let img = new Image();
-                img.src = `/static/images/avatars/${player.character}`;
-                img.onload = function() {
-                    ctx.drawImage(img, x - 15, y - 15, 30, 30);
-                };
+            }
+        });
+        dirty.forEach(position => paintCell(position, players, positions));
+        drawnPositions = positions;
+    }
+
+    // 選べる盤面の一覧を読み込む。失敗しても標準の盤面で遊べる
+    function loadBoardOptions() {
+        fetch('/get_boards')
+        .then(response => response.json())
+        .then(data => {
+            boardSelect.innerHTML = '';
+            data.boards.forEach(board => {
+                const option = document.createElement('option');
+                option.value = board.name;
+                option.textContent = `${board.title}(${board.size}マス)`;
+                option.selected = board.name === data.default;
+                boardSelect.appendChild(option);
             });
         })
         .catch(error => {
-            hideLoading();
             console.error('Error:', error);
-            appendMessage(`ゲームボードの更新中にエラーが発生しました：${error.message}`);
         });
     }
+    loadBoardOptions();
 
     function updateCharacterSelection() {
         const numPlayers = parseInt(numPlayersSelect.value);
@@ -555,8 +756,17 @@ document.addEventListener('DOMContentLoaded', () => {
                 select.appendChild(option);
             });
 
+            // コンピューターに任せる席はサーバーが操作する
+            const cpuLabel = document.createElement('label');
+            const cpuCheckbox = document.createElement('input');
+            cpuCheckbox.type = 'checkbox';
+            cpuCheckbox.classList.add('cpu-checkbox');
+            cpuLabel.appendChild(cpuCheckbox);
+            cpuLabel.appendChild(document.createTextNode('コンピューター'));
+
             characterSelectionDiv.appendChild(label);
             characterSelectionDiv.appendChild(select);
+            characterSelectionDiv.appendChild(cpuLabel);
             characterSelectionDiv.appendChild(document.createElement('br'));
         }
     }
@@ -586,7 +796,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function handleMontyHallEvent(player) {
         if (!player.is_in_monty_hall) return;
         montyHallContent.innerHTML = `
-            <p>${player.name}はモンティ・ホールの挑戦に挑みます。</p>
+            <p>${escapeHtml(player.name)}はモンティ・ホールの挑戦に挑みます。</p>
             <p>1〜3の扉から1つを選んでください。</p>
             <button id="monty_choice_1">扉1</button>
             <button id="monty_choice_2">扉2</button>
@@ -601,18 +811,18 @@ document.addEventListener('DOMContentLoaded', () => {
         fetch('/monty_hall_choice', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ choice: choice })
+            body: JSON.stringify({ game_id: gameId, since: lastVersion, choice: choice })
         })
         .then(response => response.json())
         .then(data => {
-            appendMessage(data.message);
+            applyUpdate(data);
             montyHallContent.innerHTML = '';
             // イベント終了の文字列を検知して解説表示
             if (data.message.includes('おめでとうございます') || data.message.includes('残念！ハズレ')) {
                 showEventExplanation("MontyHall"); // ここで解説を表示
             }
             montyHallModal.style.display = 'none';
-            getGameState();
+            handlePendingEvent(data);
         })
         .catch(error => {
             console.error('Error:', error);
@@ -623,10 +833,10 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- 迷路 ---
     function handleMazeEvent(player) {
         if (!player.is_in_maze) return;
-        fetch('/maze_progress', { method: 'GET' })
+        fetch(withGameId('/maze_progress'), { method: 'GET' })
         .then(response => response.json())
         .then(data => {
-            mazeContent.innerHTML = `<p>${data.message}</p>`;
+            mazeContent.innerHTML = `<p>${escapeHtml(data.message)}</p>`;
             data.choices.forEach(choice => {
                 mazeContent.innerHTML += `
                     <button class="maze-choice" data-index="${choice.index}">
@@ -651,17 +861,17 @@ document.addEventListener('DOMContentLoaded', () => {
         fetch('/maze_progress', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ choice_index: choiceIndex })
+            body: JSON.stringify({ game_id: gameId, since: lastVersion, choice_index: choiceIndex })
         })
         .then(response => response.json())
         .then(data => {
-            appendMessage(data.message);
+            applyUpdate(data);
             // イベント終了ワード
             if (data.message.includes('迷路を突破') || data.message.includes('迷路で迷い')) {
                 showEventExplanation("Maze");
             }
             mazeModal.style.display = 'none';
-            getGameState();
+            handlePendingEvent(data);
         })
         .catch(error => {
             console.error('Error:', error);
@@ -672,10 +882,13 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- サイコロ選択 ---
     function handleDiceSelectionEvent(player) {
         if (!player.needs_dice_selection) return;
-        fetch('/get_dice_options')
-        .then(response => response.json())
+        // サイコロの一覧は変わらないので、一度取得したら使い回す
+        const optionsRequest = diceOptions
+            ? Promise.resolve(diceOptions)
+            : fetch('/get_dice_options').then(response => response.json()).then(data => (diceOptions = data));
+        optionsRequest
         .then(data => {
-            diceSelectionContent.innerHTML = `<p>${player.name}はサイコロを選択できます。以下から1つを選んでください。</p>`;
+            diceSelectionContent.innerHTML = `<p>${escapeHtml(player.name)}はサイコロを選択できます。以下から1つを選んでください。</p>`;
             data.dice_options.forEach((diceOption, index) => {
                 let probText = "";
                 if (diceOption.probabilities && Object.keys(diceOption.probabilities).length > 0) {
@@ -713,11 +926,11 @@ document.addEventListener('DOMContentLoaded', () => {
         fetch('/select_dice', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ dice_index: diceIndex })
+            body: JSON.stringify({ game_id: gameId, since: lastVersion, dice_index: diceIndex })
         })
         .then(response => response.json())
         .then(data => {
-            appendMessage(data.message);
+            applyUpdate(data);
             // イベント終了とみなして解説表示
             showEventExplanation("DiceSelection");
 
@@ -732,8 +945,10 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- スロットイベント ---
     function handleSlotEvent() {
-        fetch('/get_slot_options')
-        .then(response => response.json())
+        const optionsRequest = slotOptions
+            ? Promise.resolve(slotOptions)
+            : fetch('/get_slot_options').then(response => response.json()).then(data => (slotOptions = data));
+        optionsRequest
         .then(data => {
             slotSelectionContent.innerHTML = "<p>スロットを選んでください。</p>";
             data.slot_options.forEach(slotOption => {
@@ -763,17 +978,17 @@ document.addEventListener('DOMContentLoaded', () => {
         fetch('/spin_slot', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ slot_index: slotIndex })
+            body: JSON.stringify({ game_id: gameId, since: lastVersion, slot_index: slotIndex })
         })
         .then(response => response.json())
         .then(data => {
-            appendMessage(data.message);
+            applyUpdate(data);
             // 全員スロット終了が含まれるなら解説を表示
             if (data.message.includes('全員スロット終了')) {
                 showEventExplanation("SlotMachine");
             }
             slotSelectionModal.style.display = 'none';
-            getGameState();
+            handlePendingEvent(data);
         })
         .catch(error => {
             console.error('Error:', error);
@@ -801,4 +1016,13 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     updateCharacterSelection();
+
+    const params = new URLSearchParams(window.location.search);
+    const watchId = params.get('watch');
+    const joinId = params.get('game');
+    if (watchId) {
+        startSpectating(watchId);
+    } else if (joinId) {
+        enterGame(joinId, 'ゲームに参加しました。');
+    }
 });
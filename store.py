@@ -0,0 +1,248 @@
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class VersionConflict(Exception):
+    """保存しようとした版が、ストア上の版と一致しなかったときに送出する。"""
+
+
+class MemoryStore:
+    """プロセス内の辞書に保存するストア。単一ワーカーや動作確認用。"""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, game_id, known_version=0):
+        # (版, データ) を返す。版がknown_versionと同じならデータはNone
+        with self._lock:
+            entry = self._data.get(game_id)
+            if entry is None:
+                return None
+            version, blob, updated_at = entry
+            if self.ttl is not None and time.time() - updated_at > self.ttl:
+                del self._data[game_id]
+                return None
+        return version, (None if version == known_version else blob)
+
+    def save(self, game_id, blob, expected_version):
+        with self._lock:
+            entry = self._data.get(game_id)
+            current = entry[0] if entry else 0
+            if current != expected_version:
+                raise VersionConflict(game_id)
+            self._data[game_id] = (current + 1, blob, time.time())
+            return current + 1
+
+    def delete(self, game_id):
+        with self._lock:
+            self._data.pop(game_id, None)
+
+
+class SQLiteStore:
+    """SQLiteファイルに保存するストア。同じホスト上の複数ワーカーで共有できる。"""
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS games ('
+            ' game_id TEXT PRIMARY KEY,'
+            ' version INTEGER NOT NULL,'
+            ' data BLOB NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS games_updated_at ON games (updated_at)')
+
+    def _connection(self):
+        # sqlite3の接続はスレッドをまたいで使えないため、スレッドごとに開く
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, game_id, known_version=0):
+        row = self._connection().execute(
+            'SELECT version, CASE WHEN version = ? THEN NULL ELSE data END, updated_at'
+            ' FROM games WHERE game_id = ?',
+            (known_version, game_id),
+        ).fetchone()
+        if row is None:
+            return None
+        version, blob, updated_at = row
+        if self.ttl is not None and time.time() - updated_at > self.ttl:
+            self.delete(game_id)
+            return None
+        return version, blob
+
+    def save(self, game_id, blob, expected_version):
+        conn = self._connection()
+        now = time.time()
+        if expected_version == 0:
+            try:
+                conn.execute(
+                    'INSERT INTO games (game_id, version, data, updated_at) VALUES (?, 1, ?, ?)',
+                    (game_id, blob, now),
+                )
+            except sqlite3.IntegrityError:
+                raise VersionConflict(game_id)
+            self.purge_expired()
+            return 1
+        cursor = conn.execute(
+            'UPDATE games SET version = version + 1, data = ?, updated_at = ?'
+            ' WHERE game_id = ? AND version = ?',
+            (blob, now, game_id, expected_version),
+        )
+        if cursor.rowcount == 0:
+            raise VersionConflict(game_id)
+        return expected_version + 1
+
+    def delete(self, game_id):
+        self._connection().execute('DELETE FROM games WHERE game_id = ?', (game_id,))
+
+    def purge_expired(self):
+        if self.ttl is None:
+            return 0
+        cursor = self._connection().execute(
+            'DELETE FROM games WHERE updated_at < ?', (time.time() - self.ttl,)
+        )
+        return cursor.rowcount
+
+
+# 版の比較と書き込みをサーバー側で一度に行うためのLuaスクリプト
+_REDIS_LOAD = """
+local v = redis.call('HGET', KEYS[1], 'v')
+if not v then return nil end
+if v == ARGV[1] then return {v} end
+return {v, redis.call('HGET', KEYS[1], 'd')}
+"""
+
+_REDIS_SAVE = """
+local v = redis.call('HGET', KEYS[1], 'v') or '0'
+if v ~= ARGV[1] then return -1 end
+local nv = tonumber(v) + 1
+redis.call('HSET', KEYS[1], 'v', nv, 'd', ARGV[2])
+if tonumber(ARGV[3]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[3]) end
+return nv
+"""
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisStore:
+    """Redisプロトコル(RESP)を話すサーバーに保存するストア。
+
+    redis-pyには依存せず、最低限のRESPクライアントを内蔵している。
+    Redis互換サーバー(KeyDB、Valkeyなど)をそのまま使える。
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, ttl=None,
+                 prefix='sugoroku:game:'):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.ttl = ttl
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port))
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            if self.password:
+                self._command('AUTH', self.password)
+            if self.db:
+                self._command('SELECT', self.db)
+        return conn
+
+    def _command(self, *args):
+        sock, reader = self._connection()
+        try:
+            sock.sendall(encode_command(args))
+            return read_reply(reader)
+        except (OSError, EOFError):
+            # 切断された接続は捨て、次回の呼び出しで張り直す
+            self._local.conn = None
+            raise
+
+    def load(self, game_id, known_version=0):
+        reply = self._command('EVAL', _REDIS_LOAD, 1, self.prefix + game_id, known_version)
+        if reply is None:
+            return None
+        version = int(reply[0])
+        return version, (reply[1] if len(reply) > 1 else None)
+
+    def save(self, game_id, blob, expected_version):
+        reply = self._command('EVAL', _REDIS_SAVE, 1, self.prefix + game_id,
+                              expected_version, blob, int(self.ttl or 0))
+        if reply == -1:
+            raise VersionConflict(game_id)
+        return reply
+
+    def delete(self, game_id):
+        self._command('DEL', self.prefix + game_id)
+
+
+def encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        else:
+            data = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError('Redisとの接続が切れました。')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        raise RedisError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        count = int(rest)
+        if count < 0:
+            return None
+        return [read_reply(reader) for _ in range(count)]
+    raise RedisError(f"不明な応答です: {line!r}")
+
+
+def open_store(url, ttl=None):
+    """URLからストアを作る。memory:// / sqlite:///path / redis://host:port/db"""
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryStore(ttl=ttl)
+    if parsed.scheme == 'sqlite':
+        # sqlite:///相対パス、sqlite:////絶対パス
+        return SQLiteStore(parsed.path[1:], ttl=ttl)
+    if parsed.scheme == 'redis':
+        db = int(parsed.path[1:]) if parsed.path[1:] else 0
+        return RedisStore(parsed.hostname or 'localhost', parsed.port or 6379, db=db,
+                          password=parsed.password, ttl=ttl)
+    raise ValueError(f"対応していないストアです: {url}")
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のモジュールを読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from game_logic import Dice, Game, Player, PREDEFINED_DICE_OPTIONS, build_default_board  # noqa: E402
+
+
+def new_game(num_players=2, max_turns=30, seed=None):
+    players = [Player(f"プレイヤー{i + 1}", f"avatar{i + 1}.png") for i in range(num_players)]
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    game = Game(players, build_default_board(), dice, max_turns=max_turns, seed=seed)
+    game.start()
+    return game
+
+
+@pytest.fixture
+def client():
+    import app
+    return app.app.test_client()
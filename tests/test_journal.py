@@ -0,0 +1,63 @@
+import pytest
+
+import actions
+import snapshot
+from conftest import new_game
+from journal import GameJournal, JournalError
+
+
+def _crash(journal):
+    # closeせずにプロセスが落ちたのと同じく、fsyncも後片付けもしない
+    journal._closed.set()
+    journal._lock_file.close()
+
+
+def _play(journal, game_id, game, steps):
+    for _ in range(steps):
+        decision, _ = actions.pending_decision(game)
+        if decision is None:
+            return
+        action = {
+            'roll_dice': {'type': 'roll_dice'},
+            'select_dice': {'type': 'select_dice', 'dice_index': 0},
+            'monty_hall_choice': {'type': 'monty_hall_choice', 'choice': 1},
+            'monty_hall_change': {'type': 'monty_hall_choice', 'change': 'いいえ'},
+            'maze_choice': {'type': 'maze_choice', 'choice_index': 0},
+            'spin_slot': {'type': 'spin_slot', 'slot_index': 0},
+        }[decision]
+        version = game.version
+        actions.play(game, action)
+        journal.record(game_id, game, action, version)
+
+
+def test_recover_after_crash(tmp_path):
+    directory = str(tmp_path)
+    journal = GameJournal(directory, snapshot_every=8, segment_bytes=4000)
+    assert journal.recover() == []
+    games = {}
+    for n in range(3):
+        game_id = f"g{n}"
+        games[game_id] = new_game(max_turns=40, seed=game_id)
+        journal.start(game_id, games[game_id])
+    for _ in range(30):
+        for game_id, game in games.items():
+            _play(journal, game_id, game, 3)
+    journal.end('g2')
+    # 書きかけの行が残っていても読み飛ばす
+    with open(journal._segments()[-1], 'ab') as f:
+        f.write(b'{"t":"act","g":"g0"')
+    _crash(journal)
+
+    recovered = dict(GameJournal(directory).recover())
+
+    assert sorted(recovered) == ['g0', 'g1']
+    for game_id, game in recovered.items():
+        assert snapshot.dumps(game) == snapshot.dumps(games[game_id])
+
+
+def test_directory_is_locked(tmp_path):
+    journal = GameJournal(str(tmp_path))
+    with pytest.raises(JournalError):
+        GameJournal(str(tmp_path))
+    journal.close()
+    GameJournal(str(tmp_path)).close()
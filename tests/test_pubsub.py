@@ -0,0 +1,63 @@
+import json
+
+from pubsub import Broadcaster, FanOut
+
+
+def _events(subscription):
+    # 溜まっているフレームを (イベント名, data) の一覧にする
+    events = []
+    while True:
+        frame = subscription.get(timeout=0)
+        if frame is None:
+            return events
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+        lines = frame.strip().split('\n')
+        data = next(line for line in lines if line.startswith('data: '))
+        events.append((lines[0][len('event: '):], json.loads(data[len('data: '):])))
+
+
+def test_fanout_overflow_resyncs():
+    state = {'version': 0}
+    resyncs = []
+    fanout = FanOut(lambda game_id: dict(state), max_bytes=1024, on_resync=lambda: resyncs.append(1))
+    try:
+        subscription = fanout.subscribe('g')
+        assert _events(subscription) == [('state', {'version': 0})]
+
+        # 読まない観戦者に、溜められる大きさを超える差分を送る
+        for version in range(1, 21):
+            state['version'] = version
+            fanout.publish('g', 'update', {'version': version, 'padding': 'x' * 200}, version)
+            assert fanout.flush()
+
+        events = _events(subscription)
+        assert resyncs
+        assert not subscription.closed
+        # 捨てた差分の代わりに状態全体が届き、その後の差分は続きから届く
+        kinds = [kind for kind, _ in events]
+        assert 'state' in kinds
+        resync = kinds.index('state')
+        assert all(kind == 'update' for kind in kinds[resync + 1:])
+        assert events[-1][1]['version'] == 20
+        versions = [data['version'] for _, data in events[resync:]]
+        assert versions == list(range(versions[0], 21))
+    finally:
+        fanout.stop()
+
+
+def test_broadcaster_overflow_closes():
+    broadcaster = Broadcaster(queue_size=2)
+    subscription = broadcaster.subscribe('g')
+    for version in range(3):
+        broadcaster.publish('g', 'update', {'version': version})
+    assert subscription.closed
+
+
+def test_close_wakes_subscriber():
+    broadcaster = Broadcaster()
+    subscription = broadcaster.subscribe('g')
+    broadcaster.close('g')
+    assert subscription.get(timeout=5) is None
+    assert subscription.closed
+    assert broadcaster.subscriber_count('g') == 0
@@ -0,0 +1,46 @@
+import app
+
+
+def _start(client, **settings):
+    response = client.post('/start_game', json=settings)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['game_id']
+
+
+def test_replay_reproduces_seeded_game(client):
+    game_id = _start(client, num_players=3, cpu_players=[1, 2], max_turns=15, seed='replay')
+    client.post('/batch', json={'game_id': game_id, 'auto': {'policy': 'random', 'seed': 1}})
+    state = client.get(f"/get_game_state?game_id={game_id}").get_json()
+    assert state['is_over']
+
+    replayed = client.post('/replay', json={'game_id': game_id}).get_json()
+    assert replayed['seed'] == 'replay'
+    assert replayed['matches'] is True
+
+    # 同じシードと操作の一覧だけからでも同じ結果になる
+    with app.registry.session(game_id) as game:
+        history = list(game.history)
+    body = {'num_players': 3, 'cpu_players': [1, 2], 'max_turns': 15, 'seed': 'replay', 'actions': history}
+    again = client.post('/replay', json=body).get_json()
+    assert again['state'] == replayed['state']
+
+
+def test_same_seed_same_rolls(client):
+    body = {'seed': 42, 'num_players': 2, 'actions': [{'type': 'roll_dice'}] * 6}
+    first = client.post('/replay', json=body).get_json()
+    second = client.post('/replay', json=body).get_json()
+    assert first == second
+
+    # 同じシードのゲームは、他のゲームと交互に進めても同じ出目になる
+    games = [_start(client, seed='s'), _start(client, seed='s')]
+    rolls = {game_id: [] for game_id in games}
+    for _ in range(3):
+        for game_id in games:
+            players = client.post('/roll_dice', json={'game_id': game_id}).get_json()['players']
+            rolls[game_id].append(players)
+    assert rolls[games[0]] == rolls[games[1]]
+
+
+def test_replay_requires_seed(client):
+    response = client.post('/replay', json={'actions': []})
+    assert response.status_code == 400
@@ -0,0 +1,98 @@
+import pytest
+
+import actions
+import app
+from conftest import new_game
+from rooms import GameRegistry
+from store import MemoryStore, VersionConflict
+
+
+def test_rooms_are_isolated():
+    registry = GameRegistry()
+    start = new_game(seed='a').version
+    first = registry.create(new_game(seed='a'))
+    second = registry.create(new_game(seed='a'))
+    assert first != second
+
+    with registry.session(first, write=True) as game:
+        for _ in range(5):
+            actions.play(game, {'type': 'roll_dice'})
+
+    with registry.session(first) as game:
+        assert game.version == start + 5
+    with registry.session(second) as game:
+        assert game.version == start
+        assert all(player.position == 0 for player in game.players)
+
+
+def test_unknown_room():
+    registry = GameRegistry(store=MemoryStore())
+    with registry.session('missing') as game:
+        assert game is None
+    # ストアに無いIDで部屋を作らない
+    assert len(registry) == 0
+
+
+def test_cache_eviction_keeps_stored_game():
+    closed = []
+    registry = GameRegistry(max_rooms=1, store=MemoryStore(), on_close=closed.append)
+    first = registry.create(new_game())
+    registry.create(new_game())
+    assert len(registry) == 1
+    assert closed == []
+    with registry.session(first) as game:
+        assert game is not None
+
+    registry.remove(first)
+    assert closed == [first]
+
+
+def test_eviction_without_store_closes_game():
+    closed = []
+    registry = GameRegistry(max_rooms=1, on_close=closed.append)
+    first = registry.create(new_game())
+    registry.create(new_game())
+    assert closed == [first]
+
+
+def test_concurrent_write_conflicts():
+    store = MemoryStore()
+    worker_a = GameRegistry(store=store)
+    worker_b = GameRegistry(store=store)
+    start = new_game().version
+    game_id = worker_a.create(new_game())
+
+    with pytest.raises(VersionConflict):
+        with worker_a.session(game_id, write=True) as game:
+            with worker_b.session(game_id, write=True) as other:
+                actions.play(other, {'type': 'roll_dice'})
+            actions.play(game, {'type': 'roll_dice'})
+
+    # 負けた側は手元の状態を捨て、ストアの状態を読み直す
+    with worker_a.session(game_id) as game:
+        assert game.version == start + 1
+
+
+def test_conflict_returns_409(client, monkeypatch):
+    store = MemoryStore()
+    monkeypatch.setattr(app, 'registry', GameRegistry(store=store))
+    other_worker = GameRegistry(store=store)
+    game_id = client.post('/start_game', json={'num_players': 2}).get_json()['game_id']
+    start = client.get(f"/get_game_state?game_id={game_id}").get_json()['version']
+
+    apply = app._apply
+
+    def racing_apply(game_id, game, action):
+        # このリクエストが読んだ後に、他のワーカーが同じゲームを進める
+        with other_worker.session(game_id, write=True) as other:
+            actions.play(other, {'type': 'roll_dice'})
+        return apply(game_id, game, action)
+
+    monkeypatch.setattr(app, '_apply', racing_apply)
+    response = client.post('/roll_dice', json={'game_id': game_id})
+    assert response.status_code == 409
+
+    monkeypatch.setattr(app, '_apply', apply)
+    response = client.post('/roll_dice', json={'game_id': game_id})
+    assert response.status_code == 200
+    assert response.get_json()['version'] == start + 2
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+import actions
+import serialization
+import snapshot
+from conftest import new_game
+from game_logic import DICE_CATALOGUE
+
+
+def _play(game, steps, rng):
+    # 決めるべきことがあれば適当に選び、無ければサイコロを振る
+    for _ in range(steps):
+        decision, _ = actions.pending_decision(game)
+        if decision is None:
+            break
+        action = {
+            'roll_dice': {'type': 'roll_dice'},
+            'select_dice': {'type': 'select_dice', 'dice_index': rng.randrange(len(DICE_CATALOGUE))},
+            'monty_hall_choice': {'type': 'monty_hall_choice', 'choice': rng.randint(1, 3)},
+            'monty_hall_change': {'type': 'monty_hall_choice', 'change': rng.choice(['はい', 'いいえ'])},
+            'maze_choice': {'type': 'maze_choice', 'choice_index': 0},
+            'spin_slot': {'type': 'spin_slot', 'slot_index': rng.randrange(3)},
+        }[decision]
+        actions.play(game, action)
+
+
+@pytest.mark.parametrize('steps', [0, 1, 10, 40, 200])
+def test_round_trip(steps):
+    game = new_game(num_players=4, seed=f"snap-{steps}")
+    _play(game, steps, random.Random(steps))
+
+    loaded = snapshot.loads(snapshot.dumps(game))
+
+    assert serialization.game_to_dict(loaded) == serialization.game_to_dict(game)
+    assert loaded.seed == game.seed
+    assert loaded.version == game.version
+    assert loaded.history is None
+    # 読み込んだゲームからも同じ続きになる
+    _play(game, 20, random.Random(1))
+    _play(loaded, 20, random.Random(1))
+    assert snapshot.dumps(loaded) == snapshot.dumps(game)
+
+
+def test_rejects_other_versions():
+    blob = bytearray(snapshot.dumps(new_game()))
+    blob[1] = snapshot.FORMAT_VERSION + 1
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.loads(bytes(blob))
+
+
+def test_rejects_garbage():
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.loads(b'{"players": []}')
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.loads(snapshot.dumps(new_game())[:10])
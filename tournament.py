@@ -0,0 +1,502 @@
+"""トーナメント(勝ち抜き戦・総当たり戦)の組み合わせと進行。
+
+参加者は名前と操作の種類を持つ。種類は 'human'(人が画面から操作する)、'cpu'(aiの期待値の表)、
+またはpolicies.POLICIESの方針の名前。
+
+人が1人もいない対戦はHTTPを通さず、ワーカーでGameを直接最後まで進める。
+人がいる対戦は通常のゲームとして部屋を作り(人以外の席はコンピューターが操作する)、
+終わったらreport_gameで結果を受け取る。
+
+勝敗はtotal_distanceで決める(同じならGameと同じく先の席)。順位表は対戦が1つ終わるたびに
+その対戦の分だけ足し込む。勝ち抜き戦は1回戦の対戦がすべて終わってから次の回戦を組む。
+
+各対戦の乱数は (シード, 対戦番号) だけから作るので、ワーカーの数や終わる順番が変わっても、
+自動の対戦の結果は同じになる。
+
+    python tournament.py --entrants cpu greedy random random cpu greedy --format bracket --workers 4
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import uuid
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import ai
+from actions import apply_action, pending_decision, policy_action
+from boards import DEFAULT_BOARD_NAME, board_template
+from game_logic import MAX_TURNS, PREDEFINED_DICE_OPTIONS, Dice, Game, Player
+from policies import POLICIES
+
+FORMATS = ('bracket', 'round_robin')
+HUMAN = 'human'
+CPU = 'cpu'
+# 1つの卓に着ける人数
+MAX_TABLE_SIZE = 8
+MAX_ENTRANTS = 256
+# 参加者の名前の長さの上限。名前はゲームのメッセージに入り、他の参加者や観戦者の画面に出る
+MAX_NAME_LENGTH = 20
+_MARKUP = frozenset('<>&"\'')
+# 1対戦の操作数の上限。ルールの誤りで終わらない対戦があっても止まるように
+MAX_ACTIONS = 100000
+
+logger = logging.getLogger(__name__)
+
+
+def entrant_kinds():
+    return (HUMAN, CPU) + tuple(sorted(POLICIES))
+
+
+def match_rng(seed, match_id):
+    # montecarlo.game_rngと同じく、文字列のシードでプロセスによらず同じ乱数列にする
+    return random.Random(f"{seed}:{match_id}")
+
+
+def round_robin(names, table_size=2):
+    """総当たりの回戦の一覧を返す。各回戦は卓(名前の一覧)の一覧。
+
+    円順列の方法で並べ替え、1回戦ごとに先頭からtable_size人ずつ卓にする。
+    2人の卓なら全員と1回ずつ当たる。3人以上の卓では、同じ組み合わせが何度か重なることがある。
+    人数が卓で割り切れなければ、余った人はその回戦を休む(1人の卓は作らない)。
+    """
+    names = list(names)
+    if len(names) % 2 == 1:
+        names.append(None)
+    count = len(names)
+    rounds = []
+    for index in range(count - 1):
+        # 1人目を固定し、残りを1つずつ回す
+        rest = names[1:]
+        rotated = [names[0]] + rest[index:] + rest[:index]
+        if table_size == 2:
+            order = []
+            for i in range(count // 2):
+                order += [rotated[i], rotated[count - 1 - i]]
+        else:
+            order = rotated
+        tables = [[name for name in order[i:i + table_size] if name is not None]
+                  for i in range(0, count, table_size)]
+        tables = [table for table in tables if len(table) >= 2]
+        # 先手の有利が偏らないよう、回戦ごとに席順をずらす
+        rounds.append([table[index % len(table):] + table[:index % len(table)] for table in tables])
+    return rounds
+
+
+def bracket_round(names, table_size=2):
+    """勝ち抜き戦の1回戦分の卓の一覧と、不戦勝の名前の一覧を返す。"""
+    names = list(names)
+    tables = [names[i:i + table_size] for i in range(0, len(names), table_size)]
+    byes = []
+    if tables and len(tables[-1]) < 2:
+        byes = tables.pop()
+    return tables, byes
+
+
+def valid_name(name):
+    # 表示に使える名前か。制御文字とHTMLの記号は受け付けない
+    return (isinstance(name, str) and 0 < len(name) <= MAX_NAME_LENGTH and name.isprintable()
+            and not _MARKUP.intersection(name))
+
+
+class Entrant:
+    def __init__(self, name, kind=CPU, character='default.png'):
+        self.name = name
+        self.kind = kind
+        self.character = character
+
+    @property
+    def is_human(self):
+        return self.kind == HUMAN
+
+    def to_dict(self):
+        return {'name': self.name, 'kind': self.kind, 'character': self.character}
+
+
+class Match:
+    """1つの対戦。seatsは参加者の名前を席順に並べたもの。"""
+
+    def __init__(self, match_id, round_index, seats, live):
+        self.match_id = match_id
+        self.round_index = round_index
+        self.seats = seats
+        # 人がいて部屋を作る対戦
+        self.live = live
+        self.status = 'pending'
+        self.game_id = None
+        self.distances = None
+        self.winner = None
+
+    def finish(self, distances):
+        self.distances = list(distances)
+        best = max(range(len(self.seats)), key=lambda seat: self.distances[seat])
+        self.winner = self.seats[best]
+        self.status = 'done'
+
+    def to_dict(self):
+        return {'match_id': self.match_id, 'round': self.round_index, 'seats': self.seats,
+                'live': self.live, 'status': self.status, 'game_id': self.game_id,
+                'distances': self.distances, 'winner': self.winner}
+
+
+class Standings:
+    """順位表。対戦が終わるたびにその対戦の分だけ足し込む。
+
+    勝ち1つにつき3点、負けは0点。並びは点数、総移動距離の合計の順。
+    """
+
+    WIN_POINTS = 3
+
+    def __init__(self, names):
+        self.rows = {name: {'name': name, 'played': 0, 'wins': 0, 'points': 0, 'total_distance': 0}
+                     for name in names}
+
+    def record(self, match):
+        for name, distance in zip(match.seats, match.distances):
+            row = self.rows[name]
+            row['played'] += 1
+            row['total_distance'] += distance
+            if name == match.winner:
+                row['wins'] += 1
+                row['points'] += self.WIN_POINTS
+
+    def table(self):
+        rows = sorted(self.rows.values(), key=lambda row: (-row['points'], -row['total_distance'], row['name']))
+        return [dict(row, rank=rank) for rank, row in enumerate(rows, 1)]
+
+
+class MatchSpec:
+    """ワーカーに渡す自動の対戦の設定。盤面は雛形の名前で渡す。"""
+
+    def __init__(self, match_id, kinds, board, max_turns, seed):
+        self.match_id = match_id
+        self.kinds = kinds
+        self.board = board
+        self.max_turns = max_turns
+        self.seed = seed
+
+
+def play_match(spec):
+    """人のいない対戦をHTTPを通さずに最後まで進め、(対戦番号, 席ごとのtotal_distance) を返す。"""
+    board = board_template(spec.board)
+    dice = Dice(PREDEFINED_DICE_OPTIONS[0]['probabilities'].copy())
+    players = [Player(f"プレイヤー{seat+1}", 'default.png', is_cpu=kind == CPU)
+               for seat, kind in enumerate(spec.kinds)]
+    game = Game(players, board, dice, max_turns=spec.max_turns, rng=match_rng(spec.seed, spec.match_id))
+    game.start()
+    policies = [None if kind == CPU else POLICIES[kind]() for kind in spec.kinds]
+    if CPU in spec.kinds:
+        ai.table_for(board, dice, spec.max_turns)
+    for _ in range(MAX_ACTIONS):
+        decision, seat = pending_decision(game)
+        if decision is None:
+            break
+        if policies[seat] is None:
+            action = ai.decide(game, decision, seat)
+        else:
+            action = policy_action(policies[seat], game, decision, seat)
+        apply_action(game, action)
+    else:
+        raise RuntimeError(f"{MAX_ACTIONS}回の操作で対戦が終わりませんでした。")
+    return spec.match_id, [player.total_distance for player in game.players]
+
+
+class Tournament:
+    """トーナメント1つ分の組み合わせ、対戦、順位表。
+
+    対戦の実行はしない。start・recordで次に実行する対戦の一覧を返すので、呼び出し側
+    (TournamentRunner)が実行して結果をrecordに渡す。
+    """
+
+    def __init__(self, entrants, format='bracket', table_size=2, max_turns=20, board=DEFAULT_BOARD_NAME,
+                 seed=None, tournament_id=None):
+        if format not in FORMATS:
+            raise ValueError(f"不明な形式です: {format}")
+        if not 2 <= table_size <= MAX_TABLE_SIZE:
+            raise ValueError(f"1つの卓の人数は2以上{MAX_TABLE_SIZE}以下にしてください。")
+        if not 1 <= max_turns <= MAX_TURNS:
+            raise ValueError(f"ターン数は1以上{MAX_TURNS}以下にしてください。")
+        if not 2 <= len(entrants) <= MAX_ENTRANTS:
+            raise ValueError(f"参加者は2人以上{MAX_ENTRANTS}人以下にしてください。")
+        names = [entrant.name for entrant in entrants]
+        for name in names:
+            if not valid_name(name):
+                raise ValueError(f"参加者の名前は{MAX_NAME_LENGTH}文字以内で、記号 < > & \" ' を含まないものにしてください。")
+        if len(set(names)) != len(names):
+            raise ValueError('参加者の名前が重なっています。')
+        for entrant in entrants:
+            if entrant.kind not in entrant_kinds():
+                raise ValueError(f"不明な参加者の種類です: {entrant.kind}")
+        board_template(board)
+        self.tournament_id = tournament_id or uuid.uuid4().hex
+        self.entrants = {entrant.name: entrant for entrant in entrants}
+        self.format = format
+        self.table_size = table_size
+        self.max_turns = max_turns
+        self.board = board
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rounds = []
+        self.matches = {}
+        self.byes = []
+        self.standings = Standings(names)
+        self.status = 'pending'
+        # 勝ち抜き戦の優勝者
+        self.champion = None
+        # 対戦が進むたびに1ずつ増える
+        self.version = 0
+        self._remaining = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """最初の対戦(総当たりならすべての対戦)の一覧を返す。"""
+        with self._lock:
+            self.status = 'running'
+            names = list(self.entrants)
+            if self.format == 'round_robin':
+                for tables in round_robin(names, self.table_size):
+                    self._add_round(tables)
+            else:
+                tables, byes = bracket_round(names, self.table_size)
+                self._add_round(tables, byes)
+            self.version += 1
+            return [match for tables in self.rounds for match in tables]
+
+    def _add_round(self, tables, byes=()):
+        round_index = len(self.rounds)
+        matches = []
+        for seats in tables:
+            match_id = len(self.matches)
+            live = any(self.entrants[name].is_human for name in seats)
+            match = self.matches[match_id] = Match(match_id, round_index, seats, live)
+            matches.append(match)
+        self.rounds.append(matches)
+        self.byes.append(list(byes))
+        self._remaining += len(matches)
+        return matches
+
+    def spec(self, match):
+        kinds = [self.entrants[name].kind for name in match.seats]
+        return MatchSpec(match.match_id, kinds, self.board, self.max_turns, self.seed)
+
+    def record(self, match_id, distances):
+        """対戦の結果を記録し、順位表に足し込む。続けて実行する対戦の一覧を返す。
+
+        すでに結果のある対戦なら何もしない。
+        """
+        with self._lock:
+            match = self.matches[match_id]
+            if match.status in ('done', 'abandoned'):
+                return []
+            match.finish(distances)
+            self.standings.record(match)
+            return self._match_closed(match)
+
+    def abandon(self, match_id):
+        # 終わる前に部屋が破棄された対戦。誰も勝ち上がらない
+        with self._lock:
+            match = self.matches[match_id]
+            if match.status in ('done', 'abandoned'):
+                return []
+            match.status = 'abandoned'
+            return self._match_closed(match)
+
+    def _match_closed(self, match):
+        self.version += 1
+        self._remaining -= 1
+        if self._remaining > 0:
+            return []
+        if self.format == 'bracket':
+            current = self.rounds[-1]
+            advancing = [m.winner for m in current if m.status == 'done'] + self.byes[-1]
+            if len(advancing) >= 2:
+                tables, byes = bracket_round(advancing, self.table_size)
+                return self._add_round(tables, byes)
+            self.champion = advancing[0] if advancing else None
+        self.status = 'done'
+        return []
+
+    def to_dict(self):
+        with self._lock:
+            payload = {
+                'tournament_id': self.tournament_id,
+                'format': self.format,
+                'table_size': self.table_size,
+                'max_turns': self.max_turns,
+                'board': self.board,
+                'seed': self.seed,
+                'status': self.status,
+                'version': self.version,
+                'entrants': [entrant.to_dict() for entrant in self.entrants.values()],
+                'rounds': [{'matches': [match.to_dict() for match in matches], 'byes': byes}
+                           for matches, byes in zip(self.rounds, self.byes)],
+                'standings': self.standings.table(),
+            }
+            if self.format == 'bracket' and self.status == 'done':
+                payload['champion'] = self.champion
+            return payload
+
+
+class TournamentRunner:
+    """トーナメントを保持し、対戦をワーカーに割り振る。
+
+    自動の対戦はworkersが2以上ならプロセスプール、1ならスレッド1つで実行する。
+    人のいる対戦はopen_live(tournament, match)で部屋を作り、そのゲームIDを返してもらう。
+    部屋のゲームが終わったらreport_game、破棄されたらclose_gameを呼ぶ。
+    """
+
+    def __init__(self, workers=None, open_live=None, on_change=None, max_tournaments=1000):
+        self.workers = workers or os.cpu_count() or 1
+        # 終わったトーナメントはこの数を超えたら古いものから捨てる
+        self.max_tournaments = max_tournaments
+        self.open_live = open_live
+        # トーナメントの状態が変わるたびにトーナメントを渡して呼ぶ
+        self.on_change = on_change
+        self.tournaments = {}
+        # ゲームID → (トーナメント, 対戦番号)
+        self.live_games = {}
+        self.executor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tournaments)
+
+    def _executor(self):
+        with self._lock:
+            if self.executor is None:
+                if self.workers > 1:
+                    # Webサーバーのスレッドを持ったままforkしないよう、spawnでプロセスを作る
+                    self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self.executor = ThreadPoolExecutor(1, thread_name_prefix='tournament')
+            return self.executor
+
+    def get(self, tournament_id):
+        return self.tournaments.get(tournament_id)
+
+    def start(self, tournament):
+        with self._lock:
+            self.tournaments[tournament.tournament_id] = tournament
+            # 辞書は作った順なので、先頭から終わったものを捨てる
+            excess = len(self.tournaments) - self.max_tournaments
+            finished = [key for key, value in self.tournaments.items() if value.status == 'done']
+            for tournament_id in finished[:max(excess, 0)]:
+                del self.tournaments[tournament_id]
+        self._schedule(tournament, tournament.start())
+        return tournament
+
+    def _schedule(self, tournament, matches):
+        for match in matches:
+            if match.live:
+                match.game_id = self.open_live(tournament, match)
+                match.status = 'running'
+                with self._lock:
+                    self.live_games[match.game_id] = (tournament, match.match_id)
+            else:
+                match.status = 'running'
+                future = self._submit(tournament.spec(match))
+                future.add_done_callback(
+                    lambda future, tournament=tournament, match_id=match.match_id:
+                    self._finished(tournament, match_id, future))
+        if matches:
+            self._changed(tournament)
+
+    def _submit(self, spec):
+        executor = self._executor()
+        try:
+            return executor.submit(play_match, spec)
+        except BrokenExecutor:
+            # ワーカーが落ちて使えなくなったプールは作り直す
+            self._discard(executor)
+            return self._executor().submit(play_match, spec)
+
+    def _discard(self, executor):
+        with self._lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def _finished(self, tournament, match_id, future):
+        try:
+            _, distances = future.result()
+        except Exception:
+            # 対戦1つの失敗でトーナメント全体を止めない
+            logger.exception('トーナメント%sの対戦%sを実行できませんでした。', tournament.tournament_id, match_id)
+            self._schedule(tournament, tournament.abandon(match_id))
+        else:
+            self._schedule(tournament, tournament.record(match_id, distances))
+        self._changed(tournament)
+
+    def _changed(self, tournament):
+        if self.on_change is not None:
+            self.on_change(tournament)
+
+    def report_game(self, game_id, distances):
+        """部屋で進めた対戦のゲームが終わったら、席ごとのtotal_distanceを渡して呼ぶ。
+
+        トーナメントの対戦でなければ何もしない。
+        """
+        with self._lock:
+            entry = self.live_games.pop(game_id, None)
+        if entry is None:
+            return
+        tournament, match_id = entry
+        self._schedule(tournament, tournament.record(match_id, distances))
+        self._changed(tournament)
+
+    def close_game(self, game_id):
+        with self._lock:
+            entry = self.live_games.pop(game_id, None)
+        if entry is None:
+            return
+        tournament, match_id = entry
+        self._schedule(tournament, tournament.abandon(match_id))
+        self._changed(tournament)
+
+    def is_live(self, game_id):
+        return game_id in self.live_games
+
+    def shutdown(self):
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def run(entrants, format='bracket', table_size=2, max_turns=20, board=DEFAULT_BOARD_NAME, seed=0, workers=None):
+    """人のいないトーナメントを最後まで実行して返す。"""
+    if any(entrant.is_human for entrant in entrants):
+        raise ValueError('人のいるトーナメントはWebから実行してください。')
+    done = threading.Event()
+    runner = TournamentRunner(workers, on_change=lambda t: t.status == 'done' and done.set())
+    tournament = Tournament(entrants, format, table_size, max_turns, board, seed)
+    try:
+        runner.start(tournament)
+        done.wait()
+    finally:
+        runner.shutdown()
+    return tournament
+
+
+def main():
+    parser = argparse.ArgumentParser(description='すごろくのトーナメント')
+    parser.add_argument('--entrants', nargs='+', required=True, choices=entrant_kinds()[1:],
+                        help='参加者の種類を人数分')
+    parser.add_argument('--format', choices=FORMATS, default='bracket')
+    parser.add_argument('--table-size', type=int, default=2)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--board', default=DEFAULT_BOARD_NAME)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    entrants = [Entrant(f"{kind}{i+1}", kind) for i, kind in enumerate(args.entrants)]
+    tournament = run(entrants, args.format, args.table_size, args.turns, args.board, args.seed, args.workers)
+    result = tournament.to_dict()
+    print(json.dumps({key: result[key] for key in ('standings', 'champion') if key in result},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()